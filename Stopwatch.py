@@ -6,23 +6,26 @@ class Stopwatch:
         self.num_runs = 0
         self.total_ns = 0
         self.last_start = 0
+        self.last_ns = 0
         self.is_running = False
 
     def start(self):
         if not self.is_running:
             self.num_runs += 1
-            self.last_start = time.time_ns()  # should I use monotonic_ns()?
+            self.last_start = time.perf_counter_ns()
             self.is_running = True
 
     def stop(self):
         if self.is_running:
-            self.total_ns += time.time_ns() - self.last_start
+            self.last_ns = time.perf_counter_ns() - self.last_start
+            self.total_ns += self.last_ns
             self.is_running = False
 
     def reset(self):
         self.num_runs = 0
         self.total_ns = 0
         self.last_start = 0
+        self.last_ns = 0
         self.is_running = False
 
     def passed_ns(self) -> int:
@@ -0,0 +1,273 @@
+import argparse
+import ast
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+from typing import Dict, List, Any
+
+import city_file
+import config
+import event_log
+import export
+import generation
+import profiler
+from SnapType import SnapType
+
+
+def parse_override(text: str) -> tuple:
+    """ Parses a NAME=VALUE config override, VALUE being a python literal """
+    if "=" not in text:
+        raise argparse.ArgumentTypeError(
+            "Override '{}' is not of the form NAME=VALUE".format(text))
+    name, value = text.split("=", 1)
+    name = name.strip().upper()
+
+    if not hasattr(config, name):
+        raise argparse.ArgumentTypeError(
+            "Unknown config option '{}'".format(name))
+    try:
+        value = ast.literal_eval(value.strip())
+    except (ValueError, SyntaxError):
+        raise argparse.ArgumentTypeError(
+            "Value of '{}' is not a python literal".format(name))
+
+    return name, value
+
+
+def apply_overrides(overrides: Dict[str, Any]):
+    for name, value in overrides.items():
+        setattr(config, name, value)
+
+
+def city_digest(city: generation.City) -> str:
+    """
+    Hashes the geometry and structure of a city so that two runs of the same
+    seed can be compared
+    """
+    digest = hashlib.sha1()
+    for road in city.roads:
+        parent_id = road.parent.global_id if road.parent is not None else -1
+        # Coordinates go through float() so that a city loaded from a file,
+        # which has float coordinates throughout, hashes the same as the
+        # generated one, whose first roads have int coordinates
+        start = (float(road.start[0]), float(road.start[1]))
+        end = (float(road.end[0]), float(road.end[1]))
+        digest.update(repr((road.global_id, start, end,
+                            road.is_highway, road.is_branch,
+                            int(road.has_snapped), road.t, parent_id,
+                            sorted(link.global_id for link in road.links_s),
+                            sorted(link.global_id for link in road.links_e)))
+                      .encode())
+    return digest.hexdigest()
+
+
+def summarize(seed: int, city: generation.City, time_ms: float) -> dict:
+    snaps = {snap.name: 0 for snap in SnapType}
+    highways = 0
+    for road in city.roads:
+        snaps[SnapType(road.has_snapped).name] += 1
+        if road.is_highway:
+            highways += 1
+
+    return {
+        "seed": seed,
+        "max_segs": config.MAX_SEGS,
+        "segments": len(city.roads),
+        "highways": highways,
+        "snaps": snaps,
+        "time_ms": time_ms,
+        "digest": city_digest(city)
+    }
+
+
+def run_seed(seed: int, overrides: Dict[str, Any], quiet: bool = True,
+             city_path: str = None, export_paths: List[str] = (),
+             export_lots: bool = False, profile_path: str = None,
+             event_log_path: str = None) -> dict:
+    """
+    Generates the city for a single seed in isolation from any city generated
+    before it in the same process. Config overrides are re-applied on every
+    call, and generate() uses its own segment ids and random state
+    :param city_path: File to save the generated city to
+    :param export_paths: Files to export the city to, in the format given by
+    each one's extension
+    :param export_lots: Whether to include the lots in the exports
+    :param profile_path: Profiles the generation, writing the timings to
+    <profile_path>.json and flame graph stacks to <profile_path>.collapsed
+    :param event_log_path: File to write the event log of the generation to,
+    which replay.py can replay
+    """
+    apply_overrides(overrides)
+
+    with contextlib.ExitStack() as stack:
+        if quiet:
+            stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+        if profile_path is not None:
+            profile = stack.enter_context(profiler.profiling())
+        if event_log_path is not None:
+            log = stack.enter_context(event_log.recording())
+        city = generation.generate(seed)
+
+    if profile_path is not None:
+        profile.write_json(profile_path + ".json")
+        profile.write_collapsed(profile_path + ".collapsed")
+    if event_log_path is not None:
+        log.save(event_log_path)
+
+    if city_path is not None:
+        city_file.save(city, city_path)
+    for path in export_paths:
+        export.WRITERS[path.rsplit(".", 1)[-1]](city, path, export_lots)
+
+    return summarize(seed, city, generation.watch_total.passed_ms())
+
+
+def run_batch(seeds: List[int], overrides: Dict[str, Any], workers: int,
+              out_dir: str = None, quiet: bool = True,
+              save_cities: bool = False, export_formats: List[str] = (),
+              export_lots: bool = False, profile: bool = False,
+              event_logs: bool = False) -> List[dict]:
+    """
+    Generates a city for every seed, spread over a pool of worker processes
+    :param seeds: Seeds to generate
+    :param overrides: config options to set before each generation
+    :param workers: Number of processes, 0 or 1 runs serially in this process
+    :param out_dir: Directory to write a <seed>.json result file per seed to,
+    as each seed finishes. Needed for any of the files below
+    :param quiet: Suppresses the output of generate()
+    :param save_cities: Also saves each city to <seed>.city in out_dir
+    :param export_formats: Extensions of export.WRITERS to also export each
+    city to as <seed>.<extension> in out_dir
+    :param export_lots: Whether to include the lots in the exports
+    :param profile: Also profiles each generation, writing the timings to
+    <seed>.profile.json and <seed>.profile.collapsed in out_dir
+    :param event_logs: Also records the event log of each generation to
+    <seed>.events in out_dir
+    :return: The results in the same order as seeds
+    """
+    if ((save_cities or export_formats or profile or event_logs)
+            and out_dir is None):
+        raise ValueError("Saving cities, exports, profiles and event logs "
+                         "need an out_dir")
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+
+    jobs = [(seed, overrides, quiet,
+             os.path.join(out_dir, "{}.city".format(seed)) if save_cities
+             else None,
+             [os.path.join(out_dir, "{}.{}".format(seed, extension))
+              for extension in export_formats],
+             export_lots,
+             os.path.join(out_dir, "{}.profile".format(seed)) if profile
+             else None,
+             os.path.join(out_dir, "{}.events".format(seed)) if event_logs
+             else None)
+            for seed in seeds]
+
+    results = [None] * len(jobs)
+    with contextlib.ExitStack() as stack:
+        if workers <= 1:
+            finished = map(_run_job, enumerate(jobs))
+        else:
+            # Workers are spawned rather than forked so that none of them
+            # inherit state from this process. Within a worker, run_seed
+            # resets everything a previous city could have left behind
+            context = multiprocessing.get_context("spawn")
+            pool = stack.enter_context(context.Pool(workers))
+            finished = pool.imap_unordered(_run_job, enumerate(jobs))
+
+        # Each result is written as soon as its seed finishes, so a batch
+        # that is stopped part way keeps the seeds it got through
+        for index, result in finished:
+            results[index] = result
+            if out_dir is not None:
+                path = os.path.join(out_dir, "{}.json".format(result["seed"]))
+                with open(path, "w") as out_file:
+                    json.dump(result, out_file, indent=2)
+
+    return results
+
+
+def _run_job(indexed_job: tuple) -> tuple:
+    """
+    Runs a job of run_batch, keeping its index as the results come back in
+    the order they finish
+    """
+    index, job = indexed_job
+    return index, run_seed(*job)
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Generate cities without opening a window")
+    seed_group = parser.add_mutually_exclusive_group(required=True)
+    seed_group.add_argument("--seeds", type=int, nargs="+",
+                            help="List of seeds to generate")
+    seed_group.add_argument("--range", type=int, nargs=2,
+                            metavar=("START", "STOP"),
+                            help="Generate every seed in [START, STOP)")
+    parser.add_argument("--segs", type=int, default=config.MAX_SEGS,
+                        help="Overrides config.MAX_SEGS")
+    parser.add_argument("--set", type=parse_override, action="append",
+                        default=[], metavar="NAME=VALUE",
+                        help="Overrides a config option, can be repeated")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of worker processes, 1 runs serially")
+    parser.add_argument("--out", default=None,
+                        help="Directory to write per-seed results to")
+    parser.add_argument("--save-cities", action="store_true",
+                        help="Save each city to <seed>.city in the --out "
+                             "directory, see city_file.py")
+    parser.add_argument("--export", nargs="+", default=[],
+                        choices=sorted(export.WRITERS),
+                        help="Export each city to <seed>.<format> in the --out "
+                             "directory")
+    parser.add_argument("--export-lots", action="store_true",
+                        help="Include the lots between roads in the exports")
+    parser.add_argument("--profile", action="store_true",
+                        help="Time each part of generation, writing the "
+                             "timings to <seed>.profile.json and flame graph "
+                             "stacks to <seed>.profile.collapsed in --out")
+    parser.add_argument("--event-log", action="store_true",
+                        help="Record every decision made generating each "
+                             "city to <seed>.events in --out, which "
+                             "replay.py can replay")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Show the output of each generation")
+
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None):
+    args = parse_args(argv)
+    if ((args.save_cities or args.export or args.profile or args.event_log)
+            and args.out is None):
+        raise SystemExit("--save-cities, --export, --profile and --event-log "
+                         "need an --out directory")
+
+    if args.seeds is not None:
+        seeds = args.seeds
+    else:
+        seeds = list(range(args.range[0], args.range[1]))
+
+    overrides = dict(args.set)
+    overrides["MAX_SEGS"] = args.segs
+
+    results = run_batch(seeds, overrides, args.workers, args.out,
+                        not args.verbose, args.save_cities, args.export,
+                        args.export_lots, args.profile, args.event_log)
+
+    total_ms = 0
+    for result in results:
+        total_ms += result["time_ms"]
+        print("{seed}: {segments} segments in {time_ms:.1f} ms ({digest})"
+              .format(**result))
+    print("Generated {} cities in {:.1f} ms of generation time"
+          .format(len(results), total_ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from typing import Any, Dict, List
+
+import batch
+import config
+import generation
+
+# Config overrides giving each density of city. Streets branch more often
+# and are shorter in denser cities
+DENSITIES: Dict[str, Dict[str, Any]] = {
+    "sparse": {"STREET_BRANCH_CHANCE": 0.4, "STREET_LENGTH": 400},
+    "default": {},
+    "dense": {"STREET_BRANCH_CHANCE": 1.0, "STREET_LENGTH": 200},
+}
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_SEED = 1
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "bench_baseline.json")
+# Fraction a result can be worse than the baseline before it is a regression
+DEFAULT_THRESHOLD = 0.15
+
+# The queue is sampled for its peak length every this many roads
+_QUEUE_SAMPLE_SEGS = 500
+
+# Results compared against the baseline, and whether bigger is better
+_COMPARED = {"segs_per_sec": True, "peak_rss_mb": False}
+
+
+def case_name(density: str, size: int) -> str:
+    return "{}-{}".format(density, size)
+
+
+def run_case(seed: int, density: str, size: int) -> dict:
+    """
+    Generates one city and measures it. Meant to be run in a fresh process,
+    so the peak memory is that of this city alone
+    """
+    batch.apply_overrides(DENSITIES[density])
+    config.MAX_SEGS = size
+
+    rss_before = _peak_rss_mb()
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        generator = generation.Generator(seed)
+        # Same roads as generate(), run in steps to see how long the queue gets
+        queue_peak = 0
+        for limit in range(_QUEUE_SAMPLE_SEGS, size + _QUEUE_SAMPLE_SEGS,
+                           _QUEUE_SAMPLE_SEGS):
+            generator.run_until(min(limit, size))
+            queue_peak = max(queue_peak, len(generator.road_queue))
+    wall_time = time.perf_counter() - start_time
+
+    city = generator.city
+    leaves = city.sectors.leaves()
+    leaf_sizes = [len(leaf.items) for leaf in leaves]
+
+    return {"name": case_name(density, size),
+            "seed": seed,
+            "density": density,
+            "max_segs": size,
+            "segments": len(city.roads),
+            "wall_time_s": wall_time,
+            "segs_per_sec": len(city.roads) / wall_time,
+            "peak_rss_mb": _peak_rss_mb(),
+            "start_rss_mb": rss_before,
+            "queue": {"peak_sampled": queue_peak,
+                      "left": len(generator.road_queue)},
+            "sectors": {"roads": len(city.sectors),
+                        "leaves": len(leaves),
+                        "max_per_leaf": max(leaf_sizes, default=0),
+                        "mean_per_leaf": (sum(leaf_sizes) / len(leaves)
+                                          if leaves else 0.0),
+                        "root_size": (city.sectors.root.bounds[2]
+                                      - city.sectors.root.bounds[0])},
+            "digest": batch.city_digest(city)}
+
+
+def run_suite(seed: int, densities: List[str], sizes: List[int],
+              repeat: int = 1) -> List[dict]:
+    """
+    Runs every case in its own process, keeping the fastest of repeat runs
+    """
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for density in densities:
+        for size in sizes:
+            best = None
+            for _ in range(repeat):
+                with context.Pool(1) as pool:
+                    result = pool.apply(run_case, (seed, density, size))
+                if best is None or result["wall_time_s"] < best["wall_time_s"]:
+                    best = result
+            print("{:>16} {:>8} segs {:>9.3f} s {:>10.0f} segs/s {:>8.1f} MB"
+                  .format(best["name"], best["segments"], best["wall_time_s"],
+                          best["segs_per_sec"], best["peak_rss_mb"]))
+            results.append(best)
+    return results
+
+
+def compare(results: List[dict], baseline: List[dict],
+            threshold: float) -> List[str]:
+    """
+    Compares results against a baseline
+    :return: A description of each regression worse than the threshold
+    """
+    by_name = {entry["name"]: entry for entry in baseline}
+    regressions = []
+    print("{:>16} {:>14} {:>12} {:>12} {:>8}".format(
+        "case", "result", "baseline", "now", "change"))
+    for result in results:
+        old = by_name.get(result["name"])
+        if old is None:
+            print("{:>16} not in the baseline".format(result["name"]))
+            continue
+        if old["digest"] != result["digest"]:
+            print("{:>16} generates a different city to the baseline"
+                  .format(result["name"]))
+
+        for key, higher_is_better in _COMPARED.items():
+            change = result[key] / old[key] - 1
+            worse = -change if higher_is_better else change
+            flag = " REGRESSION" if worse > threshold else ""
+            print("{:>16} {:>14} {:>12.1f} {:>12.1f} {:>+7.1%}{}".format(
+                result["name"], key, old[key], result[key], change, flag))
+            if flag:
+                regressions.append("{} {} {:+.1%}".format(
+                    result["name"], key, change))
+    return regressions
+
+
+def _peak_rss_mb() -> float:
+    """ Gets the most memory this process has had resident so far """
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks generating cities of several sizes and "
+                    "densities, and compares them to a stored baseline")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--densities", nargs="+", choices=list(DENSITIES),
+                        default=list(DENSITIES))
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs of each case, keeping the fastest")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE,
+                        help="Baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Fraction worse than the baseline a result can "
+                             "be before it fails")
+    parser.add_argument("--write-baseline", action="store_true",
+                        help="Save the results as the new baseline instead "
+                             "of comparing against it")
+    parser.add_argument("--out", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = run_suite(args.seed, args.densities, args.sizes, args.repeat)
+    report = {"python": platform.python_version(),
+              "machine": platform.machine(),
+              "results": results}
+
+    if args.out is not None:
+        with open(args.out, "w") as out_file:
+            json.dump(report, out_file, indent=2)
+
+    if args.write_baseline:
+        with open(args.baseline, "w") as out_file:
+            json.dump(report, out_file, indent=2)
+        print("Wrote baseline to {}".format(args.baseline))
+        return
+
+    if not os.path.exists(args.baseline):
+        raise SystemExit("No baseline at {}, make one with --write-baseline"
+                         .format(args.baseline))
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)["results"]
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print("Regressed by more than {:.0%}: {}".format(
+            args.threshold, ", ".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
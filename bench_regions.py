@@ -0,0 +1,122 @@
+import argparse
+import contextlib
+import io
+import time
+from typing import Tuple
+
+import batch
+import config
+import generation
+import regions
+
+
+# Factors closer than this to a road's ends count as the roads meeting at a
+# junction rather than crossing
+_END_MARGIN = 1e-6
+
+
+def crossings(city: generation.City) -> Tuple[int, int]:
+    """
+    Counts the pairs of roads that cross without a junction
+    :return: The number of crossings, and how many of them are within a
+    road's length of a region border
+    """
+    size = regions.region_size()
+    band = max(config.HIGHWAY_LENGTH, config.STREET_LENGTH)
+    total = 0
+    near_border = 0
+    for road in city.roads:
+        for other in city.sectors.near_seg(road, 0):
+            if other.global_id <= road.global_id:
+                continue
+            inter = road.find_intersect(other)
+            if inter is None:
+                continue
+            if not (_END_MARGIN < inter.main_factor < 1 - _END_MARGIN
+                    and _END_MARGIN < inter.other_factor < 1 - _END_MARGIN):
+                continue
+            total += 1
+            if any(min(coord % size, -coord % size) < band
+                   for coord in inter.point):
+                near_border += 1
+    return total, near_border
+
+
+def run_serial(seed: int) -> Tuple[generation.City, float]:
+    """
+    Generates a city in this process
+    :return: The city and the CPU seconds it took
+    """
+    start_cpu = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        city = generation.generate(seed)
+    return city, time.process_time() - start_cpu
+
+
+def run_regions(seed: int, workers: int) -> Tuple[generation.City, dict]:
+    """
+    Generates a city by regions with a number of worker processes
+    :return: The city and how long it took
+    """
+    start_time = time.perf_counter()
+    start_cpu = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        with regions.RegionGenerator(seed, workers) as generator:
+            generator.run_until(config.MAX_SEGS)
+            city = generator.city
+    times = {"wall": time.perf_counter() - start_time,
+             "main_cpu": time.process_time() - start_cpu,
+             # The CPU time of this process and the busiest worker in each
+             # phase, which is what the wall time would be with a core for
+             # each process. Only the wall time is measured, so read this
+             # instead on a machine with fewer cores than workers
+             "critical_path": generator.critical_path()}
+    return city, times
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares generating a city in one process to generating "
+                    "it by regions in several")
+    parser.add_argument("--seed", type=int, default=4)
+    parser.add_argument("--segs", type=int, default=100000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs of each case, keeping the fastest")
+    args = parser.parse_args()
+
+    config.MAX_SEGS = args.segs
+
+    serial_cpu = None
+    for _ in range(args.repeat):
+        city, seconds = run_serial(args.seed)
+        if serial_cpu is None or seconds < serial_cpu:
+            serial_cpu = seconds
+    print("one process: {} segs, {:.2f} CPU s, crossings: {}".format(
+        len(city.roads), serial_cpu, crossings(city)[0]))
+
+    print("{:>8} {:>8} {:>9} {:>9} {:>9} {:>9} {:>10} {:>8}".format(
+        "workers", "segs", "wall s", "main cpu", "critical", "speedup",
+        "crossings", "border"))
+    digests = set()
+    for workers in args.workers:
+        best = None
+        for _ in range(args.repeat):
+            city, times = run_regions(args.seed, workers)
+            digests.add(batch.city_digest(city))
+            if (best is None
+                    or times["critical_path"] < best["critical_path"]):
+                best = times
+        total, near_border = crossings(city)
+        print("{:>8} {:>8} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>10} {:>8}"
+              .format(workers, len(city.roads), best["wall"],
+                      best["main_cpu"], best["critical_path"],
+                      serial_cpu / best["critical_path"], total, near_border))
+
+    if len(digests) > 1:
+        raise SystemExit("The number of workers changed the city")
+    print("every worker count generated the same city")
+
+
+if __name__ == "__main__":
+    main()
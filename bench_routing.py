@@ -0,0 +1,91 @@
+import argparse
+import contextlib
+import io
+import random
+import time
+
+import chains
+import config
+import contraction
+import generation
+import landmarks
+import pathing
+
+
+def time_queries(search, pairs) -> tuple:
+    """
+    Gets the mean time in milliseconds of running search on each pair, and
+    the mean number of roads it expanded
+    """
+    expanded = 0
+    start_time = time.perf_counter()
+    for start, end in pairs:
+        data = pathing.PathData()
+        data.start = start
+        data.end = end
+        search(data)
+        expanded += len(data.searched)
+    query_ms = (time.perf_counter() - start_time) * 1000 / len(pairs)
+    return query_ms, expanded / len(pairs)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares the route searches on a generated city")
+    parser.add_argument("--seed", type=int, default=5)
+    parser.add_argument("--segs", type=int, default=10000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    config.MAX_SEGS = args.segs
+    with contextlib.redirect_stdout(io.StringIO()):
+        city = generation.generate(args.seed)
+
+    graph = pathing.Graph()
+    graph.precompute(city.roads)
+
+    start_time = time.perf_counter()
+    hierarchy = contraction.ContractionHierarchy.build(city.roads, graph)
+    build_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    path_landmarks = landmarks.Landmarks.build(city.roads, graph=graph)
+    landmarks_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    compact = chains.CompactGraph(city.roads)
+    chains_time = time.perf_counter() - start_time
+
+    rand = random.Random(args.seed)
+    pairs = [(rand.choice(city.roads), rand.choice(city.roads))
+             for _ in range(args.queries)]
+
+    results = (
+        ("dijkstra", time_queries(
+            lambda data: pathing.dijkstra(data, city.roads, graph), pairs)),
+        ("astar", time_queries(
+            lambda data: pathing.astar(data, city.roads, graph), pairs)),
+        ("landmarks", time_queries(path_landmarks.route, pairs)),
+        ("chains", time_queries(compact.route, pairs)),
+        ("hierarchy", time_queries(hierarchy.route, pairs)))
+
+    print("roads: {}, shortcuts and links: {}, build: {:.2f} s".format(
+        len(city.roads), len(hierarchy.up_targets) + len(hierarchy.down_sources),
+        build_time))
+    print("landmarks: {}, build: {:.2f} s".format(
+        len(path_landmarks.landmark_ids), landmarks_time))
+    print("chains: {} ({:.1%} of the roads), longest: {}, build: {:.2f} s".format(
+        len(compact), len(compact) / len(city.roads),
+        max(len(chain) for chain in compact.chains), chains_time))
+    print("{:>12} {:>10} {:>10}".format("search", "ms/query", "expanded"))
+    for name, (query_ms, expanded) in results:
+        print("{:>12} {:>10.3f} {:>10.1f}".format(name, query_ms, expanded))
+
+    dijkstra_ms = results[0][1][0]
+    hierarchy_ms = results[-1][1][0]
+    print("queries for the hierarchy to pay back its build: {:.0f}".format(
+        build_time * 1000 / (dijkstra_ms - hierarchy_ms)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import argparse
+import contextlib
+import gc
+import io
+import math
+import multiprocessing
+import resource
+import tracemalloc
+from typing import List
+
+import config
+import generation
+import road_store
+import roads
+
+
+def grid_roads(count: int) -> List[roads.Segment]:
+    """
+    Builds a square street grid of about count roads, linked the same way
+    generation links roads
+    """
+    side = math.ceil(math.sqrt(count / 2)) + 1
+    nodes = {}
+    grid = []
+
+    def add(start, end):
+        seg = roads.Segment(start, end, False)
+        for point, links in ((start, seg.links_s), (end, seg.links_e)):
+            for other in nodes.setdefault(point, []):
+                links.add(other)
+                if other.start == point:
+                    other.links_s.add(seg)
+                else:
+                    other.links_e.add(seg)
+            nodes[point].append(seg)
+        grid.append(seg)
+
+    for x in range(side):
+        for y in range(side):
+            if len(grid) < count:
+                add((x * 300.0, y * 300.0), ((x + 1) * 300.0, y * 300.0))
+            if len(grid) < count:
+                add((x * 300.0, y * 300.0), (x * 300.0, (y + 1) * 300.0))
+
+    return grid
+
+
+def measure(count: int) -> tuple:
+    """ Gets the bytes per road of Segment objects and of a RoadStore """
+    gc.collect()
+    tracemalloc.start()
+    segments = grid_roads(count)
+    object_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    store = road_store.RoadStore.from_segments(segments)
+
+    return object_bytes / count, store.nbytes() / count
+
+
+def measure_generated(seed: int, count: int) -> tuple:
+    """
+    Generates a city and packs it into a RoadStore. Generation still builds
+    a Segment per road, so the store only lowers the memory held once the
+    city is finished, not the peak while generating it
+    :return: The peak resident memory in MB while generating, the resident
+        memory once the city is packed and its Segments freed, and the
+        bytes per road of the store
+    """
+    config.MAX_SEGS = count
+    with contextlib.redirect_stdout(io.StringIO()):
+        city = generation.generate(seed)
+    generate_peak = _peak_rss_mb()
+
+    compacted = road_store.compact(city)
+    del city
+    gc.collect()
+    store_bytes = compacted.roads.store.nbytes() / len(compacted.roads)
+    return generate_peak, _rss_mb(), store_bytes
+
+
+def _peak_rss_mb() -> float:
+    """ Gets the most memory this process has had resident so far """
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _rss_mb() -> float:
+    """ Gets the memory this process has resident now """
+    with open("/proc/self/statm") as statm:
+        pages = int(statm.read().split()[1])
+    return pages * resource.getpagesize() / (1024 * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Reports the memory used per road by Segment objects and "
+                    "by a RoadStore, and the memory of generating cities and "
+                    "packing them into a RoadStore")
+    parser.add_argument("sizes", type=int, nargs="*",
+                        default=[10000, 100000, 1000000])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-generate", action="store_true",
+                        help="Only measure the street grid")
+    args = parser.parse_args()
+
+    # Each city is generated in its own process, so each peak is its own.
+    # They go first, as a process started from this one keeps the peak this
+    # one had so far
+    if not args.no_generate:
+        context = multiprocessing.get_context("spawn")
+        print("{:>10} {:>18} {:>18} {:>16}".format(
+            "segs", "generate peak MB", "packed RSS MB", "RoadStore B/road"))
+        for count in args.sizes:
+            with context.Pool(1) as pool:
+                generate_peak, packed_rss, store_bytes = pool.apply(
+                    measure_generated, (args.seed, count))
+            print("{:>10} {:>18.1f} {:>18.1f} {:>16.1f}".format(
+                count, generate_peak, packed_rss, store_bytes))
+
+    print("{:>10} {:>16} {:>16}".format("roads", "Segment B/road",
+                                        "RoadStore B/road"))
+    for count in args.sizes:
+        object_bytes, store_bytes = measure(count)
+        print("{:>10} {:>16.1f} {:>16.1f}".format(count, object_bytes,
+                                                  store_bytes))
+
+
+if __name__ == "__main__":
+    main()
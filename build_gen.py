@@ -1,95 +1,210 @@
-import math
+from typing import Iterator, List, Sequence, Tuple
 
-import roads
+import numpy
 
+import roads
 
-def gen_lots(city):
-    searched_right = set()
-    searched_left = set()
-    result = []
-
-    for seg in city.roads:
-        if seg not in searched_left:
-            lot = find_lot(seg, acute_left, searched_left,
-                           searched_right)
-            if lot is not None:
-                result.append(lot)
-        if seg not in searched_right:
-            lot = find_lot(seg, acute_right, searched_right,
-                           searched_left)
-            if lot is not None:
-                result.append(lot)
-    return result
-
-
-def find_lot(segment, angle_main, searched_main, searched_rev):
-    if len(segment.links_s) == 0:
-        return None
-
-    lot = [segment.start]
-    curr = angle_main(segment, segment.links_e)
-    if curr is None:
-        return None
-
-    main_in_lot = set()
-    rev_in_lot = set()
-
-    main_in_lot.add(segment)
-    link_at_start = curr.start == segment.end
-    while curr is not segment:
-        if link_at_start:
-            if curr in searched_main:
-                return None
-            lot.append(curr.start)
-
-            main_in_lot.add(curr)
-
-            next_seg = angle_main(curr, curr.links_e)
-            if next_seg is None:
-                return None
-            link_at_start = next_seg.start == curr.end
-        else:
-            if curr in searched_rev:
-                return None
-            lot.append(curr.end)
-
-            rev_in_lot.add(curr)
-
-            next_seg = angle_main(curr, curr.links_s)
-            if next_seg is None:
-                return None
-            link_at_start = next_seg.start == curr.start
-        curr = next_seg
-    searched_main |= main_in_lot
-    searched_rev |= rev_in_lot
-    return lot
-
-
-def acute_right(segment, neighbors):
-    min_neighbor = None
-    min_angle = 85
-
-    close_neighbor = None
-    for neighbor in neighbors:
-        diff = roads.angle_between_ccw(segment, neighbor)
-        if min_angle <= diff <= 360:
-            min_angle = diff
-            min_neighbor = neighbor
-        #if diff > 179:
-        #    close_neighbor = neighbor
-    return min_neighbor if min_neighbor is not None else close_neighbor
-
-
-def acute_left(segment, neighbors):
-    max_neighbor = None
-    max_angle = 275
-
-    close_neighbor = None
-    for neighbor in neighbors:
-        diff = roads.angle_between_ccw(segment, neighbor)
-        if max_angle >= diff >= 0:
-            max_angle = diff
-            max_neighbor = neighbor
-        #if diff < -179:
-        #    close_neighbor = neighbor
-    return max_neighbor if max_neighbor is not None else close_neighbor
+Point = Tuple[float, float]
+Lot = List[Point]
+
+# Outlines checked for crossing themselves at once, so that lots can still be
+# yielded a few at a time
+_BATCH_SIZE = 4096
+# Sine of the angle within which a point counts as on a line
+_ON_LINE = 1e-9
+
+
+class HalfEdges:
+    """
+    The roads as a planar graph, with each road split into two half-edges
+    running opposite ways along it. Half-edges 2k and 2k + 1 are the two
+    halves of one road. The half-edges leaving each point are sorted by angle
+    once, so following next from any half-edge walks around the face on its
+    left, and every face is found by walking each half-edge exactly once.
+    Roads meeting at the same point are joined whether or not they link
+    """
+    def __init__(self, city_roads: Sequence[roads.Segment]):
+        ends = numpy.array([(road.start, road.end) for road in city_roads],
+                           dtype=numpy.float64).reshape(-1, 2)
+        points, point_of = numpy.unique(ends, axis=0, return_inverse=True)
+        point_of = point_of.reshape(-1, 2)
+
+        # Roads that start and end at the same points are only kept once
+        low = point_of.min(axis=1)
+        high = point_of.max(axis=1)
+        _, first = numpy.unique(low * len(points) + high, return_index=True)
+        keep = numpy.sort(first)
+        keep = keep[low[keep] != high[keep]]
+
+        # The point each half-edge leaves from and the point it goes to
+        origin = point_of[keep].reshape(-1)
+        target = point_of[keep][:, ::-1].reshape(-1)
+
+        # The half-edges leaving each point, counterclockwise
+        angle = numpy.arctan2(points[target, 1] - points[origin, 1],
+                              points[target, 0] - points[origin, 0])
+        fans = numpy.lexsort((angle, origin))
+        fan_size = numpy.bincount(origin, minlength=len(points))
+        fan_start = numpy.cumsum(fan_size) - fan_size
+        position = numpy.empty(len(origin), dtype=numpy.int64)
+        position[fans] = numpy.arange(len(origin)) - fan_start[origin[fans]]
+
+        # Arriving along a half-edge, the face on its left carries on along
+        # the next half-edge clockwise from the way back
+        twin = numpy.arange(len(origin)) ^ 1
+        self.next: List[int] = fans[
+            fan_start[target]
+            + (position[twin] - 1) % fan_size[target]].tolist()
+        self.origin: List[int] = origin.tolist()
+        self.points: List[Point] = [tuple(point) for point in points.tolist()]
+
+    def faces(self) -> Iterator[List[int]]:
+        """ Yields the half-edges around each face, outer faces included """
+        visited = [False] * len(self.origin)
+        for first in range(len(self.origin)):
+            if visited[first]:
+                continue
+            face = []
+            half_edge = first
+            while not visited[half_edge]:
+                visited[half_edge] = True
+                face.append(half_edge)
+                half_edge = self.next[half_edge]
+            yield face
+
+    def lots(self) -> Iterator[Lot]:
+        """
+        Yields the outline of every face enclosed by roads. Roads sticking
+        into a face from its edge, with the face on both of their sides, are
+        left out of its outline. Overlapping roads are never split where they
+        overlap, so the graph isn't quite planar, and the faces around them
+        can have outlines that cross themselves or jump between points no
+        road joins. Those faces aren't lots, and are left out
+        """
+        candidates = []
+        for face in self.faces():
+            in_face = set(face)
+            kept = [half_edge for half_edge in face
+                    if half_edge ^ 1 not in in_face]
+            # Leaving out roads that stick in and come back out again joins
+            # up the rest of the walk, but leaving out a road the face is
+            # on both sides of that links two parts of it doesn't
+            if any(self.origin[half_edge ^ 1] != self.origin[after]
+                   for half_edge, after in zip(kept, kept[1:] + kept[:1])):
+                continue
+            outline = [self.points[self.origin[half_edge]]
+                       for half_edge in kept]
+            # Enclosed faces wind the opposite way to the faces around the
+            # outside of each group of roads
+            if len(outline) >= 3 and _signed_area(outline) > 0:
+                candidates.append(outline)
+            if len(candidates) == _BATCH_SIZE:
+                yield from _simple(candidates)
+                candidates = []
+        yield from _simple(candidates)
+
+
+class LotCache:
+    """
+    The lots of the last city they were found for, found again only once
+    roads.topology_changed() has been called or the city is a different one
+    """
+    def __init__(self):
+        self._roads = None
+        self._version = None
+        self._lots: List[Lot] = []
+
+    def lots(self, city) -> List[Lot]:
+        if self._roads is not city.roads or self._version != roads.topology_version:
+            self._lots = gen_lots(city)
+            self._roads = city.roads
+            self._version = roads.topology_version
+        return self._lots
+
+
+def gen_lots(city) -> List[Lot]:
+    return list(iter_lots(city))
+
+
+def iter_lots(city) -> Iterator[Lot]:
+    """
+    Finds the lots enclosed by the roads of the city, yielding each as soon
+    as it is found
+    """
+    if len(city.roads) == 0:
+        return iter(())
+    return HalfEdges(city.roads).lots()
+
+
+def _signed_area(outline: Lot) -> float:
+    """ Gets the area of a polygon, positive when it winds counterclockwise """
+    area = 0.0
+    x0, y0 = outline[-1]
+    for x1, y1 in outline:
+        area += x0 * y1 - x1 * y0
+        x0, y0 = x1, y1
+    return area / 2
+
+
+def _simple(outlines: List[Lot]) -> List[Lot]:
+    """
+    Gets the outlines that don't cross or touch themselves, checking every
+    pair of edges of the outlines with the same number of points at once
+    """
+    by_size = {}
+    for i, outline in enumerate(outlines):
+        by_size.setdefault(len(outline), []).append(i)
+
+    crossed = set()
+    for size, indices in by_size.items():
+        points = numpy.array([outlines[i] for i in indices],
+                             dtype=numpy.float64)
+        starts = points
+        ends = numpy.roll(points, -1, axis=1)
+
+        # Edges next to each other only meet where they join, unless the
+        # second doubles back along the first
+        first = ends - starts
+        second = numpy.roll(first, -1, axis=1)
+        folded = ((first[..., 0] * second[..., 1]
+                   - first[..., 1] * second[..., 0] == 0)
+                  & ((first * second).sum(axis=2) < 0)).any(axis=1)
+
+        # Every other pair of edges can't meet at all
+        i, j = numpy.triu_indices(size, 2)
+        apart = (i != 0) | (j != size - 1)
+        i, j = i[apart], j[apart]
+        met = _edges_meet(starts[:, i], ends[:, i],
+                          starts[:, j], ends[:, j]).any(axis=1)
+
+        crossed.update(numpy.array(indices)[folded | met].tolist())
+    return [outline for i, outline in enumerate(outlines) if i not in crossed]
+
+
+def _edges_meet(a: numpy.ndarray, b: numpy.ndarray, c: numpy.ndarray,
+                d: numpy.ndarray) -> numpy.ndarray:
+    """ Tests whether each edge a-b crosses or touches the edge c-d """
+    def side(p, q, r):
+        along = q - p
+        towards = r - p
+        cross = (along[..., 0] * towards[..., 1]
+                 - along[..., 1] * towards[..., 0])
+        # Points within rounding of the line count as on it, so a road ending
+        # on another without splitting it is caught
+        scale = (numpy.hypot(along[..., 0], along[..., 1])
+                 * numpy.hypot(towards[..., 0], towards[..., 1]))
+        return numpy.where(numpy.abs(cross) <= _ON_LINE * scale, 0,
+                           numpy.sign(cross))
+
+    side_c = side(a, b, c)
+    side_d = side(a, b, d)
+    side_a = side(c, d, a)
+    side_b = side(c, d, b)
+    straddle = (side_c * side_d <= 0) & (side_a * side_b <= 0)
+
+    # An end of an edge can be on the line of another far along it, so
+    # edges also have to overlap to meet
+    overlap = ((numpy.maximum(numpy.minimum(a, b), numpy.minimum(c, d))
+                <= numpy.minimum(numpy.maximum(a, b), numpy.maximum(c, d)))
+               .all(axis=-1))
+    return straddle & overlap
@@ -0,0 +1,306 @@
+import heapq
+from typing import Dict, List, Optional, Tuple
+
+import pathing
+import roads
+
+_INFINITY = float("inf")
+
+# Sides of a road, indexing the pair of link lists of each road
+_START = 0
+_END = 1
+
+
+class CompactGraph:
+    """
+    The road graph with every run of roads that only lead into each other
+    merged into a single chain. Two roads are joined where a side of one is
+    linked to nothing but the other, and the other's side back to nothing but
+    it, so a route onto the first road of a chain either carries on along it
+    to the far end or turns straight back. Routes are searched over chain
+    ends instead of roads, then expanded back into roads.
+    Only streets are joined to streets and highways to highways, so each
+    chain can be drawn as one line in one style
+    """
+    def __init__(self, all_roads: List[roads.Segment]):
+        self.roads = list(all_roads)
+        self._index_of = {road: i for i, road in enumerate(self.roads)}
+        self._costs = [pathing.cost(road) for road in self.roads]
+        # The links on the start and end side of each road, by road index
+        self._side_links = [(self._ids(road.links_s), self._ids(road.links_e))
+                            for road in self.roads]
+
+        # Roads of each chain in order, with the side each road is entered by
+        # going from the first road to the last
+        self.chains: List[List[int]] = []
+        self._entry_sides: List[List[int]] = []
+        self.chain_of: List[int] = [-1] * len(self.roads)
+        self.position_of: List[int] = [-1] * len(self.roads)
+        self._build_chains()
+        self._points: List[List[Tuple[float, float]]] = None
+
+        # Cost of each chain's roads up to and including each road
+        self._prefix: List[List[int]] = []
+        for chain in self.chains:
+            total = 0
+            prefix = []
+            for road in chain:
+                total += self._costs[road]
+                prefix.append(total)
+            self._prefix.append(prefix)
+
+        # Chain ends are numbered chain * 2 for the side of the first road,
+        # chain * 2 + 1 for the side of the last. A lone road is left by
+        # either side however it was come onto, so it only has the one end
+        # chain * 2 with the links of both its sides. For each end, the ends
+        # of the chains a route leaving by it can go onto
+        self._entries: List[List[int]] = self._build_entries()
+        # For each end, the ends reachable by going onto each of its entries
+        # and the cost of getting there: along the whole chain, or straight
+        # back off its end road. Turning back is only kept where the roads
+        # at the end don't all link to each other, as otherwise going
+        # straight from one to the other is never longer
+        linked = [set(links_s + links_e) for links_s, links_e in self._side_links]
+        self._steps: List[List[Tuple[int, int, int]]] = []
+        for chain_entries in self._entries:
+            steps = []
+            for entry in chain_entries:
+                chain, side = divmod(entry, 2)
+                chain_roads = self.chains[chain]
+                end_road = chain_roads[0 if side == 0 else -1]
+                if len(chain_roads) == 1:
+                    steps.append((entry, self._costs[end_road], entry))
+                    continue
+                steps.append((entry ^ 1, self._prefix[chain][-1], entry))
+                sides = self._entry_sides[chain]
+                outer = self._side_links[end_road][
+                    sides[0] if side == 0 else 1 - sides[-1]]
+                if any(other not in linked[road] for road in outer
+                       for other in outer if other != road):
+                    steps.append((entry, self._costs[end_road], entry))
+            self._steps.append(steps)
+
+    def __len__(self):
+        return len(self.chains)
+
+    def global_ids(self, chain: int) -> List[int]:
+        """ Gets the ids of the roads in a chain, in order """
+        return [self.roads[road].global_id for road in self.chains[chain]]
+
+    def points(self, chain: int) -> List[Tuple[float, float]]:
+        """
+        Gets the points a chain passes through, from end to end. They are
+        worked out for every chain the first time, as drawing needs them all
+        """
+        if self._points is None:
+            self._points = []
+            for chain_roads, sides in zip(self.chains, self._entry_sides):
+                first = self.roads[chain_roads[0]]
+                chain_points = [first.start if sides[0] == _START else first.end]
+                for road, side in zip(chain_roads, sides):
+                    road = self.roads[road]
+                    chain_points.append(road.end if side == _START else road.start)
+                self._points.append(chain_points)
+        return self._points[chain]
+
+    def route(self, data: pathing.PathData):
+        """
+        Finds the shortest path from data.start to data.end, the same length
+        dijkstra finds. data.searched gets the roads of every chain whose end
+        the search expanded
+        """
+        start = self._index_of[data.start]
+        end = self._index_of[data.end]
+        start_chain, start_pos = self.chain_of[start], self.position_of[start]
+        end_chain, end_pos = self.chain_of[end], self.position_of[end]
+
+        # The end each chain end was reached from and the end it entered its
+        # chain by, None for the ends reached straight from the start road
+        prev: Dict[int, Optional[Tuple[int, int]]] = {}
+        dist: Dict[int, int] = {}
+        open_ends = []
+        last_pos = len(self.chains[start_chain]) - 1
+        for chain_end, first_dist in (
+                (start_chain * 2, self._span(start_chain, 0, start_pos)),
+                (start_chain * 2 + 1,
+                 self._span(start_chain, start_pos, last_pos))):
+            if chain_end % 2 == 0 or last_pos > 0:
+                dist[chain_end] = first_dist
+                prev[chain_end] = None
+                heapq.heappush(open_ends, (first_dist, chain_end))
+
+        best = _INFINITY
+        # The end left by and the end entered by on the last step onto the end
+        # road's chain, None while the best path stays on the start chain
+        best_step = None
+        if start_chain == end_chain:
+            best = self._span(end_chain, start_pos, end_pos)
+
+        closed = set()
+        searched_chains = {}
+        while open_ends:
+            curr_dist, chain_end = heapq.heappop(open_ends)
+            if chain_end in closed:
+                continue
+            if curr_dist >= best:
+                break
+            closed.add(chain_end)
+            searched_chains[chain_end // 2] = None
+
+            for next_end, step_cost, entry in self._steps[chain_end]:
+                if entry >> 1 == end_chain:
+                    length = curr_dist + self._span(
+                        end_chain, 0 if entry % 2 == 0 else
+                        len(self.chains[end_chain]) - 1, end_pos)
+                    if length < best:
+                        best = length
+                        best_step = (chain_end, entry)
+                if next_end in closed:
+                    continue
+                new_dist = curr_dist + step_cost
+                if new_dist < dist.get(next_end, _INFINITY):
+                    dist[next_end] = new_dist
+                    prev[next_end] = (chain_end, entry)
+                    heapq.heappush(open_ends, (new_dist, next_end))
+
+        data.searched = [self.roads[road] for chain in searched_chains
+                         for road in self.chains[chain]]
+        data.path = []
+        data.length = 0
+        if best == _INFINITY:
+            return
+
+        if best_step is None:
+            forward = self._piece(start_chain, start_pos, end_pos)
+        else:
+            chain_end, entry = best_step
+            chain, side = divmod(entry, 2)
+            pieces = [self._piece(chain, 0 if side == 0 else
+                                  len(self.chains[chain]) - 1, end_pos)]
+            while prev[chain_end] is not None:
+                from_end, entry = prev[chain_end]
+                chain, side = divmod(entry, 2)
+                last = len(self.chains[chain]) - 1
+                if chain_end == entry or last == 0:
+                    at = 0 if side == 0 else last
+                    pieces.append(self._piece(chain, at, at))
+                elif side == 0:
+                    pieces.append(self._piece(chain, 0, last))
+                else:
+                    pieces.append(self._piece(chain, last, 0))
+                chain_end = from_end
+            chain = chain_end // 2
+            pieces.append(self._piece(
+                chain, start_pos,
+                0 if chain_end % 2 == 0 else len(self.chains[chain]) - 1))
+            forward = [road for piece in reversed(pieces) for road in piece]
+
+        # Paths run from the end back to the start, like every other search
+        data.path = [self.roads[road] for road in reversed(forward)]
+        data.length = best
+
+    def _ids(self, links) -> List[int]:
+        return sorted(self._index_of[link] for link in links
+                      if link in self._index_of)
+
+    def _partner(self, road: int, side: int,
+                 symmetric: List[bool]) -> Optional[Tuple[int, int]]:
+        """
+        Gets the road and its side that a side of road joins onto in a chain,
+        None if the side isn't joined
+        """
+        links = self._side_links[road][side]
+        if len(links) != 1 or not symmetric[road]:
+            return None
+        other = links[0]
+        if (other == road or not symmetric[other]
+                or self.roads[other].is_highway != self.roads[road].is_highway
+                or other in self._side_links[road][1 - side]):
+            return None
+        other_start, other_end = self._side_links[other]
+        if other_start == [road] and road not in other_end:
+            return other, _START
+        if other_end == [road] and road not in other_start:
+            return other, _END
+        return None
+
+    def _build_chains(self):
+        # Only roads that link back to every road linking to them are joined,
+        # so a route can never come onto a chain part way along it
+        incoming = [set() for _ in self.roads]
+        for road, (links_s, links_e) in enumerate(self._side_links):
+            for link in links_s + links_e:
+                incoming[link].add(road)
+        symmetric = [incoming[road].issubset(links_s + links_e)
+                     for road, (links_s, links_e) in enumerate(self._side_links)]
+        partners = [(self._partner(road, _START, symmetric),
+                     self._partner(road, _END, symmetric))
+                    for road in range(len(self.roads))]
+
+        # Chains are walked from a road with an unjoined side, then whatever
+        # is left are loops with no unjoined sides, walked from any road
+        first_roads = [road for road in range(len(self.roads))
+                       if None in partners[road]]
+        for road in first_roads + list(range(len(self.roads))):
+            if self.chain_of[road] >= 0:
+                continue
+            side = _START if partners[road][_START] is None else _END
+            if partners[road][side] is not None:
+                side = _START
+
+            chain = len(self.chains)
+            chain_roads = []
+            entry_sides = []
+            while road is not None and self.chain_of[road] < 0:
+                self.chain_of[road] = chain
+                self.position_of[road] = len(chain_roads)
+                chain_roads.append(road)
+                entry_sides.append(side)
+                joined = partners[road][1 - side]
+                road, side = joined if joined is not None else (None, None)
+            self.chains.append(chain_roads)
+            self._entry_sides.append(entry_sides)
+
+    def _build_entries(self) -> List[List[int]]:
+        # The chain end at each side of a road, for the roads at chain ends
+        end_at: Dict[Tuple[int, int], int] = {}
+        for chain, chain_roads in enumerate(self.chains):
+            sides = self._entry_sides[chain]
+            end_at[(chain_roads[0], sides[0])] = chain * 2
+            end_at[(chain_roads[-1], 1 - sides[-1])] = chain * 2 + 1
+
+        entries = []
+        for chain, chain_roads in enumerate(self.chains):
+            sides = self._entry_sides[chain]
+            if len(chain_roads) == 1:
+                end_sides = [((chain_roads[0], _START), (chain_roads[0], _END)),
+                             ()]
+            else:
+                end_sides = [((chain_roads[0], sides[0]),),
+                             ((chain_roads[-1], 1 - sides[-1]),)]
+            for road_sides in end_sides:
+                chain_entries = []
+                for road, side in road_sides:
+                    for link in self._side_links[road][side]:
+                        if len(self.chains[self.chain_of[link]]) == 1:
+                            chain_entries.append(self.chain_of[link] * 2)
+                        else:
+                            link_side = (
+                                _START if road in self._side_links[link][_START]
+                                else _END)
+                            chain_entries.append(end_at[(link, link_side)])
+                entries.append(sorted(set(chain_entries)))
+        return entries
+
+    def _span(self, chain: int, first: int, last: int) -> int:
+        """ Gets the cost of the roads between two positions on a chain """
+        low, high = min(first, last), max(first, last)
+        prefix = self._prefix[chain]
+        return prefix[high] - (prefix[low - 1] if low > 0 else 0)
+
+    def _piece(self, chain: int, first: int, last: int) -> List[int]:
+        """ Gets the roads from one position on a chain to another, in order """
+        chain_roads = self.chains[chain]
+        if first <= last:
+            return chain_roads[first:last + 1]
+        return chain_roads[last:first + 1][::-1]
@@ -0,0 +1,108 @@
+import json
+import struct
+from typing import Dict
+
+import numpy
+
+import generation
+import population
+import road_store
+import spatial
+
+# A file starts with the magic bytes and the length of a JSON header that
+# describes every array. The arrays follow, each starting on a multiple of
+# _ALIGNMENT bytes from the start of the data, so they can be used straight
+# from a memory map
+_MAGIC = b"CITYGEN\x01"
+_PREFIX = struct.Struct("<8sQ")
+_ALIGNMENT = 64
+_VERSION = 1
+
+# Arrays of the spatial index are stored under this prefix
+_INDEX_PREFIX = "index_"
+
+
+def save(city: generation.City, path: str):
+    """
+    Writes a city to a file: its roads, their links and parents, its spatial
+    index, and the seeds of the city and of its population heatmap
+    """
+    if isinstance(city.roads, road_store.RoadList) and city.roads.indices is None:
+        store = city.roads.store
+    else:
+        store = road_store.RoadStore.from_segments(city.roads)
+
+    if isinstance(city.sectors, spatial.PackedQuadTree):
+        index_arrays = city.sectors.arrays()
+    else:
+        index_of = {road: i for i, road in enumerate(city.roads)}
+        index_arrays = city.sectors.pack(index_of)
+
+    arrays = dict(store.arrays())
+    for name, array in index_arrays.items():
+        arrays[_INDEX_PREFIX + name] = array
+
+    header = {"version": _VERSION, "seed": city.seed,
+              "pop_seed": list(city.pop.seed), "arrays": {}}
+    offset = 0
+    for name, array in arrays.items():
+        header["arrays"][name] = {"dtype": array.dtype.str,
+                                  "shape": list(array.shape),
+                                  "offset": offset}
+        offset = _aligned(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode()
+
+    with open(path, "wb") as city_file:
+        city_file.write(_PREFIX.pack(_MAGIC, len(header_bytes)))
+        city_file.write(header_bytes)
+        data_start = _aligned(_PREFIX.size + len(header_bytes))
+        for name, array in arrays.items():
+            city_file.seek(data_start + header["arrays"][name]["offset"])
+            city_file.write(numpy.ascontiguousarray(array).tobytes())
+        city_file.truncate(data_start + offset)
+
+
+def load(path: str, memory_map: bool = True) -> generation.City:
+    """
+    Reads a city written by save. The roads are views of a RoadStore and the
+    spatial index is a read-only PackedQuadTree
+    :param memory_map: Maps the file into memory instead of reading it, so
+    only the pages that get used are ever read, and processes opening the
+    same file share them
+    """
+    with open(path, "rb") as city_file:
+        magic, header_length = _PREFIX.unpack(city_file.read(_PREFIX.size))
+        if magic != _MAGIC:
+            raise ValueError("{} is not a city file".format(path))
+        header = json.loads(city_file.read(header_length).decode())
+    if header["version"] != _VERSION:
+        raise ValueError("{} has unsupported version {}".format(
+            path, header["version"]))
+
+    if memory_map:
+        data = numpy.memmap(path, dtype=numpy.uint8, mode="r")
+    else:
+        data = numpy.fromfile(path, dtype=numpy.uint8)
+    data_start = _aligned(_PREFIX.size + header_length)
+
+    arrays: Dict[str, numpy.ndarray] = {}
+    for name, layout in header["arrays"].items():
+        dtype = numpy.dtype(layout["dtype"])
+        count = int(numpy.prod(layout["shape"]))
+        start = data_start + layout["offset"]
+        arrays[name] = (data[start:start + count * dtype.itemsize]
+                        .view(dtype).reshape(layout["shape"]))
+
+    index_arrays = {name[len(_INDEX_PREFIX):]: arrays.pop(name)
+                    for name in list(arrays) if name.startswith(_INDEX_PREFIX)}
+    store = road_store.RoadStore(**arrays)
+    city_roads = road_store.RoadList(store)
+    index = spatial.PackedQuadTree(city_roads, store.coords, **index_arrays)
+
+    return generation.City(city_roads, index,
+                           population.Heatmap(tuple(header["pop_seed"])),
+                           header["seed"])
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
@@ -1,17 +1,22 @@
 import math
+import sys
 from typing import List, Tuple, Optional
 
 import pygame
 
+import landmarks
 import pathing
 import population
 import roads
 import sectors
+import spatial
+import tiles
 import vectors
 import config
 import debug
 import generation
 import build_gen
+import city_file
 import drawing
 import collections
 from Stopwatch import Stopwatch
@@ -43,7 +48,7 @@ Selection = collections.namedtuple(
     "Selection", "road, connections, start_ids, end_ids, selected_sectors")
 
 
-def main():
+def main(city_path: str = None):
     pygame.init()
     drawing.init()
 
@@ -51,15 +56,30 @@ def main():
         pygame.display.set_mode(config.SCREEN_RES, pygame.RESIZABLE), (0, 0))
     input_data = InputData()
     path_data = pathing.PathData()
+    heatmap_cache = drawing.HeatmapCache()
+    road_tile_cache = drawing.RoadTileCache()
     selection = None
 
     lots = []
-
-    city = generation.generate()
-    city_labels = []
-    for road in city.roads:
-        city_labels.append((str(road.global_id),
-                            road.point_at(0.5)))
+    # Lots are only found again once the roads have changed
+    lot_cache = build_gen.LotCache()
+
+    # The city still being generated, if there is one, whose city is city.
+    # It is grown a little every frame until it has generate_target roads
+    generator = None
+    generate_target = config.MAX_SEGS
+    if city_path is not None:
+        city = city_file.load(city_path)
+    else:
+        generator = generation.Generator()
+        city = generator.city
+    # The endless world being explored, if there is one, whose city is city
+    world = None
+    path_graph = pathing.Graph()
+    # Built the first time the landmark search is used on a city
+    path_landmarks = None
+    # Clears itself whenever the roads change
+    route_cache = pathing.RouteCache()
 
     prev_time = pygame.time.get_ticks()
 
@@ -82,15 +102,37 @@ def main():
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_g:
                     debug.SHOW_ROAD_ORDER = False
-                    city_labels = []
                     selection = None
                     path_data = pathing.PathData()
-                    city = generation.generate()
-                    for road in city.roads:
-                        city_labels.append((str(road.global_id),
-                                            road.point_at(0.5)))
+                    generator = generation.Generator()
+                    generate_target = config.MAX_SEGS
+                    city = generator.city
+                    world = None
+                    path_graph = pathing.Graph()
+                    path_landmarks = None
+                elif event.key == pygame.K_e:
+                    # Start an endless world from the seed of the city,
+                    # tiles are generated as they come into view
+                    debug.SHOW_ROAD_ORDER = False
+                    selection = None
+                    lots = []
+                    path_data = pathing.PathData()
+                    world = tiles.World(city.seed if city.seed is not None
+                                        else config.ROAD_SEED)
+                    city = world.city
+                    generator = None
+                    path_graph = pathing.Graph()
+                    path_landmarks = None
+                elif event.key == pygame.K_m:
+                    # Keep growing the city past where it stopped
+                    if generator is not None:
+                        generate_target = (max(generate_target,
+                                               len(city.roads))
+                                           + config.MAX_SEGS)
+                        path_graph = pathing.Graph()
+                        path_landmarks = None
                 if event.key == pygame.K_b:
-                    lots = build_gen.gen_lots(city)
+                    lots = lot_cache.lots(city)
                 # Pathing
                 elif event.key == pygame.K_z:
                     path_data.start = road_near_point(input_data.pos,
@@ -99,9 +141,14 @@ def main():
                     path_data.end = road_near_point(input_data.pos,
                                                     screen_data, city)
                 elif event.key == pygame.K_c:
-                    pathing.astar(path_data, city.roads)
+                    pathing.astar(path_data, city.roads, path_graph)
                 elif event.key == pygame.K_v:
-                    pathing.dijkstra(path_data, city.roads)
+                    route_cache.route(path_data)
+                elif event.key == pygame.K_n:
+                    if path_landmarks is None:
+                        path_landmarks = landmarks.Landmarks.build(
+                            city.roads, graph=path_graph)
+                    path_landmarks.route(path_data)
                 # Debug Views
                 else:
                     handle_keys_debug(event.key)
@@ -132,10 +179,33 @@ def main():
                 input_data.drag_start = input_data.pos
                 input_data.drag_prev_pos = input_data.pos
 
+        # Generate a little more of the city every frame, rather than
+        # freezing until it is done
+        if (generator is not None and len(city.roads) <= generate_target
+                and not generator.is_done()):
+            if generator.run_for(config.GENERATION_FRAME_TIME,
+                                 generate_target):
+                path_graph = pathing.Graph()
+                path_landmarks = None
+
+        # Grow the endless world into any tiles that came into view, one per
+        # frame so that panning stays smooth
+        if world is not None:
+            new_roads = world.ensure(
+                drawing.screen_to_world((0, 0), screen_data.pan,
+                                        screen_data.zoom),
+                drawing.screen_to_world(config.SCREEN_RES, screen_data.pan,
+                                        screen_data.zoom),
+                1)
+            if new_roads:
+                path_graph = pathing.Graph()
+                path_landmarks = None
+
         # Drawing
         screen_data.screen.fill((0, 0, 0))
         if debug.SHOW_HEATMAP:
-            drawing.draw_heatmap(50, city, screen_data)
+            drawing.draw_heatmap(config.HEATMAP_CELL_SIZE, city,
+                                 screen_data, heatmap_cache)
         if debug.SHOW_SECTORS:
             drawing.draw_sectors(screen_data)
 
@@ -154,26 +224,22 @@ def main():
 
         # Draw roads
         if debug.SHOW_ISOLATE_SECTOR and selection is not None:
-            for sector in sectors.from_seg(selection.road):
-                drawing.draw_all_roads(city.sectors[sector], screen_data)
+            drawing.draw_all_roads(
+                city.sectors.near_seg(selection.road, spatial.snap_distance()),
+                screen_data)
         elif debug.SHOW_MOUSE_SECTOR:
             mouse_sec = sectors.containing_sector(
                 drawing.screen_to_world(input_data.pos,
                                         screen_data.pan, screen_data.zoom))
-            if mouse_sec in city.sectors:
-                drawing.draw_all_roads(city.sectors[mouse_sec], screen_data)
+            drawing.draw_all_roads(
+                city.sectors.query_box(
+                    (mouse_sec[0] * config.SECTOR_SIZE,
+                     mouse_sec[1] * config.SECTOR_SIZE),
+                    ((mouse_sec[0] + 1) * config.SECTOR_SIZE,
+                     (mouse_sec[1] + 1) * config.SECTOR_SIZE)),
+                screen_data)
         else:
-            tl_sect = sectors.containing_sector(
-                drawing.screen_to_world((0, 0),
-                                        screen_data.pan, screen_data.zoom))
-            br_sect = sectors.containing_sector(
-                drawing.screen_to_world(config.SCREEN_RES,
-                                        screen_data.pan, screen_data.zoom))
-            for x in range(tl_sect[0], br_sect[0] + 1):
-                for y in range(tl_sect[1], br_sect[1] + 1):
-                    if (x, y) in city.sectors:
-                        drawing.draw_all_roads(city.sectors[(x, y)],
-                                               screen_data)
+            drawing.draw_roads_tiled(city, screen_data, road_tile_cache)
 
         drawing.draw_roads_selected(selection, screen_data)
         drawing.draw_roads_path(path_data, screen_data)
@@ -193,8 +259,7 @@ def main():
                                           screen_data, -1)
 
         if debug.SHOW_ROAD_ORDER:
-            for label in city_labels:
-                drawing.draw_label_world(label, screen_data, 1)
+            drawing.draw_road_labels(city, screen_data)
 
         pygame.display.flip()
 
@@ -236,16 +301,13 @@ def road_near_point(screen_pos: Tuple[float, float],
                                         screen_data.zoom)
     closest: Tuple[roads.Segment, float] = (None, 9999)
     found_road = None
-    examine_sectors = sectors.from_point(world_pos, 100)
 
-    for sector in examine_sectors:
-        if sector in city.sectors:
-            for road in city.sectors[sector]:
-                dist = vectors.distance(world_pos, road.point_at(0.5))
-                if dist < closest[1]:
-                    closest = (road, dist)
-            if closest[1] < 100:
-                found_road = closest[0]
+    for road in city.sectors.query_radius(world_pos, 100):
+        dist = vectors.distance(world_pos, road.point_at(0.5))
+        if dist < closest[1]:
+            closest = (road, dist)
+    if closest[1] < 100:
+        found_road = closest[0]
 
     return found_road
 
@@ -270,4 +332,4 @@ def selection_from_road(selected_road):
 
 
 if __name__ == "__main__":
-    main()
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -1,16 +1,48 @@
 ROAD_SEED = 0
 MAX_SEGS = 1000
+# "bucket" places roads with the same t in the order they were queued,
+# "heap" in the order older versions did, to get the same cities from their
+# seeds when the rest of the config is the same, ROAD_RANDOM included. "heap"
+# also only snaps to the roads older versions found in the sectors, which
+# miss roads crossing a sector when SECTOR_SIZE is shorter than a road
+ROAD_QUEUE = "bucket"
+# "sequential" draws random numbers from one running state, so every draw
+# depends on all the roads placed before it. "counter" works each draw out from
+# the seed and the road it is for, see streams.SegmentRandom
+ROAD_RANDOM = "sequential"
+# Seconds the viewer spends generating roads each frame
+GENERATION_FRAME_TIME = 0.02
 SCREEN_RES = (1920, 1080)
 HIGHWAY_LENGTH = 400
 STREET_LENGTH = 300
 
 PATH_HIGHWAY_WEIGHT = 0.75
+# Landmark roads the ALT search precomputes path lengths from
+PATH_LANDMARKS = 8
+# Recent routes and per start road search trees kept by pathing.RouteCache
+ROUTE_CACHE_ROUTES = 256
+ROUTE_CACHE_TREES = 8
 
 MIN_DIST_EDGE_CROSS = 350
 MIN_DIST_EDGE_CONTAINED = 50
 
 SECTOR_SIZE = 550
 
+# Endless worlds are generated in square tiles of this size, each capped at
+# TILE_MAX_SEGS roads and joined to its neighbors by 1 to TILE_PORTALS
+# highways across each edge
+TILE_SIZE = SECTOR_SIZE * 8
+TILE_MAX_SEGS = 800
+TILE_PORTALS = 2
+
+# regions.generate places the roads of square regions this many sectors a
+# side in separate processes, in rounds covering this many values of t
+REGION_SECTORS = 6
+REGION_ROUND_TIME = 8
+
+QUADTREE_CAPACITY = 16
+QUADTREE_MIN_SIZE = 128
+
 HIGHWAY_BRANCH_POP = 0.1
 HIGHWAY_BRANCH_CHANCE = 0.1
 STREET_BRANCH_POP = 0.45
@@ -20,6 +52,9 @@ STREET_EXTEND_POP = 0.4
 SNAP_VERTEX_RADIUS = 50
 SNAP_EXTEND_RADIUS = 50
 
+# Fewer candidate roads than this are checked for snaps one at a time
+NARROW_PHASE_MIN_BATCH = 24
+
 MIN_ANGLE_DIFF = 30
 
 HIGHWAY_MAX_ANGLE_DEV = 15
@@ -30,4 +65,19 @@ ROAD_WIDTH_HIGHWAY = 2
 ROAD_WIDTH_SELECTION = 4
 ROAD_WIDTH_PATH = 3
 
-ZOOM_GRANULARITY = 30
\ No newline at end of file
+ZOOM_GRANULARITY = 30
+
+# Roads are drawn into cached tiles of at most this many pixels across, each
+# covering a sector or a square of sectors. Zoomed in so far that a sector is
+# more than twice this, roads are drawn straight to the screen instead
+ROAD_TILE_SIZE = 512
+# Most road tiles kept, least recently drawn dropped first
+ROAD_TILE_CACHE_TILES = 80
+
+# Road id labels are kept at least this many pixels apart, the rest are hidden
+LABEL_SPACING = 40
+# Most rendered text surfaces kept for labels, least recently drawn dropped
+# first
+TEXT_CACHE_SIZE = 4096
+
+HEATMAP_CELL_SIZE = 20
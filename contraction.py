@@ -0,0 +1,365 @@
+import heapq
+import itertools
+from typing import Dict, List, Optional, Tuple
+
+import numpy
+
+import pathing
+import roads
+
+# Witness searches give up after settling this many roads, adding a shortcut
+# that may not be needed rather than searching further
+_WITNESS_SETTLE_LIMIT = 60
+
+_INFINITY = float("inf")
+
+
+class ContractionHierarchy:
+    """
+    A contraction hierarchy over the roads of a city, for answering many
+    shortest path queries on the same city. Roads are ranked and contracted
+    one at a time, adding shortcut edges wherever a shortest path went
+    through the contracted road, so a query only ever has to search upwards
+    in rank from both ends.
+    Edges are stored CSR-style by road index: up edges go from a road to the
+    higher ranked roads it leads to, down edges from the higher ranked roads
+    that lead to it. A shortcut's middle is the road it skips, -1 for an
+    original link
+    """
+    def __init__(self, global_ids: numpy.ndarray, ranks: numpy.ndarray,
+                 costs: numpy.ndarray,
+                 up_offsets: numpy.ndarray, up_targets: numpy.ndarray,
+                 up_weights: numpy.ndarray, up_middles: numpy.ndarray,
+                 down_offsets: numpy.ndarray, down_sources: numpy.ndarray,
+                 down_weights: numpy.ndarray, down_middles: numpy.ndarray):
+        self.global_ids = global_ids
+        self.ranks = ranks
+        self.costs = costs
+        self.up_offsets = up_offsets
+        self.up_targets = up_targets
+        self.up_weights = up_weights
+        self.up_middles = up_middles
+        self.down_offsets = down_offsets
+        self.down_sources = down_sources
+        self.down_weights = down_weights
+        self.down_middles = down_middles
+
+        self._roads: List[roads.Segment] = []
+        self._index_of: Dict[roads.Segment, int] = {}
+        # Python lists of the edges, which are much faster to search than
+        # indexing into the arrays one element at a time
+        self._up = _edge_lists(up_offsets, up_targets, up_weights, up_middles)
+        self._down = _edge_lists(down_offsets, down_sources, down_weights,
+                                 down_middles)
+
+    @classmethod
+    def build(cls, all_roads: List[roads.Segment],
+              graph: Optional[pathing.Graph] = None) -> 'ContractionHierarchy':
+        """ Preprocesses the roads of a city into a hierarchy """
+        adjacency = pathing.indexed_adjacency(all_roads, graph)
+        count = len(all_roads)
+
+        out_edges: List[Dict[int, int]] = [{} for _ in range(count)]
+        in_edges: List[Dict[int, int]] = [{} for _ in range(count)]
+        for source, neighbors in enumerate(adjacency):
+            for target, weight in neighbors:
+                if target != source:
+                    out_edges[source][target] = weight
+                    in_edges[target][source] = weight
+        middles: Dict[Tuple[int, int], int] = {}
+
+        ranks = numpy.zeros(count, dtype=numpy.int32)
+        deleted_neighbors = [0] * count
+        up: List[List[Tuple[int, int, int]]] = [[] for _ in range(count)]
+        down: List[List[Tuple[int, int, int]]] = [[] for _ in range(count)]
+
+        def priority(road: int, shortcuts: list) -> int:
+            return (len(shortcuts) - len(in_edges[road]) - len(out_edges[road])
+                    + deleted_neighbors[road])
+
+        queue = [(priority(road, _shortcuts(road, out_edges, in_edges)), road)
+                 for road in range(count)]
+        heapq.heapify(queue)
+
+        rank = 0
+        while queue:
+            road = heapq.heappop(queue)[1]
+
+            # Priorities go stale as neighbors are contracted, so check it is
+            # still the best choice before contracting it
+            shortcuts = _shortcuts(road, out_edges, in_edges)
+            new_priority = priority(road, shortcuts)
+            if queue and new_priority > queue[0][0]:
+                heapq.heappush(queue, (new_priority, road))
+                continue
+
+            for source, target, weight in shortcuts:
+                if weight < out_edges[source].get(target, _INFINITY):
+                    out_edges[source][target] = weight
+                    in_edges[target][source] = weight
+                    middles[(source, target)] = road
+
+            # Everything still connected to the road is ranked above it
+            for target, weight in out_edges[road].items():
+                up[road].append((target, weight,
+                                 middles.get((road, target), -1)))
+                del in_edges[target][road]
+                deleted_neighbors[target] += 1
+            for source, weight in in_edges[road].items():
+                down[road].append((source, weight,
+                                   middles.get((source, road), -1)))
+                del out_edges[source][road]
+                deleted_neighbors[source] += 1
+            out_edges[road] = {}
+            in_edges[road] = {}
+
+            ranks[road] = rank
+            rank += 1
+
+        global_ids = numpy.array([road.global_id for road in all_roads],
+                                 dtype=numpy.int64)
+        costs = numpy.array([pathing.cost(road) for road in all_roads],
+                            dtype=numpy.int64)
+        hierarchy = cls(global_ids, ranks, costs, *_to_csr(up), *_to_csr(down))
+        hierarchy.attach(all_roads)
+
+        return hierarchy
+
+    def arrays(self) -> Dict[str, numpy.ndarray]:
+        return {"global_ids": self.global_ids, "ranks": self.ranks,
+                "costs": self.costs,
+                "up_offsets": self.up_offsets, "up_targets": self.up_targets,
+                "up_weights": self.up_weights, "up_middles": self.up_middles,
+                "down_offsets": self.down_offsets,
+                "down_sources": self.down_sources,
+                "down_weights": self.down_weights,
+                "down_middles": self.down_middles}
+
+    def save(self, path: str):
+        """ Writes the hierarchy to a .npz file """
+        numpy.savez(path, **self.arrays())
+
+    @classmethod
+    def load(cls, path: str,
+             all_roads: List[roads.Segment]) -> 'ContractionHierarchy':
+        """ Reads a hierarchy saved for the given roads """
+        with numpy.load(path) as arrays:
+            hierarchy = cls(**{name: arrays[name] for name in arrays.files})
+        hierarchy.attach(all_roads)
+
+        return hierarchy
+
+    def attach(self, all_roads: List[roads.Segment]):
+        """ Sets the roads that the indices of the hierarchy refer to """
+        if len(all_roads) != len(self.global_ids) or any(
+                road.global_id != global_id for road, global_id
+                in zip(all_roads, self.global_ids.tolist())):
+            raise ValueError("The hierarchy was built for different roads")
+
+        self._roads = list(all_roads)
+        self._index_of = {road: i for i, road in enumerate(self._roads)}
+
+    def route(self, data: pathing.PathData):
+        """
+        Finds the shortest path from data.start to data.end, giving the same
+        length as pathing.dijkstra
+        """
+        start = self._index_of[data.start]
+        end = self._index_of[data.end]
+
+        forward = _Search(start, True)
+        backward = _Search(end, False)
+        best = _INFINITY
+        meeting = -1
+
+        # Each direction only has to continue while it could still find
+        # something shorter than the best path found so far
+        while True:
+            forward_key = forward.top_key()
+            backward_key = backward.top_key()
+            if min(forward_key, backward_key) >= best:
+                break
+
+            if forward_key <= backward_key:
+                search, other, edges = forward, backward, self._up
+            else:
+                search, other, edges = backward, forward, self._down
+
+            road = search.settle()
+            if road is None:
+                continue
+            if road in other.dist:
+                through = search.dist[road] + other.dist[road]
+                if through < best:
+                    best = through
+                    meeting = road
+            search.relax(road, edges[road])
+
+        data.searched = [self._roads[road] for road
+                         in itertools.chain(forward.order, backward.order)]
+        data.path = []
+        data.length = 0
+        if meeting < 0:
+            return
+
+        # Forward edges lead from the start to the meeting road, backward
+        # edges from the meeting road to the end
+        edges = list(reversed(forward.edges_from(meeting)))
+        edges += backward.edges_from(meeting)
+
+        path = [start]
+        for source, target, middle in edges:
+            path += self._unpack(source, target, middle)[1:]
+
+        data.path = [self._roads[road] for road in reversed(path)]
+        data.length = int(sum(self.costs[path]))
+
+    def _unpack(self, source: int, target: int, middle: int) -> List[int]:
+        """ Expands an edge into the roads it stands for, ends included """
+        if middle < 0:
+            return [source, target]
+        first = self._unpack(source, middle, self._middle(source, middle))
+        second = self._unpack(middle, target, self._middle(middle, target))
+        return first + second[1:]
+
+    def _middle(self, source: int, target: int) -> int:
+        """ Gets the middle of the edge from source to target """
+        if self.ranks[source] < self.ranks[target]:
+            edges = self._up[source]
+            other = target
+        else:
+            edges = self._down[target]
+            other = source
+        for neighbor, _, middle in edges:
+            if neighbor == other:
+                return middle
+        raise KeyError("No edge from {} to {}".format(source, target))
+
+
+class _Search:
+    """ One direction of a bidirectional search through a hierarchy """
+    def __init__(self, origin: int, is_forward: bool):
+        self.is_forward = is_forward
+        self.dist = {origin: 0}
+        # The road each road was reached from and the middle of that edge
+        self.prev: Dict[int, Tuple[int, int]] = {origin: (-1, -1)}
+        self.settled = set()
+        self.order: List[int] = []
+        self.heap = [(0, origin)]
+
+    def top_key(self) -> float:
+        while self.heap and self.heap[0][1] in self.settled:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else _INFINITY
+
+    def settle(self) -> Optional[int]:
+        dist, road = heapq.heappop(self.heap)
+        if road in self.settled:
+            return None
+        self.settled.add(road)
+        self.order.append(road)
+        return road
+
+    def relax(self, road: int, edges: List[Tuple[int, int, int]]):
+        dist = self.dist[road]
+        for neighbor, weight, middle in edges:
+            new_dist = dist + weight
+            if new_dist < self.dist.get(neighbor, _INFINITY):
+                self.dist[neighbor] = new_dist
+                self.prev[neighbor] = (road, middle)
+                heapq.heappush(self.heap, (new_dist, neighbor))
+
+    def edges_from(self, road: int) -> List[Tuple[int, int, int]]:
+        """
+        Gets the edges the search took between the origin and road, starting
+        at road. Each is given in the direction of the road network as
+        (source, target, middle)
+        """
+        edges = []
+        previous, middle = self.prev[road]
+        while previous >= 0:
+            if self.is_forward:
+                edges.append((previous, road, middle))
+            else:
+                edges.append((road, previous, middle))
+            road = previous
+            previous, middle = self.prev[road]
+        return edges
+
+
+def _shortcuts(road: int, out_edges: List[Dict[int, int]],
+               in_edges: List[Dict[int, int]]) -> List[Tuple[int, int, int]]:
+    """
+    Gets the shortcuts (source, target, weight) that contracting road would
+    need, one for every path through it with no other path as short
+    """
+    shortcuts = []
+    outgoing = out_edges[road]
+
+    for source, in_weight in in_edges[road].items():
+        targets = {target: in_weight + out_weight
+                   for target, out_weight in outgoing.items()
+                   if target != source}
+        if not targets:
+            continue
+
+        witness = _witness_search(source, road, max(targets.values()),
+                                  targets, out_edges)
+        for target, weight in targets.items():
+            if witness.get(target, _INFINITY) > weight:
+                shortcuts.append((source, target, weight))
+
+    return shortcuts
+
+
+def _witness_search(source: int, avoid: int, limit: int,
+                    targets: Dict[int, int],
+                    out_edges: List[Dict[int, int]]) -> Dict[int, int]:
+    """
+    Finds the distances from source to the targets without going through
+    avoid, giving up on anything longer than limit
+    """
+    dist = {source: 0}
+    heap = [(0, source)]
+    settled = set()
+    remaining = len(targets)
+
+    while heap and len(settled) < _WITNESS_SETTLE_LIMIT:
+        road_dist, road = heapq.heappop(heap)
+        if road in settled:
+            continue
+        if road_dist > limit:
+            break
+        settled.add(road)
+        if road in targets:
+            remaining -= 1
+            if remaining == 0:
+                break
+
+        for neighbor, weight in out_edges[road].items():
+            if neighbor == avoid:
+                continue
+            new_dist = road_dist + weight
+            if new_dist < dist.get(neighbor, _INFINITY):
+                dist[neighbor] = new_dist
+                heapq.heappush(heap, (new_dist, neighbor))
+
+    return dist
+
+
+def _to_csr(edges: List[List[Tuple[int, int, int]]]) -> tuple:
+    offsets = numpy.zeros(len(edges) + 1, dtype=numpy.int64)
+    offsets[1:] = numpy.cumsum([len(road_edges) for road_edges in edges])
+    flat = [edge for road_edges in edges for edge in road_edges]
+    flat = numpy.array(flat, dtype=numpy.int64).reshape(-1, 3)
+
+    return offsets, flat[:, 0].copy(), flat[:, 1].copy(), flat[:, 2].copy()
+
+
+def _edge_lists(offsets: numpy.ndarray, neighbors: numpy.ndarray,
+                weights: numpy.ndarray,
+                middles: numpy.ndarray) -> List[List[Tuple[int, int, int]]]:
+    edges = list(zip(neighbors.tolist(), weights.tolist(), middles.tolist()))
+    offsets = offsets.tolist()
+
+    return [edges[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
@@ -37,9 +37,12 @@ def labels(screen_data, input_data, path_data, selection, city):
         debug_labels_left.append("    has_snapped: {}".format(str(selection.road.has_snapped)))
         debug_labels_left.append("    sectors: {}".format(str(selection.selected_sectors)))
         debug_labels_left.append("    length: {}".format(selection.road.length()))
+        debug_labels_left.append("    pop: {}".format(
+            city.pop.at_lines([selection.road.start], [selection.road.end])[0]))
     else:
         debug_labels_left.append("Selected: None")
     debug_labels_left.append("Path Length: {}".format(path_data.length))
+    debug_labels_left.append("    searched: {}".format(len(path_data.searched)))
 
     debug_labels_right.append("Seed: {}".format(str(config.ROAD_SEED)))
 
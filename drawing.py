@@ -4,11 +4,14 @@ import pathing
 from SnapType import SnapType
 import pygame
 import math
+import numpy
 import population
 import vectors
 import generation
 import roads
-from typing import Tuple, List
+import chains
+import collections
+from typing import Tuple, List, Optional
 
 
 class ScreenData:
@@ -44,6 +47,11 @@ class ScreenData:
         return
 
 
+# Recently rendered text by text and color, least recently used first
+_text_surfaces: 'collections.OrderedDict[Tuple[str, Tuple[int, int, int]], pygame.Surface]' = \
+    collections.OrderedDict()
+
+
 def init():
     global font
     font = pygame.font.SysFont("gohufont, terminusttf, couriernew", 14)
@@ -65,33 +73,186 @@ def screen_to_world(screen_pos: tuple, pan: tuple, zoom: float) -> Tuple[float,
     return result
 
 
+def road_style(road: roads.Segment) -> Tuple[Tuple[int, int, int], int]:
+    """ Gets the color and width a road is drawn with in the current view """
+    width = config.ROAD_WIDTH
+    color = (255, 255, 255)
+
+    if road.is_highway:
+        width = config.ROAD_WIDTH_HIGHWAY
+        color = (255, 0, 0)
+    elif debug.SHOW_ROAD_VIEW == debug.RoadViews.Snaps:
+        if road.has_snapped == SnapType.Cross:
+            color = (255, 100, 100)
+        elif road.has_snapped == SnapType.End:
+            color = (100, 255, 100)
+        elif road.has_snapped == SnapType.Extend:
+            color = (100, 100, 255)
+        elif road.has_snapped == SnapType.CrossTooClose:
+            color = (100, 255, 255)
+    elif debug.SHOW_ROAD_VIEW == debug.RoadViews.Branches:
+        if road.is_branch:
+            color = (100, 255, 100)
+    if road.has_snapped == SnapType.DebugDeleted:
+        color = (0, 255, 0)
+
+    return color, width
+
+
 def draw_all_roads(all_roads: List[roads.Segment], data: ScreenData):
     """ Draws the roads in all_roads to the surface in data"""
     for road in all_roads:
-        width = config.ROAD_WIDTH
-        color = (255, 255, 255)
-
-        if road.is_highway:
-            width = config.ROAD_WIDTH_HIGHWAY
-            color = (255, 0, 0)
-        elif debug.SHOW_ROAD_VIEW == debug.RoadViews.Snaps:
-            if road.has_snapped == SnapType.Cross:
-                color = (255, 100, 100)
-            elif road.has_snapped == SnapType.End:
-                color = (100, 255, 100)
-            elif road.has_snapped == SnapType.Extend:
-                color = (100, 100, 255)
-            elif road.has_snapped == SnapType.CrossTooClose:
-                color = (100, 255, 255)
-        elif debug.SHOW_ROAD_VIEW == debug.RoadViews.Branches:
-            if road.is_branch:
-                color = (100, 255, 100)
-        if road.has_snapped == SnapType.DebugDeleted:
-            color = (0, 255, 0)
-
+        color, width = road_style(road)
         draw_road(road, color, width, data)
 
 
+def draw_chain(points: List[Tuple[float, float]], color: Tuple[int, int, int],
+               width: int, data: ScreenData):
+    """ Draws a chain of roads through the given points as one line """
+    pan_x, pan_y = data.pan
+    zoom = data.zoom
+    pygame.draw.lines(data.screen, color, False,
+                      [(x * zoom + pan_x, y * zoom + pan_y) for x, y in points],
+                      width)
+
+
+def draw_chains(compact: 'chains.CompactGraph', data: ScreenData):
+    """
+    Draws every road of a compacted graph, a chain at a time in the style of
+    its first road. Chains only join roads of the same kind, so this matches
+    draw_all_roads unless a debug view is colouring roads individually
+    """
+    for chain, chain_roads in enumerate(compact.chains):
+        color, width = road_style(compact.roads[chain_roads[0]])
+        draw_chain(compact.points(chain), color, width, data)
+
+
+class RoadTileCache:
+    """
+    Roads drawn into square tiles, so that a frame only has to blit the
+    tiles on screen rather than draw every road on it. Each tile covers
+    a sector, or a square of sectors when zoomed out, sized to be
+    config.ROAD_TILE_SIZE pixels across or less. Tiles are kept for each
+    zoom, and only the ones under roads that have changed are redrawn
+    """
+    def __init__(self, max_tiles: int = None):
+        self.max_tiles = (max_tiles if max_tiles is not None
+                          else config.ROAD_TILE_CACHE_TILES)
+        self.sectors = None
+        self.road_view = None
+        # Surface of each tile by zoom, level and tile, in the order they
+        # were last drawn
+        self.tiles: 'collections.OrderedDict[Tuple[float, int, int, int], pygame.Surface]' = \
+            collections.OrderedDict()
+
+    @staticmethod
+    def level_at(zoom: float) -> Optional[int]:
+        """
+        Gets how many times the sides of a sector are doubled to make a tile
+        at a zoom, None if zoomed in too far to use tiles
+        """
+        sector_pixels = config.SECTOR_SIZE * zoom
+        if sector_pixels > config.ROAD_TILE_SIZE * 2:
+            return None
+        return max(0, math.floor(math.log2(config.ROAD_TILE_SIZE
+                                           / sector_pixels)))
+
+    def update(self, sectors):
+        """ Drops the tiles that no longer show the roads in sectors """
+        changed = sectors.take_changed()
+        if (sectors is not self.sectors or changed is None
+                or debug.SHOW_ROAD_VIEW != self.road_view):
+            self.sectors = sectors
+            self.road_view = debug.SHOW_ROAD_VIEW
+            self.tiles.clear()
+            return
+        if not changed or not self.tiles:
+            return
+
+        levels = {key[:2] for key in self.tiles}
+        for zoom, level in levels:
+            size = config.SECTOR_SIZE * 2 ** level
+            margin = _road_margin(zoom)
+            for x0, y0, x1, y1 in changed:
+                for i in range(math.floor((x0 - margin) / size),
+                               math.floor((x1 + margin) / size) + 1):
+                    for j in range(math.floor((y0 - margin) / size),
+                                   math.floor((y1 + margin) / size) + 1):
+                        self.tiles.pop((zoom, level, i, j), None)
+
+    def tile(self, zoom: float, level: int, i: int, j: int) -> pygame.Surface:
+        """ Gets a tile, drawing it if it isn't cached """
+        key = (zoom, level, i, j)
+        surface = self.tiles.get(key)
+        if surface is not None:
+            self.tiles.move_to_end(key)
+            return surface
+
+        size = config.SECTOR_SIZE * 2 ** level
+        left, top = _tile_origin(zoom, size, i, j)
+        right, bottom = _tile_origin(zoom, size, i + 1, j + 1)
+        surface = pygame.Surface((right - left, bottom - top))
+        surface.set_colorkey((0, 0, 0))
+
+        margin = _road_margin(zoom)
+        for road in self.sectors.query_box(
+                (i * size - margin, j * size - margin),
+                ((i + 1) * size + margin, (j + 1) * size + margin)):
+            color, width = road_style(road)
+            pygame.draw.line(surface, color,
+                             (road.start[0] * zoom - left,
+                              road.start[1] * zoom - top),
+                             (road.end[0] * zoom - left,
+                              road.end[1] * zoom - top), width)
+
+        self.tiles[key] = surface
+        while len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+        return surface
+
+
+def draw_roads_tiled(city: generation.City, data: ScreenData,
+                     cache: RoadTileCache):
+    """
+    Draws the roads on screen from the tiles in cache, or straight to the
+    screen when zoomed in too far for tiles
+    """
+    cache.update(city.sectors)
+    top_left = screen_to_world((0, 0), data.pan, data.zoom)
+    bottom_right = screen_to_world(config.SCREEN_RES, data.pan, data.zoom)
+
+    level = cache.level_at(data.zoom)
+    if level is None:
+        draw_all_roads(city.sectors.query_box(top_left, bottom_right), data)
+        return
+
+    size = config.SECTOR_SIZE * 2 ** level
+    pan = (round(data.pan[0]), round(data.pan[1]))
+    for i in range(math.floor(top_left[0] / size),
+                   math.floor(bottom_right[0] / size) + 1):
+        for j in range(math.floor(top_left[1] / size),
+                       math.floor(bottom_right[1] / size) + 1):
+            left, top = _tile_origin(data.zoom, size, i, j)
+            data.screen.blit(cache.tile(data.zoom, level, i, j),
+                             (left + pan[0], top + pan[1]))
+
+
+def _tile_origin(zoom: float, size: float, i: int, j: int) -> Tuple[int, int]:
+    """
+    Gets the pixel a tile starts at, with no pan. Neighboring tiles start
+    where the last one ended, so no gaps open up between them
+    """
+    return math.floor(i * size * zoom), math.floor(j * size * zoom)
+
+
+def _road_margin(zoom: float) -> float:
+    """
+    Gets how far outside a tile a road can be and still have some of its
+    width drawn on the tile
+    """
+    return (max(config.ROAD_WIDTH, config.ROAD_WIDTH_HIGHWAY) + 1) / zoom
+
+
 def draw_roads_selected(selection: 'debug.Selection', data: ScreenData):
     if selection is not None:
         draw_road(selection[0], (255, 255, 0), config.ROAD_WIDTH_SELECTION, data)
@@ -125,6 +286,45 @@ def draw_road(road: roads.Segment, color: Tuple[int, int, int], width: int, data
     pygame.draw.line(data.screen, color, world_to_screen(road.start, data.pan, data.zoom), world_to_screen(road.end, data.pan, data.zoom), width)
 
 
+def render_text(text: str, color: Tuple[int, int, int] = (255, 255, 255)) -> pygame.Surface:
+    """
+    Gets text rendered in the label font, reusing the surface from the last
+    time the same text was rendered in the same color if it is still cached
+    """
+    key = (text, color)
+    surface = _text_surfaces.get(key)
+    if surface is None:
+        surface = font.render(text, True, color)
+        _text_surfaces[key] = surface
+        if len(_text_surfaces) > config.TEXT_CACHE_SIZE:
+            _text_surfaces.popitem(last=False)
+    else:
+        _text_surfaces.move_to_end(key)
+    return surface
+
+
+def draw_road_labels(city: generation.City, data: ScreenData):
+    """
+    Draws the id of the roads on screen at their middles. When zoomed out,
+    only the road with the lowest id in each square of config.LABEL_SPACING
+    pixels is labelled, so the labels don't pile up on top of each other
+    """
+    spacing = config.LABEL_SPACING / data.zoom
+    chosen = {}
+    for road in city.sectors.sample_box(
+            screen_to_world((0, 0), data.pan, data.zoom),
+            screen_to_world(config.SCREEN_RES, data.pan, data.zoom), spacing):
+        middle = ((road.start[0] + road.end[0]) / 2,
+                  (road.start[1] + road.end[1]) / 2)
+        cell = (math.floor(middle[0] / spacing), math.floor(middle[1] / spacing))
+        best = chosen.get(cell)
+        if best is None or road.global_id < best[0]:
+            chosen[cell] = (road.global_id, middle)
+
+    for global_id, middle in chosen.values():
+        draw_label_world((str(global_id), middle), data, 1)
+
+
 def draw_label_world(label, data, justify):
     label_pos = world_to_screen(label[1], data.pan, data.zoom)
     draw_label_screen((label[0], label_pos), data, justify)
@@ -134,7 +334,7 @@ def draw_label_screen(label, data, justify):
     label_pos = label[1]
     if -20 < label_pos[0] < config.SCREEN_RES[0] and \
             -20 < label_pos[1] < config.SCREEN_RES[1]:
-        rendered_text = font.render(label[0], True, (255, 255, 255))
+        rendered_text = render_text(label[0])
         if justify == 0:
             label_pos = (label_pos[0] - rendered_text.get_width() / 2, label_pos[1])
         elif justify == -1:
@@ -142,23 +342,91 @@ def draw_label_screen(label, data, justify):
         data.screen.blit(rendered_text, label_pos)
 
 
-def draw_heatmap(square_size: int, city: generation.City, data: ScreenData):
-    """ Draws the population heatmap to the screen in the given ScreenData """
-    x_max = math.ceil(config.SCREEN_RES[0] / square_size) + 1
-    y_max = math.ceil(config.SCREEN_RES[1] / square_size) + 1
-
-    for x in range(0, x_max):
-        for y in range(0, y_max):
-            screen_point = (x * square_size,
-                            y * square_size)
-            world_point = screen_to_world(screen_point, data.pan, data.zoom)
-
-            intensity = city.pop.at_point(world_point)
-            color = (0, max(min(intensity * 83, 255), 0), 0)
-            pos = (screen_point[0] - (square_size / 2), screen_point[1] - (square_size / 2))
-            dim = (square_size, square_size)
-
-            pygame.draw.rect(data.screen, color, pygame.Rect(pos, dim))
+class HeatmapCache:
+    """
+    The heatmap overlay drawn in the last frame. The population of each cell
+    is kept so that panning only samples the cells that were newly exposed
+    """
+    def __init__(self):
+        self.pop = None
+        self.zoom = None
+        self.square_size = None
+        # World cell index of the first column and row of intensities
+        self.first_cell = (0, 0)
+        self.intensities = numpy.zeros((0, 0))
+        self.surface = None
+
+    def cell_range(self, data: ScreenData) -> Tuple[int, int, int, int]:
+        """ Gets the first cell and the number of columns and rows on screen """
+        cell_size = self.square_size / self.zoom
+        top_left = screen_to_world((0, 0), data.pan, data.zoom)
+        bottom_right = screen_to_world(config.SCREEN_RES, data.pan, data.zoom)
+
+        first_x = math.floor(top_left[0] / cell_size)
+        first_y = math.floor(top_left[1] / cell_size)
+        cols = math.floor(bottom_right[0] / cell_size) - first_x + 1
+        rows = math.floor(bottom_right[1] / cell_size) - first_y + 1
+
+        return first_x, first_y, cols, rows
+
+    def update(self, square_size: int, pop: population.Heatmap, data: ScreenData):
+        """ Samples any cells that aren't cached and rebuilds the surface """
+        if (pop is not self.pop or data.zoom != self.zoom
+                or square_size != self.square_size):
+            self.pop = pop
+            self.zoom = data.zoom
+            self.square_size = square_size
+            self.intensities = numpy.zeros((0, 0))
+
+        first_x, first_y, cols, rows = self.cell_range(data)
+        if (self.surface is not None
+                and (first_x, first_y) == self.first_cell
+                and (cols, rows) == self.intensities.shape):
+            return
+
+        # Copy over the cells that are still on screen
+        intensities = numpy.zeros((cols, rows))
+        cached = numpy.zeros((cols, rows), dtype=bool)
+        old_cols, old_rows = self.intensities.shape
+        shift_x = self.first_cell[0] - first_x
+        shift_y = self.first_cell[1] - first_y
+        x_lo, x_hi = max(shift_x, 0), min(shift_x + old_cols, cols)
+        y_lo, y_hi = max(shift_y, 0), min(shift_y + old_rows, rows)
+        if x_lo < x_hi and y_lo < y_hi:
+            intensities[x_lo:x_hi, y_lo:y_hi] = self.intensities[
+                x_lo - shift_x:x_hi - shift_x, y_lo - shift_y:y_hi - shift_y]
+            cached[x_lo:x_hi, y_lo:y_hi] = True
+
+        # Sample the newly exposed cells at their centers
+        missing_x, missing_y = numpy.nonzero(~cached)
+        if len(missing_x) != 0:
+            cell_size = square_size / data.zoom
+            centers = numpy.column_stack(
+                ((missing_x + first_x + 0.5) * cell_size,
+                 (missing_y + first_y + 0.5) * cell_size))
+            intensities[missing_x, missing_y] = pop.at_points(centers)
+
+        self.first_cell = (first_x, first_y)
+        self.intensities = intensities
+
+        colors = numpy.zeros((cols, rows, 3), dtype=numpy.uint8)
+        colors[:, :, 1] = numpy.clip(intensities * 83, 0, 255)
+        self.surface = pygame.transform.scale(
+            pygame.surfarray.make_surface(colors),
+            (cols * square_size, rows * square_size))
+
+
+def draw_heatmap(square_size: int, city: generation.City, data: ScreenData,
+                 cache: HeatmapCache):
+    """
+    Draws the population heatmap to the screen in the given ScreenData, in
+    square cells of square_size pixels
+    """
+    cache.update(square_size, city.pop, data)
+
+    pos = (cache.first_cell[0] * square_size + data.pan[0],
+           cache.first_cell[1] * square_size + data.pan[1])
+    data.screen.blit(cache.surface, pos)
 
 
 def draw_sectors(data: ScreenData):
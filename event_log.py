@@ -0,0 +1,164 @@
+import contextlib
+import json
+import struct
+from typing import Optional, Tuple
+
+import config
+import narrow_phase
+import roads
+
+# A log starts with the magic bytes and the length of a JSON header holding
+# the seeds and config the city was generated with. The events follow, each
+# a kind byte then the fields of that kind
+_MAGIC = b"CITYLOG\x01"
+_PREFIX = struct.Struct("<8sQ")
+_VERSION = 1
+
+# A road put on the queue: id, start, end, t, flags, parent id or -1
+PUSH = 1
+_PUSH_FIELDS = struct.Struct("<q4diBq")
+# A road taken off the queue: id
+POP = 2
+_POP_FIELDS = struct.Struct("<q")
+# The snap narrow_phase.find_snap chose for the popped road: snap type, the
+# other road's id, whether an End snap is to its start, and for Cross and
+# Extend snaps the crossing point and factors
+SNAP = 3
+_SNAP_FIELDS = struct.Struct("<Bq?4d")
+# A road split in two by snap_to_cross: the id of the new half
+SPLIT = 4
+_SPLIT_FIELDS = struct.Struct("<q")
+# Whether the popped road was placed, one of the outcomes below
+OUTCOME = 5
+_OUTCOME_FIELDS = struct.Struct("<B")
+
+_FIELDS = {PUSH: _PUSH_FIELDS, POP: _POP_FIELDS, SNAP: _SNAP_FIELDS,
+           SPLIT: _SPLIT_FIELDS, OUTCOME: _OUTCOME_FIELDS}
+
+# Outcomes of popping a road. A rejected road that has a snap couldn't be
+# snapped, one without was too close in angle to a road it starts from
+REJECTED = 0
+PLACED = 1
+OUT_OF_BOUNDS = 2
+
+# Bits of the flags of a pushed road. The first road has whole number
+# coordinates, kept as ints so the replayed city hashes the same
+HIGHWAY = 1
+BRANCH = 2
+INT_START = 4
+INT_END = 8
+
+# The log generation is currently recorded to, None when off
+_active: Optional['EventLog'] = None
+
+
+class EventLog:
+    """
+    Every decision made while generating a city, in the order it was made:
+    each road pushed onto the queue and popped off it, the snap chosen for
+    it, the roads split to make room for it and whether it was placed.
+    That is everything needed to build the city again without the heatmap
+    or any intersection tests, see replay.Replayer. Logs are recorded from
+    a Generator, which records its seeds when it starts
+    """
+    def __init__(self):
+        self.header = {"version": _VERSION}
+        self._events = bytearray()
+
+    def __len__(self):
+        return len(self._events)
+
+    def started(self, seed, pop_seed: Tuple[float, float]):
+        """ Records the seeds of a new city and the config generating it """
+        self.header["seed"] = seed
+        self.header["pop_seed"] = list(pop_seed)
+        self.header["config"] = {
+            name: value for name, value in vars(config).items()
+            if name.isupper() and isinstance(value, (bool, int, float, str))}
+
+    def pushed(self, seg: roads.Segment):
+        self._events.append(PUSH)
+        flags = ((HIGHWAY if seg.is_highway else 0)
+                 | (BRANCH if seg.is_branch else 0)
+                 | (INT_START if _is_int(seg.start) else 0)
+                 | (INT_END if _is_int(seg.end) else 0))
+        self._events += _PUSH_FIELDS.pack(
+            seg.global_id, seg.start[0], seg.start[1], seg.end[0], seg.end[1],
+            seg.t, flags,
+            seg.parent.global_id if seg.parent is not None else -1)
+
+    def popped(self, seg: roads.Segment):
+        self._events.append(POP)
+        self._events += _POP_FIELDS.pack(seg.global_id)
+
+    def snapped(self, snap: narrow_phase.Snap):
+        self._events.append(SNAP)
+        if snap.crossing is not None:
+            crossing = (snap.crossing.point[0], snap.crossing.point[1],
+                        snap.crossing.main_factor, snap.crossing.other_factor)
+        else:
+            crossing = (0.0, 0.0, 0.0, 0.0)
+        self._events += _SNAP_FIELDS.pack(snap.snap_type, snap.other.global_id,
+                                          bool(snap.at_start), *crossing)
+
+    def split(self, split_half: roads.Segment):
+        self._events.append(SPLIT)
+        self._events += _SPLIT_FIELDS.pack(split_half.global_id)
+
+    def outcome(self, outcome: int):
+        self._events.append(OUTCOME)
+        self._events += _OUTCOME_FIELDS.pack(outcome)
+
+    def read(self, offset: int) -> Tuple[int, tuple, int]:
+        """
+        Reads the event at an offset into the events
+        :return: The kind of event, its fields and the offset of the next one
+        """
+        kind = self._events[offset]
+        fields = _FIELDS[kind]
+        return kind, fields.unpack_from(self._events, offset + 1), \
+            offset + 1 + fields.size
+
+    def save(self, path: str):
+        header_bytes = json.dumps(self.header).encode()
+        with open(path, "wb") as log_file:
+            log_file.write(_PREFIX.pack(_MAGIC, len(header_bytes)))
+            log_file.write(header_bytes)
+            log_file.write(self._events)
+
+    @classmethod
+    def load(cls, path: str) -> 'EventLog':
+        with open(path, "rb") as log_file:
+            data = log_file.read()
+        magic, header_size = _PREFIX.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError("{} is not an event log".format(path))
+        log = cls()
+        log.header = json.loads(data[_PREFIX.size:_PREFIX.size + header_size])
+        if log.header["version"] != _VERSION:
+            raise ValueError("{} is version {} of the event log format, "
+                             "expected {}".format(path, log.header["version"],
+                                                  _VERSION))
+        log._events = bytearray(data[_PREFIX.size + header_size:])
+        return log
+
+
+def _is_int(point: Tuple[float, float]) -> bool:
+    return type(point[0]) is int and type(point[1]) is int
+
+
+def current() -> Optional[EventLog]:
+    """ Gets the log generation is being recorded to, None if it isn't """
+    return _active
+
+
+@contextlib.contextmanager
+def recording(log: EventLog = None):
+    """ Records the generation within the with block to an event log """
+    global _active
+    previous = _active
+    _active = log if log is not None else EventLog()
+    try:
+        yield _active
+    finally:
+        _active = previous
@@ -0,0 +1,157 @@
+import argparse
+import json
+from typing import Iterable, Iterator, List, Optional, TextIO, Tuple
+
+import build_gen
+import city_file
+import generation
+import roads
+from SnapType import SnapType
+
+Lot = List[Tuple[float, float]]
+
+# Exporters only ever hold one road or lot in memory at a time, and write
+# their output in chunks of about this many characters
+_CHUNK_SIZE = 1 << 16
+
+
+def road_properties(road: roads.Segment) -> dict:
+    return {"kind": "road",
+            "global_id": road.global_id,
+            "is_highway": bool(road.is_highway),
+            "has_snapped": SnapType(road.has_snapped).name,
+            "links_s": sorted(link.global_id for link in road.links_s),
+            "links_e": sorted(link.global_id for link in road.links_e)}
+
+
+def geojson_chunks(city: generation.City,
+                   lots: Optional[Iterable[Lot]] = None) -> Iterator[str]:
+    """
+    Yields a GeoJSON FeatureCollection of the city a piece at a time: a
+    LineString per road and, if lots are given, a Polygon per lot
+    """
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = "\n"
+    for road in city.roads:
+        yield separator + json.dumps({
+            "type": "Feature",
+            "geometry": {"type": "LineString",
+                         "coordinates": [_point(road.start),
+                                         _point(road.end)]},
+            "properties": road_properties(road)})
+        separator = ",\n"
+
+    for lot in lots if lots is not None else ():
+        ring = [_point(point) for point in lot]
+        if ring[0] != ring[-1]:
+            ring.append(ring[0])
+        yield separator + json.dumps({
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [ring]},
+            "properties": {"kind": "lot"}})
+        separator = ",\n"
+    yield "\n]}\n"
+
+
+def svg_chunks(city: generation.City, lots: Optional[Iterable[Lot]] = None,
+               margin: float = 100) -> Iterator[str]:
+    """
+    Yields an SVG drawing of the city a piece at a time, with y pointing down
+    as in the viewer. Lots are drawn under the roads, so they are found and
+    drawn before any road
+    """
+    x0, y0, x1, y1 = _bounds(city.roads)
+    yield ('<svg xmlns="http://www.w3.org/2000/svg" '
+           'viewBox="{:g} {:g} {:g} {:g}">\n'.format(
+               x0 - margin, y0 - margin, x1 - x0 + 2 * margin,
+               y1 - y0 + 2 * margin))
+    yield ('<style>'
+           '.lot {fill: #c8e6c9; stroke: none}'
+           '.street {stroke: #404040; stroke-width: 6}'
+           '.highway {stroke: #d84315; stroke-width: 12}'
+           '</style>\n')
+
+    if lots is not None:
+        yield '<g id="lots">\n'
+        for lot in lots:
+            yield '<polygon class="lot" points="{}"/>\n'.format(
+                " ".join("{:g},{:g}".format(*point) for point in lot))
+        yield '</g>\n'
+
+    yield '<g id="roads" stroke-linecap="round">\n'
+    for road in city.roads:
+        yield ('<line id="road-{}" class="{}" x1="{:g}" y1="{:g}" '
+               'x2="{:g}" y2="{:g}"/>\n'.format(
+                   road.global_id, "highway" if road.is_highway else "street",
+                   road.start[0], road.start[1], road.end[0], road.end[1]))
+    yield '</g>\n</svg>\n'
+
+
+def write_chunks(chunks: Iterable[str], out: TextIO):
+    """ Writes chunks to out, joining small ones into bigger writes """
+    buffered = []
+    size = 0
+    for chunk in chunks:
+        buffered.append(chunk)
+        size += len(chunk)
+        if size >= _CHUNK_SIZE:
+            out.write("".join(buffered))
+            buffered = []
+            size = 0
+    out.write("".join(buffered))
+
+
+def write_geojson(city: generation.City, path: str, include_lots: bool = False):
+    with open(path, "w") as out:
+        write_chunks(geojson_chunks(
+            city, build_gen.iter_lots(city) if include_lots else None), out)
+
+
+def write_svg(city: generation.City, path: str, include_lots: bool = False):
+    with open(path, "w") as out:
+        write_chunks(svg_chunks(
+            city, build_gen.iter_lots(city) if include_lots else None), out)
+
+
+# Exporters by file extension
+WRITERS = {"geojson": write_geojson, "svg": write_svg}
+
+
+def _point(point: Tuple[float, float]) -> List[float]:
+    """ Gets a point as floats, so roads and loaded views export the same """
+    return [float(point[0]), float(point[1])]
+
+
+def _bounds(city_roads: Iterable[roads.Segment]) -> Tuple[float, float, float, float]:
+    x0 = y0 = float("inf")
+    x1 = y1 = float("-inf")
+    for road in city_roads:
+        for x, y in (road.start, road.end):
+            x0 = min(x0, x)
+            y0 = min(y0, y)
+            x1 = max(x1, x)
+            y1 = max(y1, y)
+    if x0 > x1:
+        return 0, 0, 0, 0
+    return x0, y0, x1, y1
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Exports a saved city to GeoJSON or SVG")
+    parser.add_argument("city", help="A city file saved by city_file.save")
+    parser.add_argument("out", help="Output file, ending in .geojson or .svg")
+    parser.add_argument("--lots", action="store_true",
+                        help="Also export the lots between the roads")
+    args = parser.parse_args()
+
+    extension = args.out.rsplit(".", 1)[-1].lower()
+    if extension not in WRITERS:
+        parser.error("Can only export to {}".format(
+            ", ".join("." + name for name in WRITERS)))
+
+    WRITERS[extension](city_file.load(args.city), args.out, args.lots)
+
+
+if __name__ == "__main__":
+    main()
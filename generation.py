@@ -4,16 +4,23 @@ import time
 import random
 import config
 import population
+import profiler
 from SnapType import SnapType
 import sectors
-import vectors
+import spatial
+import streams
+import event_log
+import narrow_phase
 import math
 import collections
+import contextlib
 from typing import List, Dict, Tuple, Set
 
 watch_total = Stopwatch()
 
-City = collections.namedtuple("City", "roads, sectors, pop")
+# seed is what the city was generated from, None if it isn't known
+City = collections.namedtuple("City", "roads, sectors, pop, seed",
+                              defaults=(None,))
 
 
 def generate(manual_seed: int = None) -> City:
@@ -21,64 +28,184 @@ def generate(manual_seed: int = None) -> City:
     watch_total.reset()
     watch_total.start()
 
-    roads.Segment.seg_id = 0
-    if manual_seed is not None:
-        seed = manual_seed
-    elif config.ROAD_SEED != 0:
-        seed = config.ROAD_SEED
-    else:
-        seed = time.process_time()
-    random.seed(seed)
-    pop_seed = (random.randrange(-1, 1) * 1000000000,
-                random.randrange(-1, 1) * 1000000000)
-
-    print("Generating {} segments with seed: {}".format(config.MAX_SEGS, seed))
-
-    road_queue = roads.Queue()
-    road_queue.push(roads.Segment((0, 0), (config.HIGHWAY_LENGTH, 0), True))
-
-    city = City([], {}, population.Heatmap(pop_seed))
-
-    while not road_queue.is_empty() and len(city.roads) <= config.MAX_SEGS:
-        seg = road_queue.pop()
-
-        if local_constraints(seg, city):
-            seg.connect_links()
-
-            city.roads.append(seg)
-            sectors.add(seg, city.sectors)
-
-            new_segments = global_goals(seg, city.pop)
-            for new_seg in new_segments:
-                new_seg.t += seg.t + 1
-                road_queue.push(new_seg)
+    with profiler.section("generate"):
+        generator = Generator(manual_seed)
+        print("Generating {} segments with seed: {}".format(config.MAX_SEGS,
+                                                            generator.seed))
+        generator.run_until(config.MAX_SEGS)
 
     watch_total.stop()
     print("Time spent (ms): {}".format(watch_total.passed_ms()))
 
-    return city
+    return generator.city
+
+
+class Generator:
+    """
+    A city part way through being generated. It owns everything generation
+    needs between roads: the queue of roads to place, the random state and
+    the next segment id, so it can be stopped after any road and carried on
+    later. Seeds are whole numbers, so a city can always be made again from
+    the seed it was generated with. However it is stepped, the same seed
+    always places the same roads in the same order, so growing a finished
+    city to more segments gives the same city as generating that many
+    segments directly
+    """
+    def __init__(self, manual_seed: int = None):
+        if manual_seed is not None:
+            self.seed = manual_seed
+        elif config.ROAD_SEED != 0:
+            self.seed = config.ROAD_SEED
+        else:
+            self.seed = random.SystemRandom().randrange(1, 1 << 32)
+        self.rng = streams.new_rng(self.seed)
+        # The heatmap takes the first numbers of the seed, so it is the same
+        # however the roads draw theirs
+        seeded = (random.Random(self.seed)
+                  if isinstance(self.rng, streams.SegmentRandom) else self.rng)
+        pop_seed = (seeded.randrange(-1, 1) * 1000000000,
+                    seeded.randrange(-1, 1) * 1000000000)
+
+        self.city = City([], spatial.QuadTree(), population.Heatmap(pop_seed),
+                         self.seed)
+        self.road_queue = roads.new_queue()
+        self.seg_id = 0
+        with self._segment_ids():
+            first = roads.Segment((0, 0), (config.HIGHWAY_LENGTH, 0), True)
+        self.road_queue.push(first)
+        roads.topology_changed()
+
+        log = event_log.current()
+        if log is not None:
+            log.started(self.seed, pop_seed)
+            log.pushed(first)
+
+    def is_done(self) -> bool:
+        """ Whether there are no roads left that could be placed """
+        return self.road_queue.is_empty()
+
+    def step(self, count: int = 1) -> int:
+        """
+        Takes the next count roads off the queue, placing the ones that fit
+        :return: The number of roads added to the city
+        """
+        added = len(self.city.roads)
+        with self._segment_ids():
+            for _ in range(count):
+                if self.road_queue.is_empty():
+                    break
+                place_next(self.city, self.road_queue, rng=self.rng)
+        return len(self.city.roads) - added
+
+    def run_until(self, max_segs: int) -> int:
+        """
+        Generates until the city has more than max_segs roads, the same
+        limit generate() uses for config.MAX_SEGS
+        :return: The number of roads added to the city
+        """
+        added = len(self.city.roads)
+        with self._segment_ids():
+            grow(self.city, self.road_queue, max_segs, rng=self.rng)
+        return len(self.city.roads) - added
+
+    def run_for(self, seconds: float, max_segs: int = None) -> int:
+        """
+        Generates for about the given time, stopping early if the city gets
+        more than max_segs roads
+        :return: The number of roads added to the city
+        """
+        added = len(self.city.roads)
+        end_time = time.perf_counter() + seconds
+        with self._segment_ids():
+            while (not self.road_queue.is_empty()
+                   and (max_segs is None or len(self.city.roads) <= max_segs)
+                   and time.perf_counter() < end_time):
+                place_next(self.city, self.road_queue, rng=self.rng)
+        return len(self.city.roads) - added
+
+    @contextlib.contextmanager
+    def _segment_ids(self):
+        """ Gives new segments ids from this generator's own counter """
+        outside_id = roads.Segment.seg_id
+        roads.Segment.seg_id = self.seg_id
+        try:
+            yield
+        finally:
+            self.seg_id = roads.Segment.seg_id
+            roads.Segment.seg_id = outside_id
+
+
+def grow(city: City, road_queue: roads.Queue, max_segs: int,
+         bounds: spatial.BoundingBox = None, rng: random.Random = random):
+    """
+    Places the roads in the queue into the city, along with the roads they
+    lead to, until the queue is empty or the city has more than max_segs roads
+    :param bounds: A box that roads have to stay inside, None for no limit
+    :param rng: Source of random numbers, the random module if not given
+    """
+    while not road_queue.is_empty() and len(city.roads) <= max_segs:
+        place_next(city, road_queue, bounds, rng)
 
 
-def highway_deviation() -> int:
+def place_next(city: City, road_queue: roads.Queue,
+               bounds: spatial.BoundingBox = None,
+               rng: random.Random = random):
+    """
+    Takes the next road off the queue and places it in the city if it fits,
+    queueing the roads that follow on from it
+    """
+    seg = road_queue.pop()
+    log = event_log.current()
+    if log is not None:
+        log.popped(seg)
+
+    if bounds is not None and not spatial.contains(
+            bounds, spatial.bounding_box(seg)):
+        if log is not None:
+            log.outcome(event_log.OUT_OF_BOUNDS)
+        return
+
+    if local_constraints(seg, city):
+        if log is not None:
+            log.outcome(event_log.PLACED)
+        seg.connect_links()
+
+        city.roads.append(seg)
+        city.sectors.add(seg)
+
+        new_segments = global_goals(seg, city.pop, rng)
+        for new_seg in new_segments:
+            new_seg.t += seg.t + 1
+            road_queue.push(new_seg)
+            if log is not None:
+                log.pushed(new_seg)
+    elif log is not None:
+        log.outcome(event_log.REJECTED)
+
+
+def highway_deviation(rng: random.Random = random) -> int:
     """ Generates a random angle deviation in degrees for a highway """
-    return random.randint(-config.HIGHWAY_MAX_ANGLE_DEV,
-                          config.HIGHWAY_MAX_ANGLE_DEV)
+    return rng.randint(-config.HIGHWAY_MAX_ANGLE_DEV,
+                       config.HIGHWAY_MAX_ANGLE_DEV)
 
 
-def branch_deviation() -> int:
+def branch_deviation(rng: random.Random = random) -> int:
     """ Generates a random angle deviation in degrees for a branch """
-    return random.randint(-config.BRANCH_MAX_ANGLE_DEV,
-                          config.BRANCH_MAX_ANGLE_DEV)
+    return rng.randint(-config.BRANCH_MAX_ANGLE_DEV,
+                       config.BRANCH_MAX_ANGLE_DEV)
 
 
+@profiler.timed("global_goals")
 def global_goals(previous_segment: roads.Segment,
-                 heatmap: 'population.Heatmap') -> List[roads.Segment]:
+                 heatmap: 'population.Heatmap',
+                 rng: random.Random = random) -> List[roads.Segment]:
     """
     Takes a road that has been placed in the city, and generates new roads
         (branches & extensions) from it
     :param previous_segment: Road to generate continuations from.
         Assumed to already be connected
     :param heatmap: The population heatmap object to base road generation on
+    :param rng: Source of random numbers, the random module if not given
     :return: a list of the newly generated roads
     """
     new_segments = []
@@ -86,12 +213,15 @@ def global_goals(previous_segment: roads.Segment,
     if previous_segment.has_snapped != SnapType.No:
         return new_segments
 
+    if isinstance(rng, streams.SegmentRandom):
+        rng.begin(previous_segment)
+
     straight_seg = previous_segment.make_extension(0)
     straight_pop = heatmap.at_line(straight_seg)
 
     if previous_segment.is_highway:
         # Extend the current highway, tending towards higher pops
-        wiggle_seg = previous_segment.make_extension(highway_deviation())
+        wiggle_seg = previous_segment.make_extension(highway_deviation(rng))
         wiggle_pop = heatmap.at_line(wiggle_seg)
 
         if wiggle_pop > straight_pop:
@@ -103,21 +233,21 @@ def global_goals(previous_segment: roads.Segment,
 
         # Make a street branch if the extension pop is high enough
         if (next_pop > config.HIGHWAY_BRANCH_POP
-                and random.random() < config.HIGHWAY_BRANCH_CHANCE):
-            angle = (90 * random.randrange(-1, 2, 2)) + branch_deviation()
+                and rng.random() < config.HIGHWAY_BRANCH_CHANCE):
+            angle = (90 * rng.randrange(-1, 2, 2)) + branch_deviation(rng)
             branch = previous_segment.make_continuation(config.HIGHWAY_LENGTH,
                                                         angle,
                                                         True,
                                                         True)
             new_segments.append(branch)
-    elif straight_pop > random.uniform(0, config.STREET_EXTEND_POP):
+    elif straight_pop > rng.uniform(0, config.STREET_EXTEND_POP):
         # Always extend streets
         new_segments.append(straight_seg)
 
     # Sometimes create a street branch, delaying branches from highways
-    if (straight_pop > random.uniform(0, config.STREET_BRANCH_POP)
-            and random.random() < config.STREET_BRANCH_CHANCE):
-        angle = (90 * random.randrange(-1, 2, 2)) + branch_deviation()
+    if (straight_pop > rng.uniform(0, config.STREET_BRANCH_POP)
+            and rng.random() < config.STREET_BRANCH_CHANCE):
+        angle = (90 * rng.randrange(-1, 2, 2)) + branch_deviation(rng)
         delay = 5 if previous_segment.is_highway else 0
         branch = previous_segment.make_continuation(config.STREET_LENGTH,
                                                     angle,
@@ -132,68 +262,80 @@ def global_goals(previous_segment: roads.Segment,
     return new_segments
 
 
+@profiler.timed("local_constraints")
 def local_constraints(inspect_seg: roads.Segment, city: City) -> bool:
     """
     Checks that the given segment can either be placed into the city or
     can be modified to fit into the city, modifying it if it can,
     returning false if it can't.
     """
-    action = None
-    last_snap = SnapType.No
-    last_inter_factor = 1
-    last_ext_factor = 999
-
     if inspect_seg.parent is not None:
         if is_road_crowding(inspect_seg, inspect_seg.parent.links_e):
             return False
 
-    check_segs = []
-
-    for containing_sector in sectors.from_seg(inspect_seg):
-        check_segs += city.sectors.get(containing_sector, [])
-
-    for other_seg in check_segs:
-        inter = inspect_seg.find_intersect(other_seg)
-
-        # Check for possible snaps based on the priorities of the
-        # various snap types.
-
-        # Check for intersections
-        if (last_snap <= SnapType.Cross
-                and inter is not None
-                and 0 < inter.main_factor < last_inter_factor):
-            last_inter_factor = inter.main_factor
-            last_snap = SnapType.Cross
-
-            def action(other=other_seg, crossing=inter) -> bool:
-                return snap_to_cross(inspect_seg, other, crossing, city)
-        # Check for nearby road starts/ends
-        if last_snap <= SnapType.End:
-            if (vectors.distance(inspect_seg.end, other_seg.end)
-                    < config.SNAP_VERTEX_RADIUS):
-                def action(other=other_seg) -> bool:
-                    return snap_to_end(inspect_seg, other, SnapType.End)
-                last_snap = SnapType.End
-            elif (vectors.distance(inspect_seg.end, other_seg.start)
-                    < config.SNAP_VERTEX_RADIUS):
-                def action(other=other_seg) -> bool:
-                    return snap_to_start(inspect_seg, other, SnapType.End)
-                last_snap = SnapType.End
-        # Check if the seg can be extended to intersect with another road
-        if (last_snap <= SnapType.Extend
-                and inter is not None
-                and 1 < inter.main_factor < last_ext_factor
-                and vectors.distance(inspect_seg.end, inter.point)
-                < config.SNAP_EXTEND_RADIUS):
-            last_ext_factor = inter.main_factor
-
-            def action(other=other_seg, crossing=inter) -> bool:
-                return snap_to_cross(inspect_seg, other, crossing, city)
-            last_snap = SnapType.Extend
-
-    if action is not None:
-        return action()
-    return True
+    check_segs = city.sectors.near_seg(inspect_seg, spatial.snap_distance())
+    if config.ROAD_QUEUE == "heap":
+        check_segs = _in_old_sectors(inspect_seg, check_segs, city)
+
+    snap = narrow_phase.find_snap(inspect_seg, check_segs,
+                                  _sector_order(inspect_seg, city))
+
+    if snap is None:
+        return True
+    log = event_log.current()
+    if log is not None:
+        log.snapped(snap)
+    return apply_snap(inspect_seg, snap, city)
+
+
+def _in_old_sectors(inspect_seg: roads.Segment,
+                    candidates: List[roads.Segment],
+                    city: City) -> List[roads.Segment]:
+    """
+    Keeps the candidates older versions found, which were the roads listed
+    in the sectors near inspect_seg. A road was listed in the sectors it was
+    near when it was added, so when SECTOR_SIZE is shorter than a road, a
+    road crossing a sector without an end near it wasn't found there
+    """
+    near = sectors.from_seg(inspect_seg)
+    return [other for other in candidates
+            if not near.isdisjoint(sectors.from_ends(
+                city.sectors.added_start(other), other.end))]
+
+
+def _sector_order(inspect_seg: roads.Segment, city: City):
+    """
+    Makes the find_snap end_order that joins the road an End snap went to
+    before the spatial index, when the candidates were read out of the
+    sectors near inspect_seg one sector at a time, each in the order its
+    roads were added. A road was listed in the sectors it was near when it
+    was added, and stayed there when a split moved its start
+    """
+    positions = None
+
+    def order(other: roads.Segment) -> Tuple[int, int]:
+        nonlocal positions
+        if positions is None:
+            positions = {sector: i for i, sector
+                         in enumerate(sectors.from_seg(inspect_seg))}
+        added = sectors.from_ends(city.sectors.added_start(other), other.end)
+        return (max(positions.get(sector, -1) for sector in added),
+                city.sectors.order_of(other))
+
+    return order
+
+
+def apply_snap(inspect_seg: roads.Segment, snap: narrow_phase.Snap,
+               city: City) -> bool:
+    """
+    Makes the snap chosen for a segment, modifying it and the road it snaps
+    to, returning false if the segment can't be snapped that way
+    """
+    if snap.snap_type == SnapType.End:
+        if snap.at_start:
+            return snap_to_start(inspect_seg, snap.other, SnapType.End)
+        return snap_to_end(inspect_seg, snap.other, SnapType.End)
+    return snap_to_cross(inspect_seg, snap.other, snap.crossing, city)
 
 
 def is_road_crowding(inspect_seg: roads.Segment, to_check: Set[roads.Segment]):
@@ -209,6 +351,7 @@ def is_road_crowding(inspect_seg: roads.Segment, to_check: Set[roads.Segment]):
     return False
 
 
+@profiler.timed("snap_to_cross")
 def snap_to_cross(mod_road: roads.Segment, other_road: roads.Segment,
                   crossing: roads.Intersection, city: City) -> bool:
     """
@@ -235,9 +378,29 @@ def snap_to_cross(mod_road: roads.Segment, other_road: roads.Segment,
     if round(crossing[2], 5) == 0 or round(crossing[2], 5) == 1:
         return False
 
-    # Split other_road by shortening it to start at the crossing and
-    # add a new segment from other_road's original start to the crossing
-    # doing all the requisite stitching
+    split_half = split_road(other_road, crossing[0], city)
+
+    mod_road.links_e.add(other_road)
+    mod_road.links_e.add(split_half)
+    mod_road.end = crossing[0]
+
+    if crossing.main_factor > 1:
+        mod_road.has_snapped = SnapType.Extend
+    else:
+        mod_road.has_snapped = SnapType.Cross
+    return True
+
+
+def split_road(other_road: roads.Segment, point: Tuple[float, float],
+               city: City) -> roads.Segment:
+    """
+    Splits a road in two at a point along it, keeping other_road as the half
+    after the point
+    :return: The new half, from other_road's old start to the point
+    """
+    # Shorten other_road to start at the point and add a new segment from
+    # other_road's original start to the point, doing all the requisite
+    # stitching
 
     start_loc = other_road.start
     old_parent = other_road.parent
@@ -252,9 +415,11 @@ def snap_to_cross(mod_road: roads.Segment, other_road: roads.Segment,
                 road.links_e.remove(other_road)
 
     other_road.links_s = set()
-    other_road.start = crossing[0]
+    other_road.start = point
+    roads.topology_changed()
+    city.sectors.move(other_road)
 
-    split_half = roads.Segment(start_loc, crossing[0], other_road.is_highway)
+    split_half = roads.Segment(start_loc, point, other_road.is_highway)
     split_half.parent = old_parent
     split_half.links_e.add(other_road)
     split_half.connect_links()
@@ -265,17 +430,12 @@ def snap_to_cross(mod_road: roads.Segment, other_road: roads.Segment,
     other_road.links_s.add(split_half)
 
     city.roads.append(split_half)
-    sectors.add(split_half, city.sectors)
-
-    mod_road.links_e.add(other_road)
-    mod_road.links_e.add(split_half)
-    mod_road.end = crossing[0]
+    city.sectors.add(split_half)
+    log = event_log.current()
+    if log is not None:
+        log.split(split_half)
 
-    if crossing.main_factor > 1:
-        mod_road.has_snapped = SnapType.Extend
-    else:
-        mod_road.has_snapped = SnapType.Cross
-    return True
+    return split_half
 
 
 def snap_to_end(mod_road: roads.Segment, other_road: roads.Segment,
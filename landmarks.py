@@ -0,0 +1,233 @@
+import heapq
+import itertools
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import config
+import pathing
+import roads
+
+# Each search only uses the landmarks that bound its own start and end best,
+# the others rarely tighten the bounds enough to be worth checking
+_ACTIVE_LANDMARKS = 3
+
+_INFINITY = float("inf")
+
+
+class Landmarks:
+    """
+    Path lengths from a few landmark roads to every road, used by route() as
+    lower bounds on the length left to go (ALT: A*, landmarks and the
+    triangle inequality). Landmarks are picked far apart from each other, so
+    that most routes head roughly towards or away from one of them.
+    Since links go both ways, the length from a road to a landmark follows
+    from the length the other way: only the road costs at the two ends differ
+    """
+    def __init__(self, all_roads: List[roads.Segment],
+                 landmark_ids: List[int], distances: List[List[float]],
+                 adjacency: List[List[Tuple[int, int]]]):
+        self.roads = list(all_roads)
+        self.landmark_ids = landmark_ids
+        # distances[i][road] is the length from landmark i to road, not
+        # counting the landmark itself, inf where it can't be reached
+        self.distances = distances
+        self._adjacency = adjacency
+        self._costs = [pathing.cost(road) for road in self.roads]
+        self._index_of = {road: i for i, road in enumerate(self.roads)}
+        # The distances from every landmark to each road, grouped by road
+        self._by_road = list(zip(*distances))
+
+    @classmethod
+    def build(cls, all_roads: List[roads.Segment],
+              count: int = None,
+              graph: Optional[pathing.Graph] = None) -> 'Landmarks':
+        """
+        Picks count landmarks, each the road farthest from the ones already
+        picked, starting from the road farthest from the first road
+        """
+        if count is None:
+            count = config.PATH_LANDMARKS
+        adjacency = pathing.indexed_adjacency(all_roads, graph)
+        landmark_ids = []
+        distances = []
+        if not all_roads:
+            return cls(all_roads, landmark_ids, distances, adjacency)
+
+        # Distance from the nearest landmark picked so far, the first road is
+        # only a starting point and not a landmark itself
+        nearest = _distances_from(adjacency, 0)
+        for i in range(min(count, len(all_roads))):
+            landmark = max(range(len(nearest)),
+                           key=lambda road: (nearest[road] != _INFINITY,
+                                             nearest[road]))
+            landmark_ids.append(landmark)
+            distances.append(_distances_from(adjacency, landmark))
+
+            if i == 0:
+                nearest = distances[0]
+            else:
+                nearest = [min(old, new) for old, new
+                           in zip(nearest, distances[-1])]
+
+        return cls(all_roads, landmark_ids, distances, adjacency)
+
+    def lower_bound(self, road: int, goal: int,
+                    active: Sequence[int] = None) -> float:
+        """
+        Gets a length no longer than the shortest path from road to goal,
+        by road index, not counting the cost of road itself
+        :param active: Indices of the landmarks to use, all of them if None
+        """
+        bound = 0
+        road_cost = self._costs[road]
+        goal_cost = self._costs[goal]
+        road_distances = self._by_road[road]
+        goal_distances = self._by_road[goal]
+        for i in range(len(self.distances)) if active is None else active:
+            to_road = road_distances[i]
+            to_goal = goal_distances[i]
+            if to_road == _INFINITY or to_goal == _INFINITY:
+                continue
+            # landmark -> road -> goal can't beat landmark -> goal, and
+            # road -> goal -> landmark can't beat road -> landmark
+            bound = max(bound, to_goal - to_road,
+                        (to_road - road_cost) - (to_goal - goal_cost))
+        return bound
+
+    def _active(self, start: int, end: int) -> List[int]:
+        """ Gets the landmarks giving the best bounds between start and end """
+        def bound(i: int) -> float:
+            return max(self.lower_bound(start, end, (i,)),
+                       self.lower_bound(end, start, (i,)))
+
+        ranked = sorted(range(len(self.distances)), key=bound, reverse=True)
+        return ranked[:_ACTIVE_LANDMARKS]
+
+    def route(self, data: pathing.PathData):
+        """
+        Finds the shortest path from data.start to data.end, searching from
+        both ends at once with landmark bounds guiding each direction.
+        The two directions share the potential (to end - from start) / 2 so
+        that they agree on the length of every edge and can stop as soon as
+        their two frontiers add up to the best path found
+        """
+        start = self._index_of[data.start]
+        end = self._index_of[data.end]
+        active = self._active(start, end)
+        bounds: Dict[int, float] = {}
+
+        def potential(road: int) -> float:
+            value = bounds.get(road)
+            if value is None:
+                value = (self.lower_bound(road, end, active)
+                         - self.lower_bound(start, road, active)) / 2
+                bounds[road] = value
+            return value
+
+        forward = _Search(start, potential(start))
+        backward = _Search(end, -potential(end))
+        best = _INFINITY
+        meeting = -1
+
+        while True:
+            forward_key = forward.top_key()
+            backward_key = backward.top_key()
+            if forward_key + backward_key >= best:
+                break
+
+            if forward_key <= backward_key:
+                search, other = forward, backward
+                road = search.settle()
+                edges = [(neighbor, neighbor_cost, potential(neighbor))
+                         for neighbor, neighbor_cost in self._adjacency[road]]
+            else:
+                search, other = backward, forward
+                road = search.settle()
+                # Going backwards onto a neighbor, the cost paid is for road
+                road_cost = self._costs[road]
+                edges = [(neighbor, road_cost, -potential(neighbor))
+                         for neighbor, _ in self._adjacency[road]]
+
+            # Check every road both directions have reached, as soon as
+            # either improves its distance
+            reached = [road]
+            for neighbor, edge_cost, neighbor_potential in edges:
+                if search.relax(road, neighbor, edge_cost, neighbor_potential):
+                    reached.append(neighbor)
+            for neighbor in reached:
+                if neighbor in other.dist:
+                    through = search.dist[neighbor] + other.dist[neighbor]
+                    if through < best:
+                        best = through
+                        meeting = neighbor
+
+        data.searched = [self.roads[road] for road
+                         in itertools.chain(forward.order, backward.order)]
+        data.path = []
+        data.length = 0
+        if meeting < 0:
+            return
+
+        path = list(reversed(forward.chain(meeting))) + backward.chain(meeting)[1:]
+        data.path = [self.roads[road] for road in reversed(path)]
+        data.length = best + self._costs[start]
+
+
+class _Search:
+    """ One direction of a bidirectional landmark search """
+    def __init__(self, origin: int, origin_potential: float):
+        self.dist = {origin: 0}
+        self.prev: Dict[int, int] = {origin: -1}
+        self.settled = set()
+        self.order: List[int] = []
+        self.heap = [(origin_potential, origin)]
+
+    def top_key(self) -> float:
+        while self.heap and self.heap[0][1] in self.settled:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else _INFINITY
+
+    def settle(self) -> int:
+        road = heapq.heappop(self.heap)[1]
+        self.settled.add(road)
+        self.order.append(road)
+        return road
+
+    def relax(self, road: int, neighbor: int, edge_cost: int,
+              neighbor_potential: float) -> bool:
+        """ Tries reaching neighbor through road, returning if it was shorter """
+        if neighbor in self.settled:
+            return False
+        new_dist = self.dist[road] + edge_cost
+        if new_dist >= self.dist.get(neighbor, _INFINITY):
+            return False
+        self.dist[neighbor] = new_dist
+        self.prev[neighbor] = road
+        heapq.heappush(self.heap, (new_dist + neighbor_potential, neighbor))
+        return True
+
+    def chain(self, road: int) -> List[int]:
+        """ Gets the roads from road back to the origin of the search """
+        roads_back = []
+        while road >= 0:
+            roads_back.append(road)
+            road = self.prev[road]
+        return roads_back
+
+
+def _distances_from(adjacency: List[List[Tuple[int, int]]],
+                    source: int) -> List[float]:
+    dist = [_INFINITY] * len(adjacency)
+    dist[source] = 0
+    heap = [(0, source)]
+
+    while heap:
+        road_dist, road = heapq.heappop(heap)
+        if road_dist > dist[road]:
+            continue
+        for neighbor, neighbor_cost in adjacency[road]:
+            new_dist = road_dist + neighbor_cost
+            if new_dist < dist[neighbor]:
+                dist[neighbor] = new_dist
+                heapq.heappush(heap, (new_dist, neighbor))
+
+    return dist
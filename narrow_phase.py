@@ -0,0 +1,199 @@
+import collections
+import itertools
+from typing import Any, Callable, List, Optional, Tuple
+
+import numpy
+
+import config
+import profiler
+import roads
+import vectors
+from SnapType import SnapType
+
+# The best way for a segment to fit in with the existing roads. crossing is
+# the Intersection for Cross and Extend snaps, at_start tells whether an End
+# snap is to the start rather than the end of other
+Snap = collections.namedtuple("Snap", "snap_type, other, crossing, at_start")
+
+# Distances within this relative margin of a snap radius are rechecked with
+# vectors.distance, since math.pow can round differently than numpy squares
+_RADIUS_MARGIN = 1e-9
+
+
+@profiler.timed("find_snap")
+def find_snap(inspect_seg: roads.Segment, candidates: List[roads.Segment],
+              end_order: Callable[[roads.Segment], Any] = None
+              ) -> Optional[Snap]:
+    """
+    Finds the snap local_constraints should make for inspect_seg against the
+    nearby candidate roads. In priority order that is crossing the road with
+    the nearest intersection, joining the last road with an end within
+    SNAP_VERTEX_RADIUS, or extending to the nearest road within
+    SNAP_EXTEND_RADIUS.
+    Small batches are checked one road at a time, larger ones as arrays
+    :param end_order: Key giving the order roads with a close end are
+    considered in, the last one being joined. None for the candidates' order.
+    Only called when more than one road has a close end
+    :return: The chosen Snap, or None if the segment can be placed as is
+    """
+    if len(candidates) < config.NARROW_PHASE_MIN_BATCH:
+        return _find_snap_scalar(inspect_seg, candidates, end_order)
+    return _find_snap_array(inspect_seg, candidates, end_order)
+
+
+def _find_snap_scalar(inspect_seg: roads.Segment,
+                      candidates: List[roads.Segment],
+                      end_order: Callable[[roads.Segment], Any] = None
+                      ) -> Optional[Snap]:
+    snap = None
+    last_snap = SnapType.No
+    last_inter_factor = 1
+    last_ext_factor = 999
+    # end_order of the road the End snap is to, worked out when needed
+    end_key = None
+
+    for other_seg in candidates:
+        inter = inspect_seg.find_intersect(other_seg)
+
+        # Check for possible snaps based on the priorities of the
+        # various snap types.
+
+        # Check for intersections
+        if (last_snap <= SnapType.Cross
+                and inter is not None
+                and 0 < inter.main_factor < last_inter_factor):
+            last_inter_factor = inter.main_factor
+            last_snap = SnapType.Cross
+            snap = Snap(SnapType.Cross, other_seg, inter, False)
+        # Check for nearby road starts/ends
+        if last_snap <= SnapType.End:
+            if (vectors.distance(inspect_seg.end, other_seg.end)
+                    < config.SNAP_VERTEX_RADIUS):
+                at_start = False
+            elif (vectors.distance(inspect_seg.end, other_seg.start)
+                    < config.SNAP_VERTEX_RADIUS):
+                at_start = True
+            else:
+                at_start = None
+            if at_start is not None:
+                if end_order is not None and last_snap == SnapType.End:
+                    if end_key is None:
+                        end_key = end_order(snap.other)
+                    other_key = end_order(other_seg)
+                    if other_key > end_key:
+                        end_key = other_key
+                        snap = Snap(SnapType.End, other_seg, None, at_start)
+                else:
+                    snap = Snap(SnapType.End, other_seg, None, at_start)
+                    last_snap = SnapType.End
+        # Check if the seg can be extended to intersect with another road
+        if (last_snap <= SnapType.Extend
+                and inter is not None
+                and 1 < inter.main_factor < last_ext_factor
+                and vectors.distance(inspect_seg.end, inter.point)
+                < config.SNAP_EXTEND_RADIUS):
+            last_ext_factor = inter.main_factor
+            snap = Snap(SnapType.Extend, other_seg, inter, False)
+            last_snap = SnapType.Extend
+
+    return snap
+
+
+def _find_snap_array(inspect_seg: roads.Segment,
+                     candidates: List[roads.Segment],
+                     end_order: Callable[[roads.Segment], Any] = None
+                     ) -> Optional[Snap]:
+    """
+    Same as _find_snap_scalar, using the same float operations in the same
+    order on every candidate at once. Because a Cross always beats an End or
+    Extend, and an End always beats an Extend, the sequential scan reduces
+    to: the first nearest crossing, else the last road with a close end,
+    else the first nearest extension
+    """
+    count = len(candidates)
+    if count == 0:
+        return None
+
+    # Columns are start x, start y, end x, end y
+    coords = numpy.fromiter(
+        itertools.chain.from_iterable(other.start + other.end
+                                      for other in candidates),
+        numpy.float64, 4 * count).reshape(count, 4)
+    start_x, start_y = inspect_seg.start
+    end_x, end_y = inspect_seg.end
+    r = (end_x - start_x, end_y - start_y)
+
+    s_x = coords[:, 2] - coords[:, 0]
+    s_y = coords[:, 3] - coords[:, 1]
+    q_x = coords[:, 0] - start_x
+    q_y = coords[:, 1] - start_y
+
+    t_numerator = (q_x * s_y) - (q_y * s_x)
+    u_numerator = (q_x * r[1]) - (q_y * r[0])
+    denominator = (r[0] * s_y) - (r[1] * s_x)
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        main_factor = t_numerator / denominator
+        other_factor = u_numerator / denominator
+    intersects = (0 < other_factor) & (other_factor < 1)
+
+    # Crossings
+    crosses = intersects & (0 < main_factor) & (main_factor < 1)
+    if crosses.any():
+        best = int(numpy.argmin(numpy.where(crosses, main_factor, numpy.inf)))
+        other = candidates[best]
+        return Snap(SnapType.Cross, other, inspect_seg.find_intersect(other),
+                    False)
+
+    # Road ends, the last close one in the list or by end_order wins
+    squares = (coords - (end_x, end_y, end_x, end_y)) ** 2
+    near_start = _within(squares[:, 0] + squares[:, 1], inspect_seg.end,
+                         coords[:, 0:2], config.SNAP_VERTEX_RADIUS)
+    near_end = _within(squares[:, 2] + squares[:, 3], inspect_seg.end,
+                       coords[:, 2:4], config.SNAP_VERTEX_RADIUS)
+    near = near_end | near_start
+    if near.any():
+        close = numpy.flatnonzero(near).tolist()
+        if end_order is not None and len(close) > 1:
+            best = max(close, key=lambda i: end_order(candidates[i]))
+        else:
+            best = close[-1]
+        return Snap(SnapType.End, candidates[best], None,
+                    not bool(near_end[best]))
+
+    # Extensions
+    extends = intersects & (1 < main_factor) & (main_factor < 999)
+    if extends.any():
+        points = numpy.column_stack((start_x + (main_factor[extends] * r[0]),
+                                     start_y + (main_factor[extends] * r[1])))
+        squares = (points - inspect_seg.end) ** 2
+        extends[extends] = _within(squares[:, 0] + squares[:, 1],
+                                   inspect_seg.end, points,
+                                   config.SNAP_EXTEND_RADIUS)
+        if extends.any():
+            best = int(numpy.argmin(numpy.where(extends, main_factor,
+                                                numpy.inf)))
+            other = candidates[best]
+            return Snap(SnapType.Extend, other,
+                        inspect_seg.find_intersect(other), False)
+
+    return None
+
+
+def _within(squared_distances: numpy.ndarray, point: Tuple[float, float],
+            points: numpy.ndarray, radius: float) -> numpy.ndarray:
+    """
+    Gets which of points are closer than radius to point, giving the same
+    answer as comparing vectors.distance against radius
+    :param squared_distances: The squared distance of each of points to point
+    """
+    distances = numpy.sqrt(squared_distances)
+    within = distances < radius
+
+    borderline = numpy.abs(distances - radius) <= radius * _RADIUS_MARGIN
+    if borderline.any():
+        for i in numpy.flatnonzero(borderline).tolist():
+            within[i] = (vectors.distance(point, tuple(points[i]))
+                         < radius)
+
+    return within
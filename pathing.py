@@ -1,9 +1,18 @@
-from heapdict import heapdict
-from typing import List
+import collections
+import heapq
+import itertools
+import multiprocessing
+from typing import Dict, List, Optional, Tuple
 
+import numpy
+
+import config
 import roads
 import vectors
 
+# The adjacency of the city a distance_matrix worker process searches over
+_worker_adjacency: List[List[Tuple[int, int]]] = []
+
 
 class PathData:
     def __init__(self):
@@ -14,92 +23,286 @@ class PathData:
         self.length = 0
 
 
-def astar(data: PathData, all_roads: List[roads.Segment]):
-    data.searched = []
-    open_roads = heapdict()
-
-    dist_start = {}
-    dist_end = {}
-    prev_road = {}
-
-    for road in all_roads:
-        init_start = 9999999
-        init_end = 9999999
-
-        if road is data.start:
-            init_start = 0
-            init_end = heuristic(road, data.end)
-
-        dist_start[road] = init_start
-        dist_end[road] = init_end
-        prev_road[road] = None
+class Graph:
+    """
+    The roads each road connects to, along with the cost of moving onto them.
+    A road's neighbors are only looked up the first time a search expands it
+    and are kept for later searches, so a search never has to touch the roads
+    it doesn't reach
+    """
+    def __init__(self):
+        self._adjacency: Dict[roads.Segment, List[Tuple[roads.Segment, int]]] = {}
+
+    def neighbors(self, road: roads.Segment) -> List[Tuple[roads.Segment, int]]:
+        adjacent = self._adjacency.get(road)
+        if adjacent is None:
+            # Sorted so that ties between equal paths always break the same way
+            linked = sorted(road.links_s.union(road.links_e),
+                            key=lambda link: link.global_id)
+            adjacent = [(link, cost(link)) for link in linked]
+            self._adjacency[road] = adjacent
+        return adjacent
+
+    def precompute(self, all_roads: List[roads.Segment]):
+        """ Looks up the neighbors of every road ahead of any search """
+        for road in all_roads:
+            self.neighbors(road)
+
+
+def indexed_adjacency(all_roads: List[roads.Segment],
+                      graph: Optional[Graph] = None) -> List[List[Tuple[int, int]]]:
+    """
+    Gets the neighbors of every road as (index in all_roads, cost) pairs, for
+    searches that work on road indices instead of the roads themselves
+    """
+    if graph is None:
+        graph = Graph()
+    index_of = {road: i for i, road in enumerate(all_roads)}
+
+    return [[(index_of[link], link_cost) for link, link_cost
+             in graph.neighbors(road) if link in index_of]
+            for road in all_roads]
+
+
+def astar(data: PathData, all_roads: List[roads.Segment],
+          graph: Optional[Graph] = None):
+    """
+    Finds a path from data.start to data.end, guided towards data.end by the
+    heuristic. all_roads is kept for compatibility, only the roads the search
+    reaches are ever looked at
+    :param graph: Adjacency to search over, a new one is made if not given
+    """
+    _search(data, graph if graph is not None else Graph(), True)
+
+
+def dijkstra(data: PathData, all_roads: List[roads.Segment],
+             graph: Optional[Graph] = None):
+    """
+    Finds the shortest path from data.start to data.end. all_roads is kept
+    for compatibility, only the roads the search reaches are ever looked at
+    :param graph: Adjacency to search over, a new one is made if not given
+    """
+    _search(data, graph if graph is not None else Graph(), False)
+
+
+class ShortestPathTree:
+    """
+    A Dijkstra search out from one road that can be resumed, so every road it
+    has already reached can be routed to without searching again. Roads are
+    expanded in the same order dijkstra expands them
+    """
+    def __init__(self, source: roads.Segment):
+        self.source = source
+        self.dist = {source: 0}
+        self.prev_road = {source: None}
+        self.closed = set()
+        self._order = itertools.count()
+        self._open_roads = [(0, next(self._order), source)]
+
+    def search_to(self, target: roads.Segment, graph: Graph) -> List[roads.Segment]:
+        """
+        Expands the tree until target is reached or nothing is left to expand
+        :return: The roads expanded by this call
+        """
+        searched = []
+        while self._open_roads and target not in self.closed:
+            curr_dist, _, curr_min = heapq.heappop(self._open_roads)
+            if curr_min in self.closed:
+                continue
 
-    open_roads[data.start] = dist_end[data.start]
+            self.closed.add(curr_min)
+            searched.append(curr_min)
+
+            for road, road_cost in graph.neighbors(curr_min):
+                if road in self.closed:
+                    continue
+                new_dist = curr_dist + road_cost
+                if new_dist < self.dist.get(road, new_dist + 1):
+                    self.dist[road] = new_dist
+                    self.prev_road[road] = curr_min
+                    heapq.heappush(self._open_roads,
+                                   (new_dist, next(self._order), road))
+        return searched
+
+
+class RouteCache:
+    """
+    Answers dijkstra queries from the most recent results and shortest path
+    trees. Finished routes are kept in an LRU by (start, end), and the search
+    tree of each recent start road is kept so another end from the same start
+    only needs the tree walked or grown. Everything is dropped whenever
+    roads.topology_changed() has been called since it was cached
+    """
+    def __init__(self, max_routes: int = None, max_trees: int = None):
+        self.max_routes = (max_routes if max_routes is not None
+                           else config.ROUTE_CACHE_ROUTES)
+        self.max_trees = (max_trees if max_trees is not None
+                          else config.ROUTE_CACHE_TREES)
+        self.graph = Graph()
+        # (start, end) to (path, length), and start to ShortestPathTree, both
+        # with the least recently used first
+        self._routes = collections.OrderedDict()
+        self._trees = collections.OrderedDict()
+        self._version = roads.topology_version
+
+    def clear(self):
+        self.graph = Graph()
+        self._routes.clear()
+        self._trees.clear()
+        self._version = roads.topology_version
+
+    def route(self, data: PathData):
+        """
+        Finds the shortest path from data.start to data.end, the same as
+        dijkstra. data.searched only holds the roads this call had to expand
+        """
+        if self._version != roads.topology_version:
+            self.clear()
+
+        key = (data.start, data.end)
+        cached = self._routes.get(key)
+        if cached is not None:
+            self._routes.move_to_end(key)
+            data.searched = []
+        else:
+            tree = self._trees.get(data.start)
+            if tree is None:
+                tree = ShortestPathTree(data.start)
+                self._trees[data.start] = tree
+                if len(self._trees) > self.max_trees:
+                    self._trees.popitem(last=False)
+            else:
+                self._trees.move_to_end(data.start)
+
+            data.searched = tree.search_to(data.end, self.graph)
+            data.path = []
+            length = retrace_path(tree.prev_road, data)
+            cached = (data.path, length)
+            self._routes[key] = cached
+            if len(self._routes) > self.max_routes:
+                self._routes.popitem(last=False)
+
+        data.path = list(cached[0])
+        data.length = cached[1]
+
+
+def distance_matrix(sources: List[roads.Segment], targets: List[roads.Segment],
+                    all_roads: List[roads.Segment], workers: int = 0,
+                    graph: Optional[Graph] = None) -> numpy.ndarray:
+    """
+    Finds the path length from every source to every target, the same as
+    dijkstra would give for each pair, 0 where there is no path. Each source
+    gets one search that stops once every target has been reached
+    :param workers: Number of processes to spread the sources over, 0 or 1
+    searches in this process
+    :return: An int64 array with a row per source and a column per target
+    """
+    adjacency = indexed_adjacency(all_roads, graph)
+    index_of = {road: i for i, road in enumerate(all_roads)}
+    source_ids = [index_of[road] for road in sources]
+    target_ids = [index_of[road] for road in targets]
+
+    if workers <= 1 or len(sources) <= 1:
+        rows = [_distances_from(adjacency, source, target_ids)
+                for source in source_ids]
+    else:
+        # The adjacency is sent to each worker once, rather than with every
+        # source
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(workers, _init_matrix_worker, (adjacency,)) as pool:
+            rows = pool.starmap(_worker_distances_from,
+                                [(source, target_ids) for source in source_ids],
+                                chunksize=max(1, len(sources) // (workers * 4)))
+
+    matrix = numpy.array(rows, dtype=numpy.int64).reshape(len(sources),
+                                                          len(targets))
+    # Like dijkstra, a path's length includes the cost of its first road
+    start_costs = numpy.array([cost(road) for road in sources],
+                              dtype=numpy.int64).reshape(-1, 1)
+    return numpy.where(matrix >= 0, matrix + start_costs, 0)
+
+
+def _init_matrix_worker(adjacency: List[List[Tuple[int, int]]]):
+    global _worker_adjacency
+    _worker_adjacency = adjacency
+
+
+def _worker_distances_from(source: int, targets: List[int]) -> List[int]:
+    return _distances_from(_worker_adjacency, source, targets)
+
+
+def _distances_from(adjacency: List[List[Tuple[int, int]]], source: int,
+                    targets: List[int]) -> List[int]:
+    """
+    Finds the distance from source to each of targets by road index, -1 for
+    the ones that can't be reached
+    """
+    dist = {source: 0}
+    closed = set()
+    remaining = set(targets)
+    open_roads = [(0, source)]
+
+    while open_roads and remaining:
+        curr_dist, curr_min = heapq.heappop(open_roads)
+        if curr_min in closed:
+            continue
+        closed.add(curr_min)
+        remaining.discard(curr_min)
+
+        for road, road_cost in adjacency[curr_min]:
+            new_dist = curr_dist + road_cost
+            if road not in closed and new_dist < dist.get(road, new_dist + 1):
+                dist[road] = new_dist
+                heapq.heappush(open_roads, (new_dist, road))
+
+    return [dist[target] if target in closed else -1 for target in targets]
+
+
+def _search(data: PathData, graph: Graph, use_heuristic: bool):
+    data.searched = []
 
-    while len(open_roads):
-        curr_min = open_roads.popitem()[0]
-        if curr_min is data.end:
+    dist_start = {data.start: 0}
+    prev_road = {data.start: None}
+    closed = set()
+
+    # Entries are (priority, insertion order, road), the insertion order
+    # keeps roads themselves from ever being compared
+    order = itertools.count()
+    first_priority = heuristic(data.start, data.end) if use_heuristic else 0
+    open_roads = [(first_priority, next(order), data.start)]
+
+    while open_roads:
+        curr_min = heapq.heappop(open_roads)[2]
+        if curr_min in closed:
+            continue
+        if curr_min == data.end:
             break
 
+        closed.add(curr_min)
         data.searched.append(curr_min)
-        neighbors = curr_min.links_s.union(curr_min.links_e)
+        curr_dist = dist_start[curr_min]
 
-        for road in neighbors:
-            if road in data.searched:
+        for road, road_cost in graph.neighbors(curr_min):
+            if road in closed:
                 continue
 
-            new_dist_start = dist_start[curr_min] + cost(road)
-
-            if new_dist_start < dist_start[road]:
+            new_dist_start = curr_dist + road_cost
+            if new_dist_start < dist_start.get(road, new_dist_start + 1):
                 dist_start[road] = new_dist_start
-                dist_end[road] = new_dist_start + heuristic(road, data.end)
                 prev_road[road] = curr_min
-                if road not in open_roads:
-                    open_roads[road] = dist_end[road]
-
-    data.path = []
-    data.length = retrace_path(prev_road, data)
-    return
-
-
-def dijkstra(data: PathData, all_roads: List[roads.Segment]):
-    node_queue = heapdict()
-
-    dist_start = {}
-    prev_road = {}
-
-    data.searched = []
-
-    for road in all_roads:
-        dist_start[road] = 0 if road is data.start else 9999999
-        prev_road[road] = None
-        node_queue[road] = dist_start[road]
 
-    while not len(node_queue) == 0:
-        curr_min = node_queue.popitem()[0]
-
-        if curr_min is data.end:
-            break
-
-        neighbors = curr_min.links_s.union(curr_min.links_e)
-
-        for road in neighbors:
-            this_dist = dist_start[curr_min] + cost(road)
-            if this_dist < dist_start[road]:
-                data.searched.append(road)
-
-                dist_start[road] = this_dist
-                prev_road[road] = curr_min
-                node_queue[road] = this_dist
+                priority = new_dist_start
+                if use_heuristic:
+                    priority += heuristic(road, data.end)
+                heapq.heappush(open_roads, (priority, next(order), road))
 
     data.path = []
     data.length = retrace_path(prev_road, data)
-    return
 
 
 def retrace_path(previous_node, data) -> int:
     length = 0
-    if previous_node[data.end] is not None or data.end is data.start:
+    if data.end in previous_node:
         curr_node = data.end
         while curr_node is not None:
             data.path.append(curr_node)
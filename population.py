@@ -1,13 +1,41 @@
 from noise import snoise2
 from typing import Tuple
 import math
+import numpy
+import profiler
 import roads
 
+# Permutation and gradient tables of the simplex noise in the noise package,
+# used to evaluate the same noise over whole arrays of points at once
+_PERM = numpy.array([151, 160, 137, 91, 90, 15, 131, 13, 201, 95, 96, 53, 194,
+    233, 7, 225, 140, 36, 103, 30, 69, 142, 8, 99, 37, 240, 21, 10, 23, 190, 6,
+    148, 247, 120, 234, 75, 0, 26, 197, 62, 94, 252, 219, 203, 117, 35, 11, 32,
+    57, 177, 33, 88, 237, 149, 56, 87, 174, 20, 125, 136, 171, 168, 68, 175,
+    74, 165, 71, 134, 139, 48, 27, 166, 77, 146, 158, 231, 83, 111, 229, 122,
+    60, 211, 133, 230, 220, 105, 92, 41, 55, 46, 245, 40, 244, 102, 143, 54,
+    65, 25, 63, 161, 1, 216, 80, 73, 209, 76, 132, 187, 208, 89, 18, 169, 200,
+    196, 135, 130, 116, 188, 159, 86, 164, 100, 109, 198, 173, 186, 3, 64, 52,
+    217, 226, 250, 124, 123, 5, 202, 38, 147, 118, 126, 255, 82, 85, 212, 207,
+    206, 59, 227, 47, 16, 58, 17, 182, 189, 28, 42, 223, 183, 170, 213, 119,
+    248, 152, 2, 44, 154, 163, 70, 221, 153, 101, 155, 167, 43, 172, 9, 129,
+    22, 39, 253, 19, 98, 108, 110, 79, 113, 224, 232, 178, 185, 112, 104, 218,
+    246, 97, 228, 251, 34, 242, 193, 238, 210, 144, 12, 191, 179, 162, 241, 81,
+    51, 145, 235, 249, 14, 239, 107, 49, 192, 214, 31, 181, 199, 106, 157, 184,
+    84, 204, 176, 115, 121, 50, 45, 127, 4, 150, 254, 138, 236, 205, 93, 222,
+    114, 67, 29, 24, 72, 243, 141, 128, 195, 78, 66, 215, 61, 156, 180] * 2, dtype=numpy.int32)
+_GRAD3 = numpy.array([(1, 1), (-1, 1), (1, -1), (-1, -1),
+                      (1, 0), (-1, 0), (1, 0), (-1, 0),
+                      (0, 1), (0, -1), (0, 1), (0, -1)], dtype=numpy.float32)
+
+_F2 = numpy.float32(0.3660254037844386)
+_G2 = numpy.float32(0.21132486540518713)
+
 
 class Heatmap:
     def __init__(self, seed):
         self.seed = seed
 
+    @profiler.timed("heatmap.at_line")
     def at_line(self, seg: roads.Segment) -> float:
         return (self.at_point(seg.start) + self.at_point(seg.end)) / 2
 
@@ -20,3 +48,69 @@ class Heatmap:
         value3 = (snoise2((x/20000) + 1000, (y/20000) + 1000) + 1) / 2
 
         return math.pow(((value1 * value2) + value3), 2)
+
+    def at_lines(self, starts, ends) -> numpy.ndarray:
+        """
+        Gets the population of many lines at once, see at_points
+        :param starts: Array-like of shape (n, 2) of line start points
+        :param ends: Array-like of shape (n, 2) of line end points
+        :return: Array of shape (n,) with the population of each line
+        """
+        return (self.at_points(starts) + self.at_points(ends)) / 2
+
+    def at_points(self, points) -> numpy.ndarray:
+        """
+        Gets the population at many points at once. Each value is within
+        1e-12 of at_point for the same point: the noise is evaluated exactly
+        as snoise2 does, only the final square can differ in its last bit
+        :param points: Array-like of shape (n, 2) of points
+        :return: Array of shape (n,) with the population at each point
+        """
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+        x = points[:, 0] + self.seed[0]
+        y = points[:, 1] + self.seed[1]
+
+        value1 = (_snoise2(x/10000, y/10000) + 1) / 2
+        value2 = (_snoise2((x/20000) + 500, (y/20000) + 500) + 1) / 2
+        value3 = (_snoise2((x/20000) + 1000, (y/20000) + 1000) + 1) / 2
+
+        return ((value1 * value2) + value3) ** 2
+
+
+def _snoise2(x: numpy.ndarray, y: numpy.ndarray) -> numpy.ndarray:
+    """
+    Array version of noise.snoise2 with its default arguments. Follows the
+    float32 arithmetic of the C implementation step by step
+    """
+    x = x.astype(numpy.float32)
+    y = y.astype(numpy.float32)
+
+    s = (x + y) * _F2
+    i = numpy.floor(x + s)
+    j = numpy.floor(y + s)
+    t = (i + j) * _G2
+
+    xx0 = x - (i - t)
+    yy0 = y - (j - t)
+
+    i1 = (xx0 > yy0).astype(numpy.int32)
+    j1 = 1 - i1
+
+    xx1 = xx0 - i1.astype(numpy.float32) + _G2
+    yy1 = yy0 - j1.astype(numpy.float32) + _G2
+    xx2 = xx0 + _G2 * numpy.float32(2) - numpy.float32(1)
+    yy2 = yy0 + _G2 * numpy.float32(2) - numpy.float32(1)
+
+    big_i = i.astype(numpy.int32) & 255
+    big_j = j.astype(numpy.int32) & 255
+    gradients = (_PERM[big_i + _PERM[big_j]] % 12,
+                 _PERM[big_i + i1 + _PERM[big_j + j1]] % 12,
+                 _PERM[big_i + 1 + _PERM[big_j + 1]] % 12)
+
+    total = numpy.zeros_like(x)
+    for xx, yy, grad in zip((xx0, xx1, xx2), (yy0, yy1, yy2), gradients):
+        f = numpy.float32(0.5) - xx * xx - yy * yy
+        corner = f * f * f * f * (_GRAD3[grad, 0] * xx + _GRAD3[grad, 1] * yy)
+        total += numpy.where(f > 0, corner, numpy.float32(0))
+
+    return (total * numpy.float32(70)).astype(numpy.float64)
@@ -0,0 +1,219 @@
+import contextlib
+import functools
+import json
+from typing import Dict, List, Optional
+
+from Stopwatch import Stopwatch
+
+# The profiler timed sections are currently recorded to, None when off
+_active: Optional['Profiler'] = None
+
+# Call times are counted in buckets, each power of two split into this many,
+# so percentiles are within 1 / _SUB_BUCKETS of the true time whatever the
+# number of calls
+_SUB_BITS = 3
+_SUB_BUCKETS = 1 << _SUB_BITS
+
+
+class _Section:
+    __slots__ = ("name", "parent", "children", "watch", "histogram")
+
+    def __init__(self, name: str, parent: Optional['_Section']):
+        self.name = name
+        self.parent = parent
+        self.children: Dict[str, _Section] = {}
+        self.watch = Stopwatch()
+        # Number of calls in each bucket of call times, for percentiles
+        self.histogram: Dict[int, int] = {}
+
+    def self_ns(self) -> int:
+        return self.watch.passed_ns() - sum(child.watch.passed_ns()
+                                            for child in self.children.values())
+
+
+class Profiler:
+    """
+    Times named sections of code, nested by which section was running when
+    each one started. The same section called from different places is
+    timed separately for each place, like the frames of a flame graph
+    """
+    def __init__(self):
+        self.root = _Section("all", None)
+        self._current = self.root
+
+    def enter(self, name: str):
+        section = self._current.children.get(name)
+        if section is None:
+            section = _Section(name, self._current)
+            self._current.children[name] = section
+        self._current = section
+        section.watch.start()
+
+    def exit(self):
+        section = self._current
+        section.watch.stop()
+        bucket = _bucket(section.watch.last_ns)
+        section.histogram[bucket] = section.histogram.get(bucket, 0) + 1
+        self._current = section.parent
+
+    def report(self) -> dict:
+        """
+        Gets the timings as a tree of dicts, with the call count, total and
+        self time and percentiles of the call times of every section
+        """
+        return _report(self.root)["children"]
+
+    def collapsed(self) -> List[str]:
+        """
+        Gets the self time of every section in microseconds in the collapsed
+        stack format read by flamegraph.pl and speedscope
+        """
+        lines = []
+        sections = [(child, child.name) for child in self.root.children.values()]
+        while sections:
+            section, stack = sections.pop()
+            self_us = section.self_ns() // 1000
+            if self_us > 0:
+                lines.append("{} {}".format(stack, self_us))
+            sections.extend((child, stack + ";" + child.name)
+                            for child in section.children.values())
+        return sorted(lines)
+
+    def write_json(self, path: str):
+        with open(path, "w") as out_file:
+            json.dump(self.report(), out_file, indent=2)
+
+    def write_collapsed(self, path: str):
+        with open(path, "w") as out_file:
+            out_file.write("\n".join(self.collapsed()) + "\n")
+
+    def summary(self) -> str:
+        """ Gets the timings as an indented table """
+        lines = ["{:<40} {:>9} {:>11} {:>11} {:>9}".format(
+            "section", "calls", "total ms", "self ms", "p99 us")]
+
+        def add(entries: List[dict], depth: int):
+            for entry in entries:
+                lines.append("{:<40} {:>9} {:>11.2f} {:>11.2f} {:>9.1f}".format(
+                    "  " * depth + entry["name"], entry["calls"],
+                    entry["total_ms"], entry["self_ms"], entry["p99_us"]))
+                add(entry["children"], depth + 1)
+
+        add(self.report(), 0)
+        return "\n".join(lines)
+
+
+def _bucket(ns: int) -> int:
+    """
+    Gets the bucket of a call time. Times under 2 * _SUB_BUCKETS ns have a
+    bucket each, longer ones share a bucket with the times that have the
+    same highest _SUB_BITS + 1 bits
+    """
+    shift = ns.bit_length() - _SUB_BITS - 1
+    if shift <= 0:
+        return ns
+    return shift * _SUB_BUCKETS + (ns >> shift)
+
+
+def _bucket_ns(bucket: int) -> float:
+    """ Gets the middle of the call times in a bucket """
+    if bucket < 2 * _SUB_BUCKETS:
+        return float(bucket)
+    shift = bucket // _SUB_BUCKETS - 1
+    top = bucket % _SUB_BUCKETS + _SUB_BUCKETS
+    return (top + 0.5) * (1 << shift)
+
+
+def _percentiles(histogram: Dict[int, int],
+                 fractions: List[float]) -> List[float]:
+    """ Gets the call times in ns that the fractions of calls are within """
+    total = sum(histogram.values())
+    if total == 0:
+        return [0.0] * len(fractions)
+    times = []
+    buckets = iter(sorted(histogram.items()))
+    bucket, count = next(buckets)
+    seen = count
+    for fraction in sorted(fractions):
+        while seen < fraction * total:
+            bucket, count = next(buckets)
+            seen += count
+        times.append(_bucket_ns(bucket))
+    return times
+
+
+def _report(section: _Section) -> dict:
+    p50, p90, p99 = (ns / 1000 for ns in _percentiles(section.histogram,
+                                                     [0.5, 0.9, 0.99]))
+
+    return {"name": section.name,
+            "calls": section.watch.num_runs,
+            "total_ms": section.watch.passed_ms(),
+            "self_ms": section.self_ns() / 1000000,
+            "p50_us": p50,
+            "p90_us": p90,
+            "p99_us": p99,
+            "children": sorted((_report(child)
+                                for child in section.children.values()),
+                               key=lambda entry: -entry["total_ms"])}
+
+
+def enable(profiler: Profiler = None) -> Profiler:
+    """ Starts recording timed sections, to a new profiler if none is given """
+    global _active
+    _active = profiler if profiler is not None else Profiler()
+    return _active
+
+
+def disable() -> Optional[Profiler]:
+    """ Stops recording timed sections, returning the profiler they went to """
+    global _active
+    profiler = _active
+    _active = None
+    return profiler
+
+
+@contextlib.contextmanager
+def profiling(profiler: Profiler = None):
+    """ Records timed sections within the with block """
+    global _active
+    previous = _active
+    profiler = enable(profiler)
+    try:
+        yield profiler
+    finally:
+        _active = previous
+
+
+@contextlib.contextmanager
+def section(name: str):
+    """ Times the with block as a section, when profiling is on """
+    profiler = _active
+    if profiler is None:
+        yield
+        return
+    profiler.enter(name)
+    try:
+        yield
+    finally:
+        profiler.exit()
+
+
+def timed(name: str):
+    """
+    Decorates a function so each call is timed as a section. When profiling
+    is off this costs one check of a global per call
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _active
+            if profiler is None:
+                return func(*args, **kwargs)
+            profiler.enter(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.exit()
+        return wrapper
+    return decorate
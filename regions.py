@@ -0,0 +1,760 @@
+import itertools
+import math
+import multiprocessing
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy
+
+import config
+import generation
+import population
+import profiler
+import road_store
+import roads
+import spatial
+import streams
+from SnapType import SnapType
+from Stopwatch import Stopwatch
+
+Region = Tuple[int, int]
+# A road sent between processes: global id, place in the order roads were
+# added, start, end, start when it was added, is_highway, is_branch,
+# has_snapped, t, parent id (-1 for none) and the ids of the roads linked at
+# its start and at its end
+Record = tuple
+# A road waiting to be placed: global id, start, end, is_highway, is_branch,
+# t and parent id
+Pending = tuple
+# Everything placing a region's roads for a round needs: the region, the
+# roads waiting in it, the first global id and place in the order it can
+# give out, and the t roads have to be under to be placed this round
+Task = Tuple[Region, List[Pending], int, int]
+# What placing a region's roads for a round tells the main process: the
+# number of roads placed and the roads waiting to be placed in other regions
+# or rounds
+Result = Tuple[int, List[Pending]]
+
+# Regions are placed in four phases, so regions placing roads at the same
+# time are never next to each other
+_PHASES = [(0, 0), (1, 0), (0, 1), (1, 1)]
+# The snaps moving the end of a road to a point it wasn't checked at
+_MOVED_END = (SnapType.End, SnapType.CrossTooClose)
+_SNAP_TYPES = {int(snap_type): snap_type for snap_type in SnapType}
+# Each task gives out global ids and places in the order from its own block
+# of this size, so neither depends on which process placed the roads
+_ID_BLOCK = 1 << 20
+
+watch_total = Stopwatch()
+
+
+def generate(manual_seed: int = None, workers: int = 1) -> generation.City:
+    """
+    Generates a City with the given seed, or a random seed, placing the
+    roads of different regions in worker processes. The city only depends
+    on the seed and the config, not on the number of workers, though it is
+    a different city to the one generation.generate() gives for the seed.
+    With more than one worker, the city is packed and read-only, like one
+    city_file.load() gives
+    :param workers: Processes to place roads in, 1 to place them here
+    """
+    watch_total.reset()
+    watch_total.start()
+
+    with profiler.section("generate"):
+        with RegionGenerator(manual_seed, workers) as generator:
+            print("Generating {} segments with seed: {} in {} processes"
+                  .format(config.MAX_SEGS, generator.seed, workers))
+            generator.run_until(config.MAX_SEGS)
+            city = generator.city
+        # Ids come from the blocks of the tasks, so give them out again in
+        # the order the roads were added
+        if isinstance(city.roads, road_store.RoadList):
+            city.roads.store.global_ids[:] = numpy.arange(len(city.roads))
+        else:
+            for global_id, road in enumerate(city.roads):
+                road.global_id = global_id
+
+    watch_total.stop()
+    print("Time spent (ms): {}".format(watch_total.passed_ms()))
+
+    return city
+
+
+class RegionGenerator:
+    """
+    A city generated a region at a time. The world is split into square
+    regions of config.REGION_SECTORS sectors a side, and roads are placed in
+    rounds covering config.REGION_ROUND_TIME values of t. In each round the
+    regions take turns in four phases, a checkerboard of every other row and
+    column at a time, and each region with roads waiting places them in order
+    of t, along with the roads following on from them that start in the
+    region during the round. Roads following on into another region wait for
+    its turn. Once a region's roads are placed, any of them crossing another
+    road are joined to it where they cross, as roads meeting across a region
+    border are never snapped to each other.
+
+    Placing a road reads and changes roads up to halo_distance() outside its
+    region, and regions in the same phase are far enough apart that those
+    halos never meet, so the regions of a phase are placed independently, in
+    separate processes. Each worker keeps the roads of the regions it places
+    and a halo ring of sectors around them, and sends the roads it places or
+    changes straight to the workers with them in a region or halo. This
+    process only hands out the tasks and keeps the roads waiting in each
+    region, and puts the whole city together from the workers when it is
+    asked for.
+
+    Random numbers always come from streams.SegmentRandom, so the roads
+    following on from a road don't depend on the process placing them
+    """
+    def __init__(self, manual_seed: int = None, workers: int = 1):
+        check_config()
+        if manual_seed is not None:
+            self.seed = manual_seed
+        elif config.ROAD_SEED != 0:
+            self.seed = config.ROAD_SEED
+        else:
+            self.seed = random.SystemRandom().randrange(1, 1 << 32)
+        # The same heatmap as generation.Generator gives for the seed
+        seeded = random.Random(self.seed)
+        self._pop_seed = (seeded.randrange(-1, 1) * 1000000000,
+                          seeded.randrange(-1, 1) * 1000000000)
+
+        # Roads are placed in worker processes, or with one worker here in
+        # the city itself
+        self._workers = None
+        self._replica = None
+        if workers > 1:
+            self._workers = _Workers(self.seed, self._pop_seed, workers)
+        else:
+            self._replica = _Replica(self.seed, self._pop_seed)
+        # The city put together from the workers, until they place more
+        self._city: Optional[generation.City] = None
+        self._placed = 0
+
+        # The roads waiting in each region, each with its t and the order it
+        # was queued in
+        self._pending: Dict[Region, List[Tuple[int, int, Pending]]] = {}
+        self._queued = itertools.count()
+        self._next_block = 1
+        # CPU seconds spent in each phase by this process and by the busiest
+        # worker, and the same for the last time the city was put together,
+        # see critical_path()
+        self.phase_times: List[Tuple[float, float]] = []
+        self.collect_time: Tuple[float, float] = (0.0, 0.0)
+
+        first = (0, (0, 0), (config.HIGHWAY_LENGTH, 0), True, False, 0, -1)
+        self._queue(first)
+        roads.topology_changed()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """ Stops the worker processes """
+        if self._workers is not None:
+            self._workers.close()
+            self._workers = None
+
+    @property
+    def city(self) -> generation.City:
+        """
+        The roads placed so far. With workers, the roads they place are
+        packed into a read-only city like city_file.load() gives, so it has
+        to be read before close()
+        """
+        if self._replica is not None:
+            return self._replica.city
+        if self._city is None:
+            if self._workers is None:
+                raise RuntimeError("The workers were closed before the city "
+                                   "was put together")
+            start = time.process_time()
+            with profiler.section("regions.collect"):
+                parts, busiest = self._workers.collect(len(self.phase_times))
+                self._city = _packed_city(parts, self.seed, self._pop_seed)
+            self.collect_time = (time.process_time() - start, busiest)
+        return self._city
+
+    def is_done(self) -> bool:
+        """ Whether there are no roads left that could be placed """
+        return not self._pending
+
+    def run_until(self, max_segs: int) -> int:
+        """
+        Generates until the city has more than max_segs roads. It is only
+        checked after each phase, so the city can end up with a phase's
+        worth of roads more than that
+        :return: The number of roads added to the city
+        """
+        added = self._placed
+        while self._pending and self._placed <= max_segs:
+            round_end = (min(t for waiting in self._pending.values()
+                             for t, _, _ in waiting)
+                         + config.REGION_ROUND_TIME)
+            for phase in _PHASES:
+                self._run_phase(phase, round_end)
+                if self._placed > max_segs:
+                    break
+        return self._placed - added
+
+    def critical_path(self) -> float:
+        """
+        Gets the CPU seconds generation would have taken so far with every
+        worker on its own core: this process's time in each phase and the
+        busiest worker's, then the same for putting the city together
+        """
+        return (sum(own + busiest for own, busiest in self.phase_times)
+                + sum(self.collect_time))
+
+    def _run_phase(self, phase: Tuple[int, int], round_end: int):
+        own_start = time.process_time()
+        tasks = []
+        for region in sorted(self._pending):
+            if (region[0] % 2, region[1] % 2) != phase:
+                continue
+            waiting = self._pending[region]
+            due = [pending for t, _, pending in sorted(waiting)
+                   if t < round_end]
+            if not due:
+                continue
+            waiting[:] = [entry for entry in waiting if entry[0] >= round_end]
+            if not waiting:
+                del self._pending[region]
+            tasks.append((region, due, self._next_block * _ID_BLOCK,
+                          round_end))
+            self._next_block += 1
+        if not tasks:
+            return
+
+        if self._replica is not None:
+            results = []
+            for task in tasks:
+                placed, leaving = self._replica.run(*task)
+                results.append((len(placed), leaving))
+            busiest = 0.0
+        else:
+            results, busiest = self._workers.run(len(self.phase_times), tasks)
+            self._city = None
+
+        for placed, leaving in results:
+            self._placed += placed
+            for pending in leaving:
+                self._queue(pending)
+        self.phase_times.append((time.process_time() - own_start, busiest))
+
+    def _queue(self, pending: Pending):
+        self._pending.setdefault(region_of(pending[1]), []).append(
+            (pending[5], next(self._queued), pending))
+
+
+class _Replica:
+    """
+    The roads one process knows about: every road when roads are placed in
+    the main process, and in a worker the roads in or near the regions it
+    places. Roads outside those that known roads link to are stand-ins
+    without their ends set, which are never looked at
+    """
+    def __init__(self, seed: int, pop_seed: Tuple[int, int]):
+        self.city = generation.City([], spatial.QuadTree(),
+                                    population.Heatmap(pop_seed), seed)
+        self.rng = streams.SegmentRandom(seed)
+        self._by_id: Dict[int, roads.Segment] = {}
+
+    def run(self, region: Region, due: List[Pending], first_id: int,
+            round_end: int) -> Tuple[List[roads.Segment], List[Pending]]:
+        """
+        Places the roads waiting in a region and the roads following on from
+        them in it, until they reach round_end, then joins them to any roads
+        they cross. The roads placed take their places in the order of the
+        whole city from first_id on
+        :return: The roads placed, and the roads waiting to be placed in
+            other regions or rounds
+        """
+        region_queue = _RegionQueue(region, round_end)
+        seg_id = roads.Segment.seg_id
+        try:
+            for pending in due:
+                region_queue.push(self._pending_segment(pending))
+
+            placed_from = len(self.city.roads)
+            roads.Segment.seg_id = first_id
+            while not region_queue.is_empty():
+                generation.place_next(self.city, region_queue, rng=self.rng)
+            self._join_crossings(self.city.roads[placed_from:])
+            if roads.Segment.seg_id - first_id > _ID_BLOCK:
+                raise RuntimeError("Region {} made more than {} roads in a round"
+                                   .format(region, _ID_BLOCK))
+        finally:
+            roads.Segment.seg_id = seg_id
+
+        placed = self.city.roads[placed_from:]
+        for i, seg in enumerate(placed):
+            self._by_id[seg.global_id] = seg
+            self.city.sectors.reorder(seg, first_id + i)
+        leaving = [(seg.global_id, seg.start, seg.end, seg.is_highway,
+                    seg.is_branch, seg.t,
+                    seg.parent.global_id if seg.parent is not None else -1)
+                   for seg in region_queue.leaving]
+        return placed, leaving
+
+    def changed(self, placed: List[roads.Segment]) -> List[roads.Segment]:
+        """ Gets the roads placed by run() and the roads they changed """
+        placed_set = set(placed)
+        changed = {}
+        for seg in placed:
+            for other in itertools.chain(seg.links_s, seg.links_e):
+                if other not in placed_set:
+                    changed[other.global_id] = other
+        return placed + [seg for _, seg in sorted(changed.items())]
+
+    def apply(self, records: List[Record]):
+        """ Adds or updates the given roads """
+        seg_id = roads.Segment.seg_id
+        sectors = self.city.sectors
+        # Most roads are known already, so they are looked up before calling
+        # _segment() to make stand-ins
+        known = self._by_id.get
+        segment = self._segment
+        for record in records:
+            (global_id, order, start, end, added_start, is_highway, is_branch,
+             has_snapped, t, parent_id, links_s, links_e) = record
+            seg = segment(global_id)
+            seg.start = start
+            seg.end = end
+            seg.is_highway = is_highway
+            seg.is_branch = is_branch
+            seg.has_snapped = _SNAP_TYPES[has_snapped]
+            seg.t = t
+            seg.parent = (known(parent_id) or segment(parent_id)
+                          if parent_id >= 0 else None)
+            seg.links_s = {known(link) or segment(link) for link in links_s}
+            seg.links_e = {known(link) or segment(link) for link in links_e}
+            seg.connected = True
+
+            if seg in sectors:
+                sectors.move(seg)
+                sectors.reorder(seg, order)
+            else:
+                sectors.add(seg, order, added_start)
+                self.city.roads.append(seg)
+        roads.Segment.seg_id = seg_id
+        roads.topology_changed()
+
+    def pack(self, worker: int, count: int) -> Dict[str, numpy.ndarray]:
+        """
+        Packs the roads ending in the regions a worker of count places into
+        the arrays of a RoadStore, with the roads referred to by global id
+        and with their places in the order. Every change to a road is sent
+        to that worker, so its copy is up to date
+        """
+        home = [seg for seg in self.city.roads
+                if owner(region_of(seg.end), count) == worker]
+        order_of = self.city.sectors.order_of
+        links_s_offsets, links_s = _csr([link.global_id for link in seg.links_s]
+                                        for seg in home)
+        links_e_offsets, links_e = _csr([link.global_id for link in seg.links_e]
+                                        for seg in home)
+        return {
+            "orders": numpy.array([order_of(seg) for seg in home],
+                                  dtype=numpy.int64),
+            "coords": numpy.array([(seg.start[0], seg.start[1],
+                                    seg.end[0], seg.end[1]) for seg in home],
+                                  dtype=numpy.float64).reshape(-1, 4),
+            "flags": numpy.array(
+                [(road_store.HIGHWAY if seg.is_highway else 0)
+                 | (road_store.BRANCH if seg.is_branch else 0)
+                 for seg in home], dtype=numpy.uint8),
+            "snaps": numpy.array([seg.has_snapped for seg in home],
+                                 dtype=numpy.uint8),
+            "times": numpy.array([seg.t for seg in home], dtype=numpy.int32),
+            "parents": numpy.array(
+                [seg.parent.global_id if seg.parent is not None else -1
+                 for seg in home], dtype=numpy.int64),
+            "global_ids": numpy.array([seg.global_id for seg in home],
+                                      dtype=numpy.int64),
+            "links_s_offsets": links_s_offsets, "links_s": links_s,
+            "links_e_offsets": links_e_offsets, "links_e": links_e}
+
+    def _join_crossings(self, placed: List[roads.Segment]):
+        """
+        Joins the roads placed to the roads they cross without a junction,
+        splitting both where they cross. Only roads whose end was moved to
+        the end of another road are checked, as the rest had every road they
+        cross snapped to when they were placed. The roads crossed are taken
+        in order of global id, so the roads made don't depend on how the
+        spatial index is laid out
+        """
+        to_check = [road for road in placed
+                    if road.has_snapped in _MOVED_END]
+        while to_check:
+            road = to_check.pop()
+            for other in sorted(self.city.sectors.near_seg(road, 0),
+                                key=lambda seg: seg.global_id):
+                if other is road:
+                    continue
+                crossing = road.find_intersect(other)
+                if (crossing is not None
+                        and 0 < round(crossing.main_factor, 5) < 1
+                        and 0 < round(crossing.other_factor, 5) < 1):
+                    half = _join(road, other, crossing.point, self.city)
+                    # Both parts of road could cross other roads still
+                    to_check += [road, half]
+                    break
+
+    def _segment(self, global_id: int) -> roads.Segment:
+        """ Gets the road with a global id, making a stand-in if it's new """
+        seg = self._by_id.get(global_id)
+        if seg is None:
+            seg = roads.Segment((0.0, 0.0), (0.0, 0.0), False)
+            seg.global_id = global_id
+            self._by_id[global_id] = seg
+        return seg
+
+    def _pending_segment(self, pending: Pending) -> roads.Segment:
+        global_id, start, end, is_highway, is_branch, t, parent_id = pending
+        seg = roads.Segment(start, end, is_highway, t)
+        seg.global_id = global_id
+        seg.is_branch = is_branch
+        if parent_id >= 0:
+            seg.parent = self._by_id[parent_id]
+        return seg
+
+    def record(self, seg: roads.Segment) -> Record:
+        return (seg.global_id, self.city.sectors.order_of(seg), seg.start,
+                seg.end, self.city.sectors.added_start(seg), seg.is_highway,
+                seg.is_branch, int(seg.has_snapped), seg.t,
+                seg.parent.global_id if seg.parent is not None else -1,
+                tuple(link.global_id for link in seg.links_s),
+                tuple(link.global_id for link in seg.links_e))
+
+
+class _RegionQueue:
+    """
+    The queue of a region's task. Roads starting outside the region, or due
+    after the round, are kept aside to go back to the main process
+    """
+    def __init__(self, region: Region, round_end: int):
+        self.region = region
+        self.round_end = round_end
+        self.leaving: List[roads.Segment] = []
+        self._queue = roads.new_queue()
+
+    def push(self, segment: roads.Segment):
+        if (segment.t < self.round_end
+                and region_of(segment.start) == self.region):
+            self._queue.push(segment)
+        else:
+            self.leaving.append(segment)
+
+    def pop(self) -> roads.Segment:
+        return self._queue.pop()
+
+    def is_empty(self):
+        return self._queue.is_empty()
+
+
+class _Workers:
+    """
+    Worker processes, each placing the roads of the regions it owns. Which
+    worker owns a region only changes how fast generation is, not the city
+    """
+    def __init__(self, seed: int, pop_seed: Tuple[int, int], count: int):
+        # Workers are spawned, so they are given the config of this process
+        settings = {name: value for name, value in vars(config).items()
+                    if name.isupper()}
+        context = multiprocessing.get_context("spawn")
+        # The workers send each other the roads they place through these,
+        # one for each worker to read
+        self._inboxes = [context.Queue() for _ in range(count)]
+        self._connections = []
+        self._processes = []
+        for index in range(count):
+            connection, worker_end = context.Pipe()
+            process = context.Process(
+                target=_work,
+                args=(worker_end, index, self._inboxes, seed, pop_seed,
+                      settings),
+                daemon=True)
+            process.start()
+            worker_end.close()
+            self._connections.append(connection)
+            self._processes.append(process)
+        # The number of messages sent to each worker that it hasn't been
+        # told to read yet
+        self._unread = [0] * count
+
+    def run(self, phase: int, tasks: List[Task]) -> Tuple[List[Result], float]:
+        """
+        Runs each task on the worker owning its region
+        :param phase: The number of the phase, counting every phase run
+        :return: The result of each task, in the order given, and the most
+            CPU seconds a worker spent
+        """
+        count = len(self._connections)
+        running = [[] for _ in range(count)]
+        for i, task in enumerate(tasks):
+            running[owner(task[0], count)].append(i)
+
+        for worker, indices in enumerate(running):
+            if indices:
+                self._send(worker, "run", phase, [tasks[i] for i in indices])
+
+        results: List[Optional[Result]] = [None] * len(tasks)
+        busiest = 0.0
+        for worker, indices in enumerate(running):
+            if indices:
+                worker_results, sent_to, seconds = (
+                    self._connections[worker].recv())
+                busiest = max(busiest, seconds)
+                for other in sent_to:
+                    self._unread[other] += 1
+                for i, result in zip(indices, worker_results):
+                    results[i] = result
+        return results, busiest
+
+    def collect(self, phase: int) -> Tuple[List[Dict[str, numpy.ndarray]],
+                                           float]:
+        """
+        Gets every road from the worker owning the region it ends in
+        :param phase: The number of the next phase
+        :return: The roads packed by each worker, see _Replica.pack(), and
+            the most CPU seconds a worker spent
+        """
+        for worker in range(len(self._connections)):
+            self._send(worker, "collect", phase, None)
+        parts = []
+        busiest = 0.0
+        for connection in self._connections:
+            part, seconds = connection.recv()
+            parts.append(part)
+            busiest = max(busiest, seconds)
+        return parts, busiest
+
+    def close(self):
+        for connection in self._connections:
+            connection.send(None)
+            connection.close()
+        for process in self._processes:
+            process.join()
+
+    def _send(self, worker: int, kind: str, phase: int,
+              tasks: Optional[List[Task]]):
+        self._connections[worker].send(
+            (kind, phase, self._unread[worker], tasks))
+        self._unread[worker] = 0
+
+
+def _work(connection, index: int, inboxes: list, seed: int,
+          pop_seed: Tuple[int, int], settings: Dict[str, object]):
+    """
+    Runs the tasks sent to a worker process until it is sent None. Before
+    each phase it reads the roads the other workers have sent it, and after
+    placing its regions it sends the roads it placed or changed to the
+    workers with them in a region or halo
+    """
+    for name, value in settings.items():
+        setattr(config, name, value)
+    replica = _Replica(seed, pop_seed)
+    sectors = replica.city.sectors
+    count = len(inboxes)
+    # Workers own blocks of four regions, one of each phase
+    block_size = 2 * region_size()
+    halo = halo_distance()
+    # Messages from phases not finished yet, read while waiting for others
+    early = []
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        kind, phase, unread, tasks = message
+        start = time.process_time()
+
+        received = [entry for entry in early if entry[0] < phase]
+        early = [entry for entry in early if entry[0] >= phase]
+        while len(received) < unread:
+            entry = inboxes[index].get()
+            (received if entry[0] < phase else early).append(entry)
+        # The roads of a phase are applied in their order, after the roads of
+        # the phases before
+        received.sort(key=lambda entry: entry[:2])
+        for _, entries in itertools.groupby(received, lambda entry: entry[0]):
+            replica.apply(sorted(
+                (record for entry in entries for record in entry[2]),
+                key=lambda record: record[1]))
+
+        if kind == "collect":
+            connection.send((replica.pack(index, count),
+                             time.process_time() - start))
+            continue
+
+        results = []
+        outgoing = [[] for _ in range(count)]
+        for task in tasks:
+            placed, leaving = replica.run(*task)
+            results.append((len(placed), leaving))
+            for seg in replica.changed(placed):
+                x0, y0, x1, y1 = _box(sectors.added_start(seg), seg.end)
+                owners = {_block_owner(i, j, count)
+                          for i in range(math.floor((x0 - halo) / block_size),
+                                         math.floor((x1 + halo) / block_size)
+                                         + 1)
+                          for j in range(math.floor((y0 - halo) / block_size),
+                                         math.floor((y1 + halo) / block_size)
+                                         + 1)}
+                owners.discard(index)
+                if owners:
+                    record = replica.record(seg)
+                    for worker in owners:
+                        outgoing[worker].append(record)
+        sent_to = []
+        for worker, records in enumerate(outgoing):
+            if records:
+                inboxes[worker].put((phase, index, records))
+                sent_to.append(worker)
+        connection.send((results, sent_to, time.process_time() - start))
+
+    # Messages left in the inboxes when generation stops are never read
+    for inbox in inboxes:
+        inbox.cancel_join_thread()
+    connection.close()
+
+
+def owner(region: Region, count: int) -> int:
+    """
+    Gets which of count workers places a region. Regions of the same phase
+    near each other go to different workers
+    """
+    return _block_owner(region[0] // 2, region[1] // 2, count)
+
+
+def _block_owner(column: int, row: int, count: int) -> int:
+    """ Gets which of count workers places a block of four regions """
+    return (column + row * math.ceil(math.sqrt(count))) % count
+
+
+def region_size() -> float:
+    return config.REGION_SECTORS * config.SECTOR_SIZE
+
+
+def region_of(point: Tuple[float, float]) -> Region:
+    """ Gets the region a point is in """
+    size = region_size()
+    return math.floor(point[0] / size), math.floor(point[1] / size)
+
+
+def halo_sectors() -> int:
+    """
+    Gets how many sectors around a region its roads can reach. A road placed
+    in a region ends at most a road and an extension snap outside it, snaps
+    to roads within snapping distance of that, and changes the links of the
+    roads sharing an end with those
+    """
+    reach = (2 * max(config.HIGHWAY_LENGTH, config.STREET_LENGTH)
+             + config.SNAP_EXTEND_RADIUS + spatial.snap_distance())
+    return math.ceil(reach / config.SECTOR_SIZE)
+
+
+def halo_distance() -> float:
+    return halo_sectors() * config.SECTOR_SIZE
+
+
+def check_config():
+    """
+    Raises a ValueError if regions are too small for the regions of a phase
+    to be placed independently. Between two of them is a whole region, which
+    has to be wider than both of their halos and a road touching both
+    """
+    needed = (2 * halo_distance()
+              + max(config.HIGHWAY_LENGTH, config.STREET_LENGTH))
+    if region_size() <= needed:
+        raise ValueError("REGION_SECTORS is {} but has to be more than {}"
+                         .format(config.REGION_SECTORS,
+                                 needed / config.SECTOR_SIZE))
+
+
+def _join(road: roads.Segment, other: roads.Segment,
+          point: Tuple[float, float], city: generation.City) -> roads.Segment:
+    """
+    Joins two roads crossing at a point, splitting both there and linking
+    the four parts to each other
+    :return: The new part of road, from its old start to the point
+    """
+    road_half = generation.split_road(road, point, city)
+    other_half = generation.split_road(other, point, city)
+    parts = (road_half, other_half, road, other)
+    for half in (road_half, other_half):
+        half.links_e.update(part for part in parts if part is not half)
+    for rest in (road, other):
+        rest.links_s.update(part for part in parts if part is not rest)
+    roads.topology_changed()
+    return road_half
+
+
+def _packed_city(parts: List[Dict[str, numpy.ndarray]], seed: int,
+                 pop_seed: Tuple[int, int]) -> generation.City:
+    """
+    Puts the roads packed by the workers together into one RoadStore, in the
+    order they were added, and indexes them in a PackedQuadTree
+    """
+    joined = {name: numpy.concatenate([part[name] for part in parts])
+              for name in ("orders", "coords", "flags", "snaps", "times",
+                           "parents", "global_ids")}
+    order = numpy.argsort(joined["orders"], kind="stable")
+    global_ids = joined["global_ids"][order]
+    by_id = numpy.argsort(global_ids)
+    sorted_ids = global_ids[by_id]
+
+    def index_of(ids: numpy.ndarray) -> numpy.ndarray:
+        return by_id[numpy.searchsorted(sorted_ids, ids)]
+
+    parents = joined["parents"][order]
+    parents = numpy.where(parents >= 0, index_of(parents), -1)
+    links = []
+    for name in ("links_s", "links_e"):
+        # The rows of each part follow on from those of the parts before
+        values = numpy.concatenate([part[name] for part in parts])
+        bases = numpy.cumsum([0] + [len(part[name]) for part in parts[:-1]])
+        starts = numpy.concatenate(
+            [part[name + "_offsets"][:-1] + base
+             for part, base in zip(parts, bases)])[order]
+        lengths = numpy.concatenate(
+            [numpy.diff(part[name + "_offsets"]) for part in parts])[order]
+        offsets = numpy.zeros(len(order) + 1, dtype=numpy.int32)
+        numpy.cumsum(lengths, out=offsets[1:])
+        values = index_of(values[numpy.repeat(starts - offsets[:-1], lengths)
+                                 + numpy.arange(offsets[-1])])
+        # Sorted within each row, as RoadStore.from_segments() does
+        rows = numpy.repeat(numpy.arange(len(order)), lengths)
+        links += [offsets, values[numpy.lexsort((values, rows))]
+                  .astype(numpy.int32)]
+
+    store = road_store.RoadStore(
+        joined["coords"][order], joined["flags"][order],
+        joined["snaps"][order], joined["times"][order],
+        parents.astype(numpy.int32), global_ids, *links)
+    city_roads = road_store.RoadList(store)
+    return generation.City(city_roads,
+                           spatial.PackedQuadTree.build(city_roads, store.coords),
+                           population.Heatmap(pop_seed), seed)
+
+
+def _csr(rows) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """ Packs rows of ids into the offsets and values of a RoadStore """
+    offsets = [0]
+    values = []
+    for row in rows:
+        values += row
+        offsets.append(len(values))
+    return (numpy.array(offsets, dtype=numpy.int32),
+            numpy.array(values, dtype=numpy.int64))
+
+
+def _box(start: Tuple[float, float],
+         end: Tuple[float, float]) -> spatial.BoundingBox:
+    return (min(start[0], end[0]), min(start[1], end[1]),
+            max(start[0], end[0]), max(start[1], end[1]))
@@ -0,0 +1,156 @@
+import argparse
+import time
+from typing import Dict
+
+import city_file
+import config
+import event_log
+import generation
+import narrow_phase
+import population
+import roads
+import spatial
+from SnapType import SnapType
+
+
+class Replayer:
+    """
+    Builds a city again from an event log, a popped road at a time, making
+    the same changes to the city that generation made but taking every
+    decision from the log. Replayed to the end, or to any number of pops,
+    the city is the same as the generated one was at that point.
+    The spatial index is built with the current config, which should match
+    the config in the log's header for the index to be the same too
+    """
+    def __init__(self, log: event_log.EventLog):
+        self.log = log
+        self.city = generation.City(
+            [], spatial.QuadTree(),
+            population.Heatmap(tuple(log.header["pop_seed"])),
+            log.header["seed"])
+        # Roads that have been pushed, by id
+        self.roads: Dict[int, roads.Segment] = {}
+        # Roads popped so far
+        self.pops = 0
+        self._offset = 0
+
+    def is_done(self) -> bool:
+        return self._offset >= len(self.log)
+
+    def step(self, count: int = 1) -> int:
+        """
+        Replays the next count popped roads
+        :return: The number of roads added to the city
+        """
+        added = len(self.city.roads)
+        # Split halves are given their logged ids by the global counter, so
+        # leave it as it was for whatever else is using it
+        seg_id = roads.Segment.seg_id
+        try:
+            for _ in range(count):
+                if not self._replay_pop():
+                    break
+        finally:
+            roads.Segment.seg_id = seg_id
+        return len(self.city.roads) - added
+
+    def run(self, max_pops: int = None) -> generation.City:
+        """ Replays until the log ends or max_pops roads have been popped """
+        # Every pop takes up more than one byte of the log
+        self.step(len(self.log) if max_pops is None else max_pops - self.pops)
+        return self.city
+
+    def _replay_pop(self) -> bool:
+        """
+        Replays the events of the next popped road, and the pushes before
+        and after it
+        :return: False if there were no roads left to pop
+        """
+        seg = None
+        snap = None
+        split_id = None
+        read = self.log.read
+        offset = self._offset
+        end = len(self.log)
+        while offset < end:
+            kind, fields, next_offset = read(offset)
+            if kind == event_log.POP and seg is not None:
+                break
+            offset = self._offset = next_offset
+
+            if kind == event_log.PUSH:
+                self._push(*fields)
+            elif kind == event_log.POP:
+                seg = self.roads[fields[0]]
+                self.pops += 1
+            elif kind == event_log.SNAP:
+                snap_type, other, at_start, x, y, main, other_factor = fields
+                crossing = None
+                if snap_type in (SnapType.Cross, SnapType.Extend):
+                    crossing = roads.Intersection((x, y), main, other_factor)
+                snap = narrow_phase.Snap(SnapType(snap_type),
+                                         self.roads[other], crossing, at_start)
+            elif kind == event_log.SPLIT:
+                split_id = fields[0]
+            elif kind == event_log.OUTCOME and fields[0] == event_log.PLACED:
+                if snap is not None:
+                    if split_id is not None:
+                        roads.Segment.seg_id = split_id
+                    generation.apply_snap(seg, snap, self.city)
+                    if split_id is not None:
+                        # The split road now starts from the new half
+                        self.roads[split_id] = snap.other.parent
+                seg.connect_links()
+                self.city.roads.append(seg)
+                self.city.sectors.add(seg)
+        return seg is not None
+
+    def _push(self, global_id: int, start_x: float, start_y: float,
+              end_x: float, end_y: float, t: int, flags: int, parent: int):
+        start = ((int(start_x), int(start_y)) if flags & event_log.INT_START
+                 else (start_x, start_y))
+        end = ((int(end_x), int(end_y)) if flags & event_log.INT_END
+               else (end_x, end_y))
+        seg = roads.Segment(start, end, bool(flags & event_log.HIGHWAY), t)
+        seg.global_id = global_id
+        seg.is_branch = bool(flags & event_log.BRANCH)
+        if parent >= 0:
+            seg.parent = self.roads[parent]
+        self.roads[global_id] = seg
+
+
+def replay(path: str, max_pops: int = None) -> generation.City:
+    """ Builds the city in an event log file, up to max_pops popped roads """
+    return Replayer(event_log.EventLog.load(path)).run(max_pops)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Builds a city again from an event log written by "
+                    "batch.py --event-log")
+    parser.add_argument("log", help="An event log file")
+    parser.add_argument("--pops", type=int, default=None,
+                        help="Stop after this many roads have been popped "
+                             "off the queue")
+    parser.add_argument("--save", default=None,
+                        help="Save the city to this file, which the viewer "
+                             "can open")
+    args = parser.parse_args()
+
+    log = event_log.EventLog.load(args.log)
+    for name, value in log.header["config"].items():
+        setattr(config, name, value)
+
+    start_time = time.perf_counter()
+    replayer = Replayer(log)
+    city = replayer.run(args.pops)
+    print("Replayed {} pops into {} segments in {:.1f} ms".format(
+        replayer.pops, len(city.roads),
+        (time.perf_counter() - start_time) * 1000))
+
+    if args.save is not None:
+        city_file.save(city, args.save)
+
+
+if __name__ == "__main__":
+    main()
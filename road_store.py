@@ -0,0 +1,256 @@
+import collections.abc
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy
+
+import roads
+import generation
+import spatial
+from SnapType import SnapType
+
+# Bits of RoadStore.flags
+HIGHWAY = 1
+BRANCH = 2
+
+
+class RoadStore:
+    """
+    The roads of a finished city kept in contiguous arrays instead of one
+    Segment object per road. Generation still builds Segments, so this only
+    lowers the memory a city takes once it is finished, not the peak while
+    it is generated. Links are stored CSR-style: the roads linked at
+    the start of road i are links_s[links_s_offsets[i]:links_s_offsets[i + 1]]
+    and likewise for the end. Roads are referred to by their index in the
+    store, with -1 meaning no road.
+    """
+    def __init__(self, coords: numpy.ndarray, flags: numpy.ndarray,
+                 snaps: numpy.ndarray, times: numpy.ndarray,
+                 parents: numpy.ndarray, global_ids: numpy.ndarray,
+                 links_s_offsets: numpy.ndarray, links_s: numpy.ndarray,
+                 links_e_offsets: numpy.ndarray, links_e: numpy.ndarray):
+        # start x, start y, end x, end y
+        self.coords = coords
+        self.flags = flags
+        self.snaps = snaps
+        self.times = times
+        self.parents = parents
+        self.global_ids = global_ids
+        self.links_s_offsets = links_s_offsets
+        self.links_s = links_s
+        self.links_e_offsets = links_e_offsets
+        self.links_e = links_e
+
+    @classmethod
+    def from_segments(cls, segments: Sequence[roads.Segment]) -> 'RoadStore':
+        """ Packs the given roads, keeping their order """
+        count = len(segments)
+        index_of = {seg: i for i, seg in enumerate(segments)}
+
+        coords = numpy.empty((count, 4), dtype=numpy.float64)
+        flags = numpy.zeros(count, dtype=numpy.uint8)
+        snaps = numpy.empty(count, dtype=numpy.uint8)
+        times = numpy.empty(count, dtype=numpy.int32)
+        parents = numpy.empty(count, dtype=numpy.int32)
+        global_ids = numpy.empty(count, dtype=numpy.int64)
+        links_s_offsets = numpy.zeros(count + 1, dtype=numpy.int32)
+        links_e_offsets = numpy.zeros(count + 1, dtype=numpy.int32)
+        links_s = []
+        links_e = []
+
+        for i, seg in enumerate(segments):
+            coords[i] = (seg.start[0], seg.start[1], seg.end[0], seg.end[1])
+            flags[i] = ((HIGHWAY if seg.is_highway else 0)
+                        | (BRANCH if seg.is_branch else 0))
+            snaps[i] = seg.has_snapped
+            times[i] = seg.t
+            parents[i] = index_of.get(seg.parent, -1)
+            global_ids[i] = seg.global_id
+
+            # Sorted so that packing the same city always gives the same bytes
+            links_s.extend(sorted(index_of[link] for link in seg.links_s
+                                  if link in index_of))
+            links_e.extend(sorted(index_of[link] for link in seg.links_e
+                                  if link in index_of))
+            links_s_offsets[i + 1] = len(links_s)
+            links_e_offsets[i + 1] = len(links_e)
+
+        return cls(coords, flags, snaps, times, parents, global_ids,
+                   links_s_offsets, numpy.array(links_s, dtype=numpy.int32),
+                   links_e_offsets, numpy.array(links_e, dtype=numpy.int32))
+
+    def __len__(self):
+        return len(self.coords)
+
+    def to_segments(self) -> List[roads.Segment]:
+        """
+        Unpacks the store into new Segments, the reverse of from_segments.
+        The global ids are the stored ones, and Segment.seg_id is left as it
+        was
+        """
+        seg_id = roads.Segment.seg_id
+        segments = []
+        for i, (x0, y0, x1, y1) in enumerate(self.coords.tolist()):
+            seg = roads.Segment((x0, y0), (x1, y1),
+                                bool(self.flags[i] & HIGHWAY), int(self.times[i]))
+            seg.is_branch = bool(self.flags[i] & BRANCH)
+            seg.has_snapped = SnapType(int(self.snaps[i]))
+            seg.global_id = int(self.global_ids[i])
+            seg.connected = True
+            segments.append(seg)
+        roads.Segment.seg_id = seg_id
+
+        for i, seg in enumerate(segments):
+            if self.parents[i] >= 0:
+                seg.parent = segments[self.parents[i]]
+            seg.links_s.update(segments[link]
+                               for link in self.start_link_ids(i).tolist())
+            seg.links_e.update(segments[link]
+                               for link in self.end_link_ids(i).tolist())
+        return segments
+
+    def arrays(self) -> Dict[str, numpy.ndarray]:
+        return {"coords": self.coords, "flags": self.flags,
+                "snaps": self.snaps, "times": self.times,
+                "parents": self.parents, "global_ids": self.global_ids,
+                "links_s_offsets": self.links_s_offsets,
+                "links_s": self.links_s,
+                "links_e_offsets": self.links_e_offsets,
+                "links_e": self.links_e}
+
+    def nbytes(self) -> int:
+        """ Gets the number of bytes taken by the arrays of the store """
+        return sum(array.nbytes for array in self.arrays().values())
+
+    def start_link_ids(self, index: int) -> numpy.ndarray:
+        return self.links_s[self.links_s_offsets[index]:
+                            self.links_s_offsets[index + 1]]
+
+    def end_link_ids(self, index: int) -> numpy.ndarray:
+        return self.links_e[self.links_e_offsets[index]:
+                            self.links_e_offsets[index + 1]]
+
+
+class SegmentView:
+    """
+    A read-only roads.Segment backed by a row of a RoadStore. Views of the
+    same row compare and hash equal, so they can be used wherever Segments
+    are used as dict keys
+    """
+    __slots__ = ("store", "index")
+
+    def __init__(self, store: RoadStore, index: int):
+        self.store = store
+        self.index = index
+
+    @property
+    def start(self) -> Tuple[float, float]:
+        coords = self.store.coords[self.index]
+        return float(coords[0]), float(coords[1])
+
+    @property
+    def end(self) -> Tuple[float, float]:
+        coords = self.store.coords[self.index]
+        return float(coords[2]), float(coords[3])
+
+    @property
+    def is_highway(self) -> bool:
+        return bool(self.store.flags[self.index] & HIGHWAY)
+
+    @property
+    def is_branch(self) -> bool:
+        return bool(self.store.flags[self.index] & BRANCH)
+
+    @property
+    def has_snapped(self) -> SnapType:
+        return SnapType(self.store.snaps[self.index])
+
+    @property
+    def t(self) -> int:
+        return int(self.store.times[self.index])
+
+    @property
+    def global_id(self) -> int:
+        return int(self.store.global_ids[self.index])
+
+    @property
+    def parent(self) -> Optional['SegmentView']:
+        parent = self.store.parents[self.index]
+        if parent < 0:
+            return None
+        return SegmentView(self.store, int(parent))
+
+    @property
+    def links_s(self) -> frozenset:
+        return frozenset(SegmentView(self.store, int(i))
+                         for i in self.store.start_link_ids(self.index))
+
+    @property
+    def links_e(self) -> frozenset:
+        return frozenset(SegmentView(self.store, int(i))
+                         for i in self.store.end_link_ids(self.index))
+
+    @property
+    def connected(self) -> bool:
+        return True
+
+    def __eq__(self, other):
+        return (isinstance(other, SegmentView) and other.store is self.store
+                and other.index == self.index)
+
+    def __hash__(self):
+        return hash(self.index)
+
+    def __repr__(self):
+        return "SegmentView({})".format(self.global_id)
+
+    # Everything else only reads the attributes above
+    __lt__ = roads.Segment.__lt__
+    __gt__ = roads.Segment.__gt__
+    length = roads.Segment.length
+    dir = roads.Segment.dir
+    point_at = roads.Segment.point_at
+    find_intersect = roads.Segment.find_intersect
+
+
+class RoadList(collections.abc.Sequence):
+    """ A list of views of some or all roads in a RoadStore """
+    def __init__(self, store: RoadStore, indices: numpy.ndarray = None):
+        self.store = store
+        self.indices = indices
+
+    def __len__(self):
+        if self.indices is None:
+            return len(self.store)
+        return len(self.indices)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError("road index out of range")
+        if self.indices is None:
+            return SegmentView(self.store, item)
+        return SegmentView(self.store, int(self.indices[item]))
+
+    def __iter__(self):
+        if self.indices is None:
+            return (SegmentView(self.store, i) for i in range(len(self.store)))
+        return (SegmentView(self.store, i) for i in self.indices.tolist())
+
+
+def compact(city: generation.City) -> generation.City:
+    """
+    Packs a generated city into a RoadStore, returning a City with the same
+    roads and spatial index made of views of the store. The spatial index
+    still has a view object per road
+    """
+    store = RoadStore.from_segments(city.roads)
+    index_of = {seg: i for i, seg in enumerate(city.roads)}
+
+    index = spatial.QuadTree()
+    for seg in city.sectors:
+        index.add(SegmentView(store, index_of[seg]))
+
+    return generation.City(RoadList(store), index, city.pop, city.seed)
@@ -1,20 +1,43 @@
 import heapq
 from SnapType import SnapType
+import config
+import profiler
 import vectors
 import math
 import collections
-from typing import Tuple, Optional, List
+from typing import Dict, Tuple, Optional, List
 
 Intersection = collections.namedtuple("Intersection", ["point", "main_factor", "other_factor"])
 
+# Counts changes to how roads link together, so that anything caching routes
+# can tell when they may have gone out of date
+topology_version = 0
+
+
+def topology_changed():
+    global topology_version
+    topology_version += 1
+
 
 class Queue:
+    """
+    Segments waiting to be placed, as a heap ordered by t. Segments with the
+    same t come out in whatever order the heap has them in, which is how
+    cities were generated before BucketQueue, so config.ROAD_QUEUE = "heap"
+    still gives the same city for the same seed and config, along with
+    generation.local_constraints looking for snaps the way it did then
+    """
     def __init__(self):
         self.heap: List[Segment] = []
 
+    def __len__(self):
+        return len(self.heap)
+
+    @profiler.timed("queue.push")
     def push(self, segment: 'Segment'):
         heapq.heappush(self.heap, segment)
 
+    @profiler.timed("queue.pop")
     def pop(self) -> 'Segment':
         return heapq.heappop(self.heap)
 
@@ -22,7 +45,61 @@ class Queue:
         return self.heap == []
 
 
+class BucketQueue:
+    """
+    Segments waiting to be placed, in a bucket for each t. t is always a
+    small whole number a little above the t last popped, so there are only
+    ever a few buckets and pushing and popping never compare segments.
+    Segments with the same t come out in the order they were pushed
+    """
+    def __init__(self):
+        self._buckets: Dict[int, collections.deque] = {}
+        # The t of the bucket popped from next, the smallest there is
+        self._time = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @profiler.timed("queue.push")
+    def push(self, segment: 'Segment'):
+        bucket = self._buckets.get(segment.t)
+        if bucket is None:
+            bucket = collections.deque()
+            self._buckets[segment.t] = bucket
+            if self._size == 0 or segment.t < self._time:
+                self._time = segment.t
+        bucket.append(segment)
+        self._size += 1
+
+    @profiler.timed("queue.pop")
+    def pop(self) -> 'Segment':
+        if self._size == 0:
+            raise IndexError("pop from an empty queue")
+        bucket = self._buckets[self._time]
+        segment = bucket.popleft()
+        self._size -= 1
+        if not bucket:
+            del self._buckets[self._time]
+            if self._buckets:
+                self._time = min(self._buckets)
+        return segment
+
+    def is_empty(self):
+        return self._size == 0
+
+
+def new_queue():
+    """ Makes an empty queue of the kind set by config.ROAD_QUEUE """
+    if config.ROAD_QUEUE == "heap":
+        return Queue()
+    return BucketQueue()
+
+
 class Segment:
+    __slots__ = ("start", "end", "is_highway", "t", "has_snapped", "is_branch",
+                 "parent", "links_s", "links_e", "connected", "global_id")
+
     seg_id = 0
 
     def __init__(self, start: Tuple[float, float], end: Tuple[float, float], is_highway: bool, time_delay: int = 0):
@@ -95,6 +172,7 @@ class Segment:
 
         return angle
 
+    @profiler.timed("connect_links")
     def connect_links(self):
         """
         Adds this road to the links of each road this is connected to
@@ -122,6 +200,8 @@ class Segment:
             elif self.end == road.end:
                 road.links_e.add(self)
 
+        topology_changed()
+
         self.connected = True
 
     def point_at(self, factor: float) -> Tuple[float, float]:
@@ -1,22 +1,19 @@
 import config
 import roads
 import vectors
-from typing import Dict, Tuple, List, Set
-
-
-def add(new_seg: roads.Segment, sectors: Dict[Tuple[int, int], List[roads.Segment]]):
-    containing_sectors = from_seg(new_seg)
-
-    for sector in containing_sectors:
-        if sector not in sectors:
-            sectors[sector] = []
-        sectors[sector].append(new_seg)
+from typing import Tuple, Set
 
 
 def from_seg(segment: roads.Segment) -> Set[Tuple[int, int]]:
     """ Gets the sectors the segment is in or within snapping distance of """
-    start_sector = containing_sector(segment.start)
-    end_sector = containing_sector(segment.end)
+    return from_ends(segment.start, segment.end)
+
+
+def from_ends(start: Tuple[float, float],
+              end: Tuple[float, float]) -> Set[Tuple[int, int]]:
+    """ Gets the sectors a segment with the given ends is in or near """
+    start_sector = containing_sector(start)
+    end_sector = containing_sector(end)
 
     aux_secs = set()
 
@@ -25,8 +22,8 @@ def from_seg(segment: roads.Segment) -> Set[Tuple[int, int]]:
         aux_secs.add((end_sector[0] + diff[0], end_sector[1]))
         aux_secs.add((end_sector[0], end_sector[1] + diff[1]))
 
-    start_secs = from_point(segment.start, config.MIN_DIST_EDGE_CONTAINED)
-    end_secs = from_point(segment.end, config.MIN_DIST_EDGE_CONTAINED)
+    start_secs = from_point(start, config.MIN_DIST_EDGE_CONTAINED)
+    end_secs = from_point(end, config.MIN_DIST_EDGE_CONTAINED)
 
     return start_secs.union(end_secs).union(aux_secs)
 
@@ -0,0 +1,587 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy
+
+import config
+import profiler
+import roads
+import vectors
+
+BoundingBox = Tuple[float, float, float, float]
+
+
+class _Node:
+    __slots__ = ("bounds", "items", "children")
+
+    def __init__(self, bounds: BoundingBox):
+        self.bounds = bounds
+        self.items: List[roads.Segment] = []
+        self.children: List[_Node] = None
+
+    def overlaps(self, box: BoundingBox) -> bool:
+        return overlaps(self.bounds, box)
+
+    def split(self):
+        x0, y0, x1, y1 = self.bounds
+        mid_x = (x0 + x1) / 2
+        mid_y = (y0 + y1) / 2
+        self.children = [_Node((x0, y0, mid_x, mid_y)),
+                         _Node((mid_x, y0, x1, mid_y)),
+                         _Node((x0, mid_y, mid_x, y1)),
+                         _Node((mid_x, mid_y, x1, y1))]
+
+
+class QuadTree:
+    """
+    Spatial index of road segments. Leaves split in four once they hold more
+    than config.QUADTREE_CAPACITY roads, so dense areas get small leaves and
+    sparse areas big ones. A road is listed in every leaf its bounding box
+    overlaps, and queries return each road once, in the order they were added
+    """
+    def __init__(self, bounds: BoundingBox = None):
+        if bounds is None:
+            half = config.SECTOR_SIZE * 4
+            bounds = (-half, -half, half, half)
+        self.root = _Node(bounds)
+        # Each road's bounding box when it was indexed, its insertion order
+        # and its start when it was added
+        self._entries: Dict[roads.Segment,
+                            Tuple[BoundingBox, int, Tuple[float, float]]] = {}
+        self._next_order = 0
+        # Boxes of roads added, moved or removed since take_changed was last
+        # called, None until it is first called
+        self._changed: List[BoundingBox] = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, seg: roads.Segment):
+        return seg in self._entries
+
+    def __iter__(self):
+        """ Iterates over every road in the order they were added """
+        return iter(self._entries)
+
+    def order_of(self, seg: roads.Segment) -> int:
+        """ Gets the position of a road in the order roads were added """
+        return self._entries[seg][1]
+
+    def added_start(self, seg: roads.Segment) -> Tuple[float, float]:
+        """ Gets where a road started when it was added, before any moves """
+        return self._entries[seg][2]
+
+    @profiler.timed("index.add")
+    def add(self, seg: roads.Segment, order: int = None,
+            start: Tuple[float, float] = None):
+        """
+        Adds a road to the index
+        :param order: Its place in the order of the roads, after every road
+            added so far if not given
+        :param start: Where it started when it was first added, if it is
+            being copied from another index after it was moved
+        """
+        if seg in self._entries:
+            raise ValueError("Road {} is already indexed".format(seg.global_id))
+
+        if order is None:
+            order = self._next_order
+        box = bounding_box(seg)
+        self._entries[seg] = (box, order,
+                              start if start is not None else seg.start)
+        self._next_order = max(self._next_order, order + 1)
+
+        self._grow_to(box)
+        self._insert(self.root, seg, box)
+        if self._changed is not None:
+            self._changed.append(box)
+
+    def remove(self, seg: roads.Segment):
+        """ Removes a road from the index """
+        box = self._entries.pop(seg)[0]
+        self._remove(self.root, seg, box)
+        if self._changed is not None:
+            self._changed.append(box)
+
+    @profiler.timed("index.move")
+    def move(self, seg: roads.Segment):
+        """
+        Updates the index after the start or end of a road has been changed,
+        keeping its place in the order of the roads
+        """
+        old_box, order, start = self._entries[seg]
+        box = bounding_box(seg)
+        if box == old_box:
+            return
+
+        self._remove(self.root, seg, old_box)
+        self._entries[seg] = (box, order, start)
+        self._grow_to(box)
+        self._insert(self.root, seg, box)
+        if self._changed is not None:
+            self._changed.extend((old_box, box))
+
+    def reorder(self, seg: roads.Segment, order: int):
+        """ Gives a road another place in the order of the roads """
+        box, _, start = self._entries[seg]
+        self._entries[seg] = (box, order, start)
+        self._next_order = max(self._next_order, order + 1)
+
+    def take_changed(self) -> Optional[List[BoundingBox]]:
+        """
+        Gets the bounding boxes of the roads that have been added, moved (both
+        before and after) or removed since the last call, so whatever was
+        drawn of the roads there can be redrawn. Changes are only kept once
+        this has been called, so the first call gives None
+        """
+        changed = self._changed
+        self._changed = []
+        return changed
+
+    def query_box(self, corner1: Tuple[float, float],
+                  corner2: Tuple[float, float]) -> List[roads.Segment]:
+        """ Gets the roads whose bounding boxes overlap the given box """
+        box = (min(corner1[0], corner2[0]), min(corner1[1], corner2[1]),
+               max(corner1[0], corner2[0]), max(corner1[1], corner2[1]))
+
+        found = {}
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            if not node.overlaps(box):
+                continue
+            if node.children is not None:
+                nodes.extend(node.children)
+                continue
+            for seg in node.items:
+                if seg not in found:
+                    seg_box, order, _ = self._entries[seg]
+                    if overlaps(seg_box, box):
+                        found[seg] = order
+
+        return sorted(found, key=found.get)
+
+    def query_radius(self, point: Tuple[float, float],
+                     radius: float) -> List[roads.Segment]:
+        """ Gets the roads that pass within radius of the point """
+        box_roads = self.query_box((point[0] - radius, point[1] - radius),
+                                   (point[0] + radius, point[1] + radius))
+
+        return [seg for seg in box_roads
+                if distance_to_segment(point, seg) <= radius]
+
+    @profiler.timed("index.near_seg")
+    def near_seg(self, seg: roads.Segment, distance: float) -> List[roads.Segment]:
+        """
+        Gets the roads whose bounding boxes come within distance of the
+        bounding box of seg. This includes every road that seg crosses or that
+        has an end or crossing point within distance of seg
+        """
+        x0, y0, x1, y1 = bounding_box(seg)
+        return self.query_box((x0 - distance, y0 - distance),
+                              (x1 + distance, y1 + distance))
+
+    def sample_box(self, corner1: Tuple[float, float],
+                   corner2: Tuple[float, float],
+                   cell_size: float) -> List[roads.Segment]:
+        """
+        Gets some of the roads in a box, thinned out so that no more than one
+        comes from each node of the tree cell_size across or smaller. Only
+        the nodes in the box are visited, so this is quick even when the box
+        holds most of the city
+        """
+        box = (min(corner1[0], corner2[0]), min(corner1[1], corner2[1]),
+               max(corner1[0], corner2[0]), max(corner1[1], corner2[1]))
+
+        found = {}
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            if not node.overlaps(box):
+                continue
+            if node.bounds[2] - node.bounds[0] <= cell_size:
+                seg = _first_item(node)
+                if seg is not None:
+                    found[seg] = None
+            elif node.children is None:
+                found.update(dict.fromkeys(node.items))
+            else:
+                nodes.extend(node.children)
+        return list(found)
+
+    def leaves(self) -> List[_Node]:
+        result = []
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            if node.children is None:
+                result.append(node)
+            else:
+                nodes.extend(node.children)
+        return result
+
+    def pack(self, index_of: Dict[roads.Segment, int]) -> Dict[str, numpy.ndarray]:
+        """
+        Flattens the tree into the arrays of a PackedQuadTree, breadth first
+        so the four children of a node are always next to each other
+        :param index_of: The index each road will have in the packed city
+        """
+        node_bounds = []
+        node_children = []
+        item_offsets = [0]
+        items = []
+
+        nodes = [self.root]
+        for node in nodes:
+            node_bounds.append(node.bounds)
+            if node.children is None:
+                node_children.append(-1)
+                items.extend(sorted(index_of[seg] for seg in node.items))
+            else:
+                node_children.append(len(nodes))
+                nodes.extend(node.children)
+            item_offsets.append(len(items))
+
+        return {"node_bounds": numpy.array(node_bounds, dtype=numpy.float64)
+                .reshape(-1, 4),
+                "node_children": numpy.array(node_children, dtype=numpy.int32),
+                "item_offsets": numpy.array(item_offsets, dtype=numpy.int64),
+                "items": numpy.array(items, dtype=numpy.int32)}
+
+    def _grow_to(self, box: BoundingBox):
+        """ Doubles the size of the root until it contains the box """
+        while not contains(self.root.bounds, box):
+            x0, y0, x1, y1 = self.root.bounds
+            width = x1 - x0
+            height = y1 - y0
+            # Grow towards the box, the old root becomes one of the quadrants
+            grow_left = box[0] < x0
+            grow_up = box[1] < y0
+            new_x0 = x0 - width if grow_left else x0
+            new_y0 = y0 - height if grow_up else y0
+            new_root = _Node((new_x0, new_y0,
+                              new_x0 + 2 * width, new_y0 + 2 * height))
+            new_root.split()
+            new_root.children[(2 if grow_up else 0)
+                              + (1 if grow_left else 0)] = self.root
+            self.root = new_root
+
+    def _insert(self, node: _Node, seg: roads.Segment, box: BoundingBox):
+        # The overlap tests are written out rather than calling overlaps(),
+        # as adding roads is most of the work of replaying an event log
+        box_x0, box_y0, box_x1, box_y1 = box
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            if node.children is not None:
+                for child in node.children:
+                    x0, y0, x1, y1 = child.bounds
+                    if (x0 <= box_x1 and box_x0 <= x1
+                            and y0 <= box_y1 and box_y0 <= y1):
+                        nodes.append(child)
+                continue
+
+            node.items.append(seg)
+            if (len(node.items) > config.QUADTREE_CAPACITY
+                    and node.bounds[2] - node.bounds[0]
+                    > config.QUADTREE_MIN_SIZE):
+                items = node.items
+                node.items = []
+                node.split()
+                for item in items:
+                    item_x0, item_y0, item_x1, item_y1 = self._entries[item][0]
+                    for child in node.children:
+                        x0, y0, x1, y1 = child.bounds
+                        if (x0 <= item_x1 and item_x0 <= x1
+                                and y0 <= item_y1 and item_y0 <= y1):
+                            child.items.append(item)
+
+    def _remove(self, node: _Node, seg: roads.Segment, box: BoundingBox):
+        box_x0, box_y0, box_x1, box_y1 = box
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            x0, y0, x1, y1 = node.bounds
+            if not (x0 <= box_x1 and box_x0 <= x1
+                    and y0 <= box_y1 and box_y0 <= y1):
+                continue
+            if node.children is not None:
+                nodes.extend(node.children)
+            elif seg in node.items:
+                node.items.remove(seg)
+
+
+class PackedQuadTree:
+    """
+    A read-only QuadTree flattened into arrays by QuadTree.pack, so it can be
+    saved and memory-mapped along with the roads it indexes. Roads are
+    referred to by their index in roads, and queries return them in that
+    order, which is the order generate indexes them in
+    """
+    def __init__(self, roads_list: Sequence[roads.Segment],
+                 coords: numpy.ndarray, node_bounds: numpy.ndarray,
+                 node_children: numpy.ndarray, item_offsets: numpy.ndarray,
+                 items: numpy.ndarray):
+        self.roads = roads_list
+        # start x, start y, end x, end y of each road
+        self.coords = coords
+        self.node_bounds = node_bounds
+        self.node_children = node_children
+        self.item_offsets = item_offsets
+        self.items = items
+        # Worked out by _first_items when first needed
+        self._first_item_of: List[int] = None
+
+    @classmethod
+    def build(cls, roads_list: Sequence[roads.Segment],
+              coords: numpy.ndarray) -> 'PackedQuadTree':
+        """
+        Indexes roads straight into a PackedQuadTree, without a QuadTree.
+        Nodes are split the same way, once they hold more than
+        config.QUADTREE_CAPACITY roads, but a whole level of the tree at a
+        time rather than a road at a time
+        :param coords: start x, start y, end x, end y of each road
+        """
+        boxes = numpy.column_stack(
+            (numpy.minimum(coords[:, 0], coords[:, 2]),
+             numpy.minimum(coords[:, 1], coords[:, 3]),
+             numpy.maximum(coords[:, 0], coords[:, 2]),
+             numpy.maximum(coords[:, 1], coords[:, 3])))
+
+        half = config.SECTOR_SIZE * 4
+        bounds = (-half, -half, half, half)
+        if len(boxes):
+            bounds = _grown_bounds(bounds, (boxes[:, 0].min(), boxes[:, 1].min(),
+                                            boxes[:, 2].max(), boxes[:, 3].max()))
+
+        node_bounds = [numpy.array([bounds], dtype=numpy.float64)]
+        node_children = []
+        item_counts = []
+        items = []
+        # The nodes of the level being split, and a (node, road) pair for
+        # each road overlapping each of them, sorted by node then road
+        level_bounds = node_bounds[0]
+        pair_nodes = numpy.zeros(len(boxes), dtype=numpy.int64)
+        pair_items = numpy.arange(len(boxes), dtype=numpy.int64)
+        level_start = 0
+        while len(level_bounds):
+            counts = numpy.bincount(pair_nodes, minlength=len(level_bounds))
+            split = ((counts > config.QUADTREE_CAPACITY)
+                     & (level_bounds[:, 2] - level_bounds[:, 0]
+                        > config.QUADTREE_MIN_SIZE))
+            next_start = level_start + len(level_bounds)
+            first_child = numpy.full(len(level_bounds), -1, dtype=numpy.int64)
+            first_child[split] = next_start + 4 * numpy.arange(split.sum())
+            node_children.append(first_child)
+            item_counts.append(numpy.where(split, 0, counts))
+            items.append(pair_items[~split[pair_nodes]])
+
+            # The children of each split node in the order of _Node.split
+            parents = level_bounds[split]
+            x0, y0, x1, y1 = parents.T
+            mid_x = (x0 + x1) / 2
+            mid_y = (y0 + y1) / 2
+            level_bounds = numpy.stack(
+                (numpy.column_stack((x0, y0, mid_x, mid_y)),
+                 numpy.column_stack((mid_x, y0, x1, mid_y)),
+                 numpy.column_stack((x0, mid_y, mid_x, y1)),
+                 numpy.column_stack((mid_x, mid_y, x1, y1))),
+                axis=1).reshape(-1, 4)
+            node_bounds.append(level_bounds)
+
+            in_split = split[pair_nodes]
+            parent_rank = numpy.cumsum(split) - 1
+            pair_parents = parent_rank[pair_nodes[in_split]]
+            pair_items = pair_items[in_split]
+            box = boxes[pair_items]
+            child_nodes = []
+            child_items = []
+            for quadrant in range(4):
+                children = 4 * pair_parents + quadrant
+                child = level_bounds[children]
+                overlapping = ((child[:, 0] <= box[:, 2])
+                               & (box[:, 0] <= child[:, 2])
+                               & (child[:, 1] <= box[:, 3])
+                               & (box[:, 1] <= child[:, 3]))
+                child_nodes.append(children[overlapping])
+                child_items.append(pair_items[overlapping])
+            # Each quadrant's pairs are sorted already, so a stable sort by
+            # node keeps each node's roads in order
+            pair_nodes = numpy.concatenate(child_nodes)
+            by_node = numpy.argsort(pair_nodes, kind="stable")
+            pair_nodes = pair_nodes[by_node]
+            pair_items = numpy.concatenate(child_items)[by_node]
+            level_start = next_start
+
+        item_offsets = numpy.zeros(level_start + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.concatenate(item_counts), out=item_offsets[1:])
+        return cls(roads_list, coords,
+                   numpy.concatenate(node_bounds)[:level_start],
+                   numpy.concatenate(node_children).astype(numpy.int32),
+                   item_offsets,
+                   numpy.concatenate(items).astype(numpy.int32))
+
+    def __len__(self):
+        return len(self.roads)
+
+    def __iter__(self):
+        return iter(self.roads)
+
+    def take_changed(self) -> Optional[List[BoundingBox]]:
+        """ Same as QuadTree.take_changed, a PackedQuadTree never changes """
+        return []
+
+    def arrays(self) -> Dict[str, numpy.ndarray]:
+        return {"node_bounds": self.node_bounds,
+                "node_children": self.node_children,
+                "item_offsets": self.item_offsets, "items": self.items}
+
+    def query_box(self, corner1: Tuple[float, float],
+                  corner2: Tuple[float, float]) -> List[roads.Segment]:
+        """ Gets the roads whose bounding boxes overlap the given box """
+        box = (min(corner1[0], corner2[0]), min(corner1[1], corner2[1]),
+               max(corner1[0], corner2[0]), max(corner1[1], corner2[1]))
+
+        leaves = []
+        nodes = [0] if len(self.node_children) else []
+        while nodes:
+            node = nodes.pop()
+            if not overlaps(tuple(self.node_bounds[node].tolist()), box):
+                continue
+            first_child = int(self.node_children[node])
+            if first_child < 0:
+                leaves.append(node)
+            else:
+                nodes.extend(range(first_child, first_child + 4))
+        if not leaves:
+            return []
+
+        candidates = numpy.unique(numpy.concatenate(
+            [self.items[self.item_offsets[leaf]:self.item_offsets[leaf + 1]]
+             for leaf in leaves]))
+        coords = self.coords[candidates]
+        keep = ((numpy.minimum(coords[:, 0], coords[:, 2]) <= box[2])
+                & (box[0] <= numpy.maximum(coords[:, 0], coords[:, 2]))
+                & (numpy.minimum(coords[:, 1], coords[:, 3]) <= box[3])
+                & (box[1] <= numpy.maximum(coords[:, 1], coords[:, 3])))
+
+        return [self.roads[i] for i in candidates[keep].tolist()]
+
+    def query_radius(self, point: Tuple[float, float],
+                     radius: float) -> List[roads.Segment]:
+        """ Gets the roads that pass within radius of the point """
+        box_roads = self.query_box((point[0] - radius, point[1] - radius),
+                                   (point[0] + radius, point[1] + radius))
+
+        return [seg for seg in box_roads
+                if distance_to_segment(point, seg) <= radius]
+
+    def near_seg(self, seg: roads.Segment, distance: float) -> List[roads.Segment]:
+        """ Same as QuadTree.near_seg """
+        x0, y0, x1, y1 = bounding_box(seg)
+        return self.query_box((x0 - distance, y0 - distance),
+                              (x1 + distance, y1 + distance))
+
+    def sample_box(self, corner1: Tuple[float, float],
+                   corner2: Tuple[float, float],
+                   cell_size: float) -> List[roads.Segment]:
+        """ Same as QuadTree.sample_box """
+        box = (min(corner1[0], corner2[0]), min(corner1[1], corner2[1]),
+               max(corner1[0], corner2[0]), max(corner1[1], corner2[1]))
+
+        found = {}
+        nodes = [0] if len(self.node_children) else []
+        while nodes:
+            node = nodes.pop()
+            bounds = tuple(self.node_bounds[node].tolist())
+            if not overlaps(bounds, box):
+                continue
+            first_child = int(self.node_children[node])
+            if bounds[2] - bounds[0] <= cell_size:
+                index = self._first_items()[node]
+                if index >= 0:
+                    found[index] = None
+            elif first_child < 0:
+                found.update(dict.fromkeys(self.items[
+                    self.item_offsets[node]:self.item_offsets[node + 1]].tolist()))
+            else:
+                nodes.extend(range(first_child, first_child + 4))
+        return [self.roads[i] for i in found]
+
+    def _first_items(self) -> List[int]:
+        """
+        Gets the index of the first road under each node, or -1 for nodes
+        with no roads under them, working them out the first time
+        """
+        if self._first_item_of is None:
+            offsets = self.item_offsets.tolist()
+            items = self.items
+            first = [int(items[offsets[node]])
+                     if offsets[node] < offsets[node + 1] else -1
+                     for node in range(len(self.node_children))]
+            children = self.node_children.tolist()
+            # Children always come after their parent
+            for node in range(len(children) - 1, -1, -1):
+                if children[node] >= 0:
+                    first[node] = next(
+                        (first[child]
+                         for child in range(children[node], children[node] + 4)
+                         if first[child] >= 0), -1)
+            self._first_item_of = first
+        return self._first_item_of
+
+
+def _first_item(node: _Node) -> Optional[roads.Segment]:
+    """ Gets the first road found under a node """
+    nodes = [node]
+    while nodes:
+        node = nodes.pop()
+        if node.children is not None:
+            nodes.extend(node.children)
+        elif node.items:
+            return node.items[0]
+    return None
+
+
+def _grown_bounds(bounds: BoundingBox, box: BoundingBox) -> BoundingBox:
+    """ Gets the bounds QuadTree._grow_to grows a root with bounds to """
+    while not contains(bounds, box):
+        x0, y0, x1, y1 = bounds
+        width = x1 - x0
+        height = y1 - y0
+        new_x0 = x0 - width if box[0] < x0 else x0
+        new_y0 = y0 - height if box[1] < y0 else y0
+        bounds = (new_x0, new_y0, new_x0 + 2 * width, new_y0 + 2 * height)
+    return bounds
+
+
+def bounding_box(seg: roads.Segment) -> BoundingBox:
+    return (min(seg.start[0], seg.end[0]), min(seg.start[1], seg.end[1]),
+            max(seg.start[0], seg.end[0]), max(seg.start[1], seg.end[1]))
+
+
+def overlaps(box1: BoundingBox, box2: BoundingBox) -> bool:
+    return (box1[0] <= box2[2] and box2[0] <= box1[2]
+            and box1[1] <= box2[3] and box2[1] <= box1[3])
+
+
+def contains(outer: BoundingBox, inner: BoundingBox) -> bool:
+    return (outer[0] <= inner[0] and outer[1] <= inner[1]
+            and inner[2] <= outer[2] and inner[3] <= outer[3])
+
+
+def distance_to_segment(point: Tuple[float, float], seg: roads.Segment) -> float:
+    """ Gets the distance from the point to the closest point on the road """
+    seg_vector = vectors.sub(seg.end, seg.start)
+    length_squared = vectors.dot(seg_vector, seg_vector)
+    if length_squared == 0:
+        return vectors.distance(point, seg.start)
+
+    factor = vectors.dot(vectors.sub(point, seg.start), seg_vector) / length_squared
+    factor = max(0, min(1, factor))
+
+    return vectors.distance(point, seg.point_at(factor))
+
+
+def snap_distance() -> float:
+    """ Gets how close a road has to be to a new road to be checked for snaps """
+    return max(config.SNAP_VERTEX_RADIUS, config.SNAP_EXTEND_RADIUS)
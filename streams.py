@@ -0,0 +1,66 @@
+import hashlib
+import random
+import struct
+
+import config
+import roads
+
+_MASK = (1 << 64) - 1
+# Added to the counter for each draw, as in splitmix64
+_GAMMA = 0x9E3779B97F4A7C15
+
+
+class SegmentRandom(random.Random):
+    """
+    Random numbers worked out from a counter rather than kept as a running
+    state. Before generating the roads that follow on from a segment,
+    begin() keys the numbers to the seed and where the segment is, and each
+    draw after that is a hash of the key and how many draws came before it.
+    The roads grown from a segment then only depend on the seed and the
+    segment, not on how many roads were placed before it or in which
+    process, so any part of a city can be grown again on its own
+    """
+    def __init__(self, seed):
+        self._seed_key = _hash(repr(seed).encode())
+        self._key = self._seed_key
+        self._draw = 0
+        super().__init__(seed)
+
+    def begin(self, segment: roads.Segment):
+        """ Starts the numbers for the roads following on from segment """
+        self._key = _hash(struct.pack("<Q4d?", self._seed_key,
+                                      segment.start[0], segment.start[1],
+                                      segment.end[0], segment.end[1],
+                                      segment.is_highway))
+        self._draw = 0
+
+    def _next(self) -> int:
+        """ Gets the next 64 random bits """
+        self._draw += 1
+        value = (self._key + self._draw * _GAMMA) & _MASK
+        value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+        value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK
+        return value ^ (value >> 31)
+
+    def random(self) -> float:
+        return (self._next() >> 11) * (1.0 / (1 << 53))
+
+    def getrandbits(self, k: int) -> int:
+        if k <= 64:
+            return self._next() >> (64 - k)
+        bits = 0
+        for shift in range(0, k, 64):
+            bits |= self._next() << shift
+        return bits & ((1 << k) - 1)
+
+
+def new_rng(seed) -> random.Random:
+    """ Makes the source of random numbers config.ROAD_RANDOM asks for """
+    if config.ROAD_RANDOM == "counter":
+        return SegmentRandom(seed)
+    return random.Random(seed)
+
+
+def _hash(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(),
+                          "little")
@@ -0,0 +1,239 @@
+import hashlib
+import math
+import multiprocessing
+import random
+from typing import Dict, List, Tuple
+
+import config
+import generation
+import population
+import road_store
+import roads
+import spatial
+import streams
+
+Tile = Tuple[int, int]
+# An edge between two tiles: "x" for the vertical edge at x = i * TILE_SIZE
+# spanning row j, "y" for the horizontal edge at y = j * TILE_SIZE spanning
+# column i
+Edge = Tuple[str, int, int]
+
+# Tiles give out global ids in blocks of this size, so that a road's id only
+# depends on its tile and not on which tiles were generated before it
+_ID_BLOCK = 1 << 20
+
+
+class World:
+    """
+    A city without an edge, generated a tile at a time as it is needed.
+    Each tile is grown on its own from a seed that only depends on the world
+    seed and the tile, starting from portal roads on its edges. Both tiles
+    sharing an edge put the same portals on it, so their roads meet up once
+    both are generated, and any region always gets the same roads no matter
+    which order the tiles around it were generated in
+    """
+    def __init__(self, seed):
+        self.seed = seed
+        # Same heatmap as generate() gives for the seed
+        seeded = random.Random(seed)
+        pop_seed = (seeded.randrange(-1, 1) * 1000000000,
+                    seeded.randrange(-1, 1) * 1000000000)
+        self.city = generation.City([], spatial.QuadTree(),
+                                    population.Heatmap(pop_seed), seed)
+        self.tiles: Dict[Tile, List[roads.Segment]] = {}
+        # Roads with an end on each portal point, from all generated tiles
+        self._portal_roads: Dict[Tuple[float, float], List[roads.Segment]] = {}
+
+    def tiles_in(self, corner1: Tuple[float, float],
+                 corner2: Tuple[float, float]) -> List[Tile]:
+        """ Gets the tiles overlapping a box, nearest its center first """
+        x0, x1 = sorted((corner1[0], corner2[0]))
+        y0, y1 = sorted((corner1[1], corner2[1]))
+        center = ((x0 + x1) / 2, (y0 + y1) / 2)
+
+        tiles = [(i, j)
+                 for i in range(math.floor(x0 / config.TILE_SIZE),
+                                math.floor(x1 / config.TILE_SIZE) + 1)
+                 for j in range(math.floor(y0 / config.TILE_SIZE),
+                                math.floor(y1 / config.TILE_SIZE) + 1)]
+        return sorted(tiles, key=lambda tile: (
+            ((tile[0] + 0.5) * config.TILE_SIZE - center[0]) ** 2
+            + ((tile[1] + 0.5) * config.TILE_SIZE - center[1]) ** 2, tile))
+
+    def ensure(self, corner1: Tuple[float, float],
+               corner2: Tuple[float, float],
+               limit: int = None, workers: int = 1) -> List[roads.Segment]:
+        """
+        Generates the tiles overlapping a box that haven't been yet
+        :param limit: Most tiles to generate, None for all of them
+        :param workers: Processes to grow the tiles in, see generate_tiles
+        :return: The roads that were added to the city
+        """
+        missing = [tile for tile in self.tiles_in(corner1, corner2)
+                   if tile not in self.tiles]
+        return self.generate_tiles(missing[:limit], workers)
+
+    def generate_tile(self, tile: Tile) -> List[roads.Segment]:
+        """ Generates a tile and adds its roads to the city """
+        if tile in self.tiles:
+            return []
+        return self._add_tile(tile, self._grow_tile(tile))
+
+    def generate_tiles(self, tiles: List[Tile],
+                       workers: int = 1) -> List[roads.Segment]:
+        """
+        Generates the given tiles that haven't been yet, growing them in a
+        pool of worker processes. A tile only needs the portals on its edges
+        to be grown, so the workers never wait on each other. The grown tiles
+        are added to the city in the order given, giving the same city as
+        generating them one at a time
+        :param workers: Processes to grow tiles in, 1 to grow them here
+        :return: The roads that were added to the city
+        """
+        missing = [tile for tile in dict.fromkeys(tiles)
+                   if tile not in self.tiles]
+        if workers <= 1 or len(missing) <= 1:
+            added = []
+            for tile in missing:
+                added += self.generate_tile(tile)
+            return added
+
+        # Workers are spawned, so they are given the config of this process
+        settings = {name: value for name, value in vars(config).items()
+                    if name.isupper()}
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(min(workers, len(missing))) as pool:
+            stores = pool.starmap(
+                _grow_packed,
+                [(self.seed, tile, settings) for tile in missing],
+                chunksize=1)
+
+        added = []
+        for tile, store in zip(missing, stores):
+            added += self._add_tile(tile, store.to_segments())
+        return added
+
+    def _grow_tile(self, tile: Tile) -> List[roads.Segment]:
+        """ Grows the roads of a tile on their own, without adding them """
+        tile_city = generation.City([], spatial.QuadTree(), self.city.pop,
+                                    self.seed)
+
+        # New segments take their ids from the global counter, so leave it as
+        # it was for whatever else is using it
+        seg_id = roads.Segment.seg_id
+        try:
+            roads.Segment.seg_id = tile_id_start(tile)
+
+            road_queue = roads.new_queue()
+            for edge, inward in tile_edges(tile):
+                for point in self.portals(edge):
+                    end = (point[0] + inward[0] * config.HIGHWAY_LENGTH,
+                           point[1] + inward[1] * config.HIGHWAY_LENGTH)
+                    road_queue.push(roads.Segment(point, end, True))
+
+            generation.grow(tile_city, road_queue, config.TILE_MAX_SEGS,
+                            tile_bounds(tile),
+                            streams.new_rng(_hash(self.seed, "tile", tile)))
+        finally:
+            roads.Segment.seg_id = seg_id
+        return tile_city.roads
+
+    def _add_tile(self, tile: Tile,
+                  tile_roads: List[roads.Segment]) -> List[roads.Segment]:
+        """ Adds the grown roads of a tile to the city """
+        for road in tile_roads:
+            self.city.roads.append(road)
+            self.city.sectors.add(road)
+        portals = [point for edge, _ in tile_edges(tile)
+                   for point in self.portals(edge)]
+        self._link_portals(portals, tile_roads)
+        self.tiles[tile] = tile_roads
+        roads.topology_changed()
+
+        return tile_roads
+
+    def portals(self, edge: Edge) -> List[Tuple[float, float]]:
+        """ Gets the points where roads cross an edge between two tiles """
+        seeded = random.Random(_hash(self.seed, "edge", edge))
+        count = seeded.randint(1, config.TILE_PORTALS)
+        # Kept away from the corners, where they would crowd the portals of
+        # the edges meeting there
+        factors = sorted(seeded.uniform(0.1, 0.9) for _ in range(count))
+
+        # Always floats, as roads sent back from worker processes have float
+        # coordinates and should be the same as roads grown here
+        axis, i, j = edge
+        if axis == "x":
+            return [(float(i * config.TILE_SIZE),
+                     (j + factor) * config.TILE_SIZE) for factor in factors]
+        return [((i + factor) * config.TILE_SIZE,
+                 float(j * config.TILE_SIZE)) for factor in factors]
+
+    def _link_portals(self, portals: List[Tuple[float, float]],
+                      tile_roads: List[roads.Segment]):
+        """ Links the roads of a new tile to the roads across its portals """
+        portal_set = set(portals)
+        at_portal: Dict[Tuple[float, float], List[roads.Segment]] = {}
+        for road in tile_roads:
+            for point in (road.start, road.end):
+                if point in portal_set:
+                    at_portal.setdefault(point, []).append(road)
+
+        for point, new_roads in at_portal.items():
+            old_roads = self._portal_roads.setdefault(point, [])
+            for new_road in new_roads:
+                for old_road in old_roads:
+                    _link_at(new_road, old_road, point)
+                    _link_at(old_road, new_road, point)
+            old_roads.extend(new_roads)
+
+
+def tile_bounds(tile: Tile) -> spatial.BoundingBox:
+    return (tile[0] * config.TILE_SIZE, tile[1] * config.TILE_SIZE,
+            (tile[0] + 1) * config.TILE_SIZE, (tile[1] + 1) * config.TILE_SIZE)
+
+
+def tile_edges(tile: Tile) -> List[Tuple[Edge, Tuple[int, int]]]:
+    """ Gets the edges of a tile, each with the direction into the tile """
+    i, j = tile
+    return [(("x", i, j), (1, 0)), (("x", i + 1, j), (-1, 0)),
+            (("y", i, j), (0, 1)), (("y", i, j + 1), (0, -1))]
+
+
+def tile_id_start(tile: Tile) -> int:
+    """ Gets the first global id given to the roads of a tile """
+    # Interleave negative and positive coordinates, then pair them up
+    a = 2 * tile[0] if tile[0] >= 0 else -2 * tile[0] - 1
+    b = 2 * tile[1] if tile[1] >= 0 else -2 * tile[1] - 1
+    return ((a + b) * (a + b + 1) // 2 + b) * _ID_BLOCK
+
+
+def _link_at(road: roads.Segment, other: roads.Segment,
+             point: Tuple[float, float]):
+    if road.start == point:
+        road.links_s.add(other)
+    else:
+        road.links_e.add(other)
+
+
+# The world of each seed a worker has grown tiles for, so the heatmap is only
+# made once per worker
+_worker_worlds: Dict[int, World] = {}
+
+
+def _grow_packed(seed, tile: Tile,
+                 settings: Dict[str, object]) -> road_store.RoadStore:
+    """ Grows a tile in a worker process, packed to be sent back """
+    for name, value in settings.items():
+        setattr(config, name, value)
+    world = _worker_worlds.get(seed)
+    if world is None:
+        world = World(seed)
+        _worker_worlds[seed] = world
+    return road_store.RoadStore.from_segments(world._grow_tile(tile))
+
+
+def _hash(*parts) -> int:
+    """ Hashes to the same value in every process, unlike hash() on strings """
+    return int.from_bytes(hashlib.blake2b(repr(parts).encode(),
+                                          digest_size=8).digest(), "little")